@@ -1,42 +1,42 @@
 # CRF: Cloud Run Function
 
-import os, time, posixpath
+import re, time, posixpath
 import utils.gcs_utils as gcs
+import utils.manifest_utils as mnf
 
 from google.cloud import storage
 from utils.resource_manager import resource_manager as res
-from utils.lock_utils import acquire_lock
+
+
+RESULT_BLOB_PATTERN = re.compile(r"^(?P<dataset>.+)_result_(?P<batch_id>\d+)\.jsonl$")    # es: "ABC_result_0.jsonl" -> ("ABC", 0)
 
 
 # F01 - Merge single result files in one final 'result.json' (eseguita come Cloud Function al trigger di GCS, cioè ogni volta che un file 'result' viene creato)
+#       Ogni evento registra il proprio batch nel manifest della run (costo costante: nessun listing, nessun download dei batch);
+#       il merge viene eseguito una sola volta, dall'invocazione che registra l'ultimo batch. Run diverse (anche dello stesso dataset)
+#       hanno file, manifest e risultati separati sotto 'runs/<run_id>/', quindi possono essere elaborate in parallelo
 def merge_handler(event, context):
-    # Filtra solo eventi legati ai result batch (complemento al trigger con osservabilità limitata all'intero bucket)
-    results_prefix = res.gcs_batch_result_dir + "/"
-    metrics_prefix = res.gcs_batch_metrics_dir + "/"
-
     try:
         # Parametri dell'origine dell'evento trigger
         bucket_name = event["bucket"]
         object_name = event["name"]
 
-        if not object_name.startswith(results_prefix):
+        # Filtra solo eventi legati ai result batch (complemento al trigger con osservabilità limitata all'intero bucket)
+        folder, filename = posixpath.split(object_name)
+        is_batch_result, run_id = parse_batch_folder(folder)
+        if not is_batch_result:
             return
-        
-        bucket = storage.Client().bucket(bucket_name)
 
-        # Estrazione file (risultati e metriche)
-        res_blobs = list(bucket.list_blobs(prefix=results_prefix))
-        met_blobs = list(bucket.list_blobs(prefix=metrics_prefix))
-    
-        if not res_blobs:   # assenza di file nella directory
+        match = RESULT_BLOB_PATTERN.match(filename)
+        if not match:
             return
 
+        dataset_name, batch_id = match["dataset"], int(match["batch_id"])
+        bucket = storage.Client().bucket(bucket_name)
+
         try:
-            # Lettura metadati
-            dataset_name = os.path.basename(res_blobs[0].name).split("_result_")[0]     # es: "ABC_result_0.jsonl" -> "ABC"
-            metadata = gcs.get_metadata(bucket, dataset_name)
-        except IndexError:
-            return
+            # Lettura del documento della run (numero di batch proprio della run), o dei metadati per i batch senza run ID
+            metadata = gcs.get_run(bucket, run_id) if run_id else gcs.get_metadata(bucket, dataset_name)
         except Exception as e:
             res.logger.error(f"[main|F01]\t\t-> Failed to retrieve metadata ({type(e).__name__}): {str(e)}")
             raise
@@ -45,33 +45,78 @@ def merge_handler(event, context):
         if expected_batches < 0:
             res.logger.warning("[main|F01]\t\t-> 'n_batches' undefined in metadata")
             return
-        
-        n_blobs = len(res_blobs) + len(met_blobs)
-        if n_blobs < expected_batches * 2:
-            res.logger.info(f"[main|F01]\t\t-> Found only {n_blobs}/{expected_batches*2} batch result files")
+
+        # Registrazione del batch nel suo shard del manifest, e dello shard nel riepilogo quando è completo
+        manifest_name = mnf.manifest_name(dataset_name, metadata, run_id)
+        n_shards = mnf.get_num_shards(metadata)
+        if not mnf.register_batch(bucket, manifest_name, batch_id, expected_batches, n_shards, run_id):
+            return
+
+        owner = getattr(context, "event_id", None) or object_name
+        if not mnf.register_shard(bucket, manifest_name, batch_id, expected_batches, n_shards, owner, run_id):
+            res.logger.info(f"[main|F01]\t\t-> Batch {batch_id} registered, merge not (or not yet) assigned to this invocation")
             return
-        
-        # Acquisizione lock (creazione flag)
-        if not acquire_lock(bucket):
-            return  
-        
-        gcs_result_path = posixpath.join(res.gcs_result_dir, f"{dataset_name}_result.json")
-        gcs_metrics_path = posixpath.join(res.gcs_metrics_dir, f"{dataset_name}_metrics.json")
-        gcs_metrics_csv_path = posixpath.join(res.gcs_metrics_dir, f"{dataset_name}_metrics.csv")
-
-        # Unificazione e upload file JSON (batch result file)
-        res.logger.info(f"[main|F01]\t\t-> Saving {n_blobs} batch result files in '{gcs_result_path}'")
-        result_data = list(gcs.stream_jsonl_blobs(res_blobs))
-        gcs.upload_json(bucket, gcs_result_path, result_data)
-
-        time.sleep(1)   # NB: necessario per permettere la corretta generazione di tutti i file metrics
+
+        if run_id:
+            mnf.update_run(bucket, run_id, status="merging", merge_started_at=time.time())
+
+        result_dir = gcs.get_run_dir(res.gcs_result_dir, run_id)
+        metrics_dir = gcs.get_run_dir(res.gcs_metrics_dir, run_id)
+        gcs_result_path = posixpath.join(result_dir, f"{dataset_name}_result.json")
+        gcs_result_jsonl_path = posixpath.join(result_dir, f"{dataset_name}_result.jsonl")
+        gcs_metrics_path = posixpath.join(metrics_dir, f"{dataset_name}_metrics.json")
+        gcs_metrics_csv_path = posixpath.join(res.gcs_metrics_dir, f"{dataset_name}_metrics.csv")    # storico condiviso tra tutte le run del dataset
+
+        # Nomi dei batch file deterministici (stesso schema del worker): nessun listing delle directory
+        batch_result_dir = gcs.get_run_dir(res.gcs_batch_result_dir, run_id)
+        batch_metrics_dir = gcs.get_run_dir(res.gcs_batch_metrics_dir, run_id)
+        res_blobs = [bucket.blob(posixpath.join(batch_result_dir, f"{dataset_name}_result_{i}.jsonl")) for i in range(expected_batches)]
+        met_blobs = [bucket.blob(posixpath.join(batch_metrics_dir, f"{dataset_name}_metrics_{i}.jsonl")) for i in range(expected_batches)]
+        merged_paths = [gcs_metrics_path]
+
+        # Unificazione batch result file: concatenazione lato server in un unico JSONL (nessun download), con JSON derivato opzionale
+        if res.merge_mode == "compose":
+            res.logger.info(f"[main|F01]\t\t-> Composing {expected_batches} batch result files into '{gcs_result_jsonl_path}'")
+            gcs.compose_blobs(bucket, res_blobs, gcs_result_jsonl_path, posixpath.join(gcs.get_run_dir(res.gcs_compose_tmp_dir, run_id), dataset_name))
+            merged_paths.append(gcs_result_jsonl_path)
+
+            if res.merge_json_artifact:
+                gcs.upload_json(bucket, gcs_result_path, gcs.stream_jsonl_blobs(res_blobs))
+                merged_paths.append(gcs_result_path)
+        else:
+            res.logger.info(f"[main|F01]\t\t-> Saving {expected_batches} batch result files in '{gcs_result_path}'")
+            gcs.upload_json(bucket, gcs_result_path, gcs.stream_jsonl_blobs(res_blobs))  # generatore: nessuna lista completa in memoria
+            merged_paths.append(gcs_result_path)
 
         # Unificazione e upload file CSV (batch metrics file)
-        res.logger.info(f"[main|F01]\t\t-> Saving {n_blobs} batch metrics files in '{gcs_metrics_path}'")
+        # NB: il worker carica le metriche di un batch prima dei suoi risultati, quindi qui sono già tutte presenti
+        res.logger.info(f"[main|F01]\t\t-> Saving {expected_batches} batch metrics files in '{gcs_metrics_path}'")
         metrics_data = list(gcs.stream_jsonl_blobs(met_blobs))
         gcs.upload_json(bucket, gcs_metrics_path, metrics_data)
         gcs.update_csv(bucket, gcs_metrics_csv_path, metrics_data)
 
+        # Pubblicazione dei file della run come ultimi risultati del dataset (copia lato server, letta da '/result' senza run ID)
+        if run_id:
+            for path in merged_paths:
+                shared_dir = res.gcs_metrics_dir if path == gcs_metrics_path else res.gcs_result_dir
+                bucket.copy_blob(bucket.blob(path), bucket, posixpath.join(shared_dir, posixpath.basename(path)))
+
+        mnf.mark_done(bucket, manifest_name, run_id)
+        if run_id:
+            mnf.update_run(bucket, run_id, status="completed", merge_completed_at=time.time(), output_paths=merged_paths)
+
     except Exception as e:
         res.logger.error(f"[main|F01]\t\t-> Error ({type(e).__name__}): {str(e)}")
         raise
+
+
+# F02 - Run di un batch result file a partire dalla sua cartella: (True, run_id) per 'runs/<run_id>/batch_results',
+#       (True, None) per la cartella condivisa (batch senza run ID), (False, None) per qualsiasi altra cartella
+def parse_batch_folder(folder: str) -> tuple[bool, str | None]:
+    if folder == res.gcs_batch_result_dir:
+        return True, None
+
+    parts = folder.split("/")
+    if len(parts) == 3 and parts[0] == res.gcs_runs_dir and parts[2] == res.gcs_batch_result_dir:
+        return True, parts[1]
+    return False, None
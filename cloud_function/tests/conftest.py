@@ -0,0 +1,76 @@
+# Configurazione comune dei test del merge handler: bucket GCS simulato in memoria (generation e precondizioni come GCS) e resource manager
+# minimale, così che i test non richiedano credenziali, rete o le librerie Google
+
+import os, sys, types, logging
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    import google.api_core.exceptions
+except ImportError:     # solo le eccezioni usate dal merge handler per le scritture condizionate
+    exceptions = types.ModuleType("google.api_core.exceptions")
+    for name in ("NotFound", "PreconditionFailed", "TooManyRequests"):
+        setattr(exceptions, name, type(name, (Exception,), {}))
+    sys.modules.setdefault("google", types.ModuleType("google"))
+    sys.modules["google.api_core"] = types.SimpleNamespace(exceptions=exceptions)
+    sys.modules["google.api_core.exceptions"] = exceptions
+
+try:
+    from google.cloud import storage
+except ImportError:     # 'storage' è usato solo nelle annotazioni dei tipi
+    sys.modules.setdefault("google", types.ModuleType("google"))
+    sys.modules["google.cloud.storage"] = types.SimpleNamespace(Bucket=object, Blob=object, Client=None)
+    sys.modules["google.cloud"] = types.SimpleNamespace(storage=sys.modules["google.cloud.storage"])
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+
+# C01 - Blob simulato: ogni scrittura incrementa la generation, 'if_generation_match' fallisce come su GCS (0 = il blob non deve esistere)
+class FakeBlob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = bucket.objects.get(name, (None, None))[1]
+
+    def upload_from_string(self, data, content_type: str = None, if_generation_match: int = None):
+        self._check(if_generation_match)
+        self.bucket.generation += 1
+        self.generation = self.bucket.generation
+        self.bucket.objects[self.name] = (data.encode() if isinstance(data, str) else data, self.generation)
+
+    def download_as_text(self, if_generation_match: int = None) -> str:
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        self._check(if_generation_match)
+        return self.bucket.objects[self.name][0].decode()
+
+    def _check(self, if_generation_match: int):
+        if if_generation_match is not None and if_generation_match != self.bucket.objects.get(self.name, (None, 0))[1]:
+            raise PreconditionFailed(self.name)
+
+
+# C02 - Bucket simulato (oggetti in memoria: nome -> (contenuto, generation))
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str) -> FakeBlob | None:
+        return FakeBlob(self, name) if name in self.objects else None
+
+
+# Resource manager minimale: quello reale scarica la configurazione da GCS all'import
+res = types.SimpleNamespace(
+    logger=logging.getLogger("test"), gcs_runs_dir="runs", gcs_manifest_dir="batch_manifests", manifest_num_shards=16
+)
+sys.modules["utils.resource_manager"] = types.SimpleNamespace(resource_manager=res)
+
+
+# Bucket vuoto per ogni test (il merge handler riceve il bucket come argomento, ricavato dall'evento trigger)
+@pytest.fixture
+def bucket() -> FakeBucket:
+    return FakeBucket()
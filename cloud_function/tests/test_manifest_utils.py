@@ -0,0 +1,70 @@
+# Test delle transizioni del manifest di merge (utils/manifest_utils.py): 'collecting' -> 'merging' (una sola invocazione) -> 'done'
+
+import json
+import pytest
+
+import utils.manifest_utils as mnf
+
+NUM_BATCHES = 5
+RUN = {"num_batches": NUM_BATCHES, "manifest_num_shards": 2}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(mnf.time, "sleep", lambda seconds: None)
+
+
+def manifest(bucket, name: str = "D", run_id: str = "r1") -> dict:
+    return json.loads(bucket.objects[mnf.manifest_path(name, run_id)][0])
+
+
+# Registrazione di un batch come nel merge handler: True se l'invocazione ('owner') deve eseguire il merge
+def register(bucket, batch_id: int, owner: str, metadata: dict = RUN, run_id: str = "r1") -> bool:
+    name = mnf.manifest_name("D", metadata, run_id)
+    n_shards = mnf.get_num_shards(metadata)
+    return (mnf.register_batch(bucket, name, batch_id, metadata["num_batches"], n_shards, run_id)
+            and mnf.register_shard(bucket, name, batch_id, metadata["num_batches"], n_shards, owner, run_id))
+
+
+def test_last_batch_starts_merge_once(bucket):
+    owners = [register(bucket, batch_id, f"event-{batch_id}") for batch_id in range(NUM_BATCHES)]
+
+    assert owners == [False] * (NUM_BATCHES - 1) + [True]
+    assert manifest(bucket)["state"] == mnf.STATE_MERGING
+    assert manifest(bucket)["merge_owner"] == f"event-{NUM_BATCHES - 1}"
+
+
+def test_redelivered_event_keeps_merge_owner(bucket):
+    for batch_id in range(NUM_BATCHES):
+        register(bucket, batch_id, f"event-{batch_id}")
+
+    assert register(bucket, NUM_BATCHES - 1, f"event-{NUM_BATCHES - 1}")   # stesso evento riconsegnato dopo un errore del merge
+    assert not register(bucket, NUM_BATCHES - 1, "duplicate-event")        # evento duplicato con un altro ID
+
+
+def test_done_manifest_is_not_merged_again(bucket):
+    for batch_id in range(NUM_BATCHES):
+        register(bucket, batch_id, f"event-{batch_id}")
+    mnf.mark_done(bucket, "D", "r1")
+
+    assert manifest(bucket)["state"] == mnf.STATE_DONE
+    assert not register(bucket, NUM_BATCHES - 1, f"event-{NUM_BATCHES - 1}")
+
+
+def test_shard_count_comes_from_the_run(bucket):
+    register(bucket, 0, "event-0")
+
+    assert mnf.get_num_shards(RUN) == 2
+    assert mnf.get_num_shards({"num_batches": NUM_BATCHES}) == NUM_BATCHES    # batch senza run ID: dalla configurazione
+    assert mnf.shard_path("D", 0, "r1") in bucket.objects
+
+
+def test_new_analysis_without_run_id_gets_a_fresh_manifest(bucket):
+    first = {"num_batches": 1, "analysis_started_at": 100.0}
+    second = {"num_batches": 1, "analysis_started_at": 200.0}
+
+    assert register(bucket, 0, "event-a", first, run_id=None)
+    mnf.mark_done(bucket, mnf.manifest_name("D", first), None)
+
+    assert register(bucket, 0, "event-b", second, run_id=None)
+    assert manifest(bucket, mnf.manifest_name("D", second), None)["state"] == mnf.STATE_MERGING
@@ -1,57 +1,217 @@
-import io, json, csv, posixpath
+import io, json, csv, uuid, hashlib, posixpath
 
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
 from utils.resource_manager import resource_manager as res
 
 
+COMPOSE_MAX_SOURCES = 32    # limite GCS di file sorgente per singola operazione di compose
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # dimensione dei chunk dell'upload resumable (multiplo di 256 KiB)
+RUN_DOC_FILENAME = "run.json"   # documento di stato di una run, nella radice del suo prefisso (stesso nome usato dal server)
+
+
 # F01 - Estrazione metadati di dataset pre-caricato su GCS
 def get_metadata(bucket: storage.Bucket, dataset_name: str) -> dict:
     metadata_path = posixpath.join(res.gcs_dataset_dir, f"{dataset_name}_metadata.json")
     metadata_text = bucket.blob(metadata_path).download_as_text()
     return json.loads(metadata_text)
 
+# F01B - Directory di una cartella nello spazio di una run ('runs/<run_id>/<folder>'); senza run ID, la cartella condivisa (analisi avviate prima dei run ID)
+def get_run_dir(folder: str, run_id: str = None) -> str:
+    return posixpath.join(res.gcs_runs_dir, run_id, folder) if run_id else folder
+
+# F01C - Estrazione del documento di stato di una run (scritto dal server all'avvio dell'analisi)
+def get_run(bucket: storage.Bucket, run_id: str) -> dict:
+    return json.loads(bucket.blob(get_run_doc_path(run_id)).download_as_text())
+
+def get_run_doc_path(run_id: str) -> str:
+    return posixpath.join(res.gcs_runs_dir, run_id, RUN_DOC_FILENAME)
+
 
 # F02 - Estrazione dati da file multipli per creare uno stream di entry JSONL
+#       I download avvengono in parallelo (pool di thread limitato) con una finestra scorrevole di file in anticipo sullo stream,
+#       così che la memoria resti limitata a pochi batch; le entry sono restituite nello stesso ordine di 'blobs' (cioè per 'batch_id')
 def stream_jsonl_blobs(blobs: list[storage.Blob]):
-    for blob in blobs:
-        try:
-            lines = blob.download_as_text().strip().splitlines()
-            for line in lines:
-                yield json.loads(line)
-        except Exception as e:
-            res.logger.error(f"[GCS|F02]\t\t-> Error in '{blob.name}': {str(e)}")
+    max_workers = max(1, res.merge_download_workers)
+    blobs = iter(blobs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window = deque((blob, executor.submit(download_jsonl_entries, blob)) for blob in islice(blobs, 2 * max_workers))
+
+        while window:
+            blob, future = window.popleft()
+            for next_blob in islice(blobs, 1):
+                window.append((next_blob, executor.submit(download_jsonl_entries, next_blob)))
+
+            try:
+                yield from future.result()
+            except Exception as e:
+                res.logger.error(f"[GCS|F02]\t\t-> Error in '{blob.name}': {str(e)}")
+
+# F02B - Download e parsing di un singolo file JSONL
+def download_jsonl_entries(blob: storage.Blob) -> list[dict]:
+    lines = blob.download_as_text().strip().splitlines()
+    return [json.loads(line) for line in lines]
 
 
 # F03 - Upload JSONL files as one JSON
-def upload_json(bucket: storage.Bucket, path: str, data_gen):
-    blob = bucket.blob(path)
-    data = list(data_gen)
-    blob.upload_from_string(
-        json.dumps(data, indent=2),
-        content_type="application/json"
-    )
+#       Scrittura in streaming di un array JSON: gli elementi sono serializzati man mano che arrivano dal generatore e caricati
+#       a chunk (upload resumable), quindi la memoria resta limitata ai batch in lettura invece che all'intero risultato
+#       L'array è scritto su un oggetto temporaneo e pubblicato su 'path' solo se il generatore termina senza errori
+def upload_json(bucket: storage.Bucket, path: str, data_gen, indent: int = None):
+    writer = StagedUpload(bucket, path, mode="w", content_type="application/json")
+    separators = (",", ":") if indent is None else (",", ": ")
+    prefix = "\n" + " " * indent if indent is not None else ""
+
+    try:
+        writer.write("[")
+        n_items = 0
+        for item in data_gen:
+            text = json.dumps(item, indent=indent, separators=separators)
+            if indent is not None:
+                text = text.replace("\n", prefix)  # rientro degli elementi annidati rispetto all'array
+
+            writer.write(("," if n_items else "") + prefix + text)
+            n_items += 1
+
+        writer.write(("\n" if indent is not None and n_items else "") + "]")
+
+    except BaseException:
+        writer.abort()  # un array parziale non sostituisce il file dei risultati già presente
+        raise
 
+    writer.commit()
+    res.logger.info(f"[GCS|F03]\t\t-> Streamed {n_items} items into '{path}'")
 
-# F04 - Aggiorna il file CSV aggiungendo in append i nuovi dati
-def update_csv(bucket: storage.Bucket, path: str, data_gen):  
-    blob = bucket.blob(path)
+
+# F04 - Aggiorna il file CSV aggiungendo in append i nuovi dati. Se le colonne dei nuovi dati differiscono dall'header esistente
+#       (es: nuove metriche), il file è riscritto con l'unione delle colonne e le righe precedenti completate con valori vuoti;
+#       un file senza header riconoscibile (righe di dati già alla prima riga) non è modificato: i dati vanno in un nuovo file versionato
+def update_csv(bucket: storage.Bucket, path: str, data_gen):
     data = list(data_gen)
 
     if not data:
         res.logger.info(f"[GCS|F04]\t\t-> No data to append for '{path}'")
         return
 
-    output_io = io.StringIO()
-    writer = csv.DictWriter(output_io, fieldnames=data[0].keys())
-
+    fieldnames = list(dict.fromkeys(key for row in data for key in row))
+    existing = ""
     try:
-        if blob.exists():
-            output_io.write(blob.download_as_text())    # scrittura di dati pre-esistenti
+        blob = bucket.get_blob(path)
+        if blob is not None:
+            existing = blob.download_as_text()
     except Exception as e:
         res.logger.warning(f"[GCS|F04]\t\t-> Failed to read existing CSV ({type(e).__name__}): {str(e)}")
 
-    for row in data:
-        writer.writerow(row)    # scrittura di nuovi dati
+    header = next(csv.reader(io.StringIO(existing)), None) if existing.strip() else None
+    output_io = io.StringIO()
+
+    if header is not None and not set(header) & set(fieldnames):
+        root, ext = posixpath.splitext(path)
+        path = f"{root}_v{hashlib.md5(','.join(fieldnames).encode()).hexdigest()[:8]}{ext}"
+        res.logger.warning(f"[GCS|F04]\t\t-> Existing CSV has no matching header: writing rows to '{path}'")
+        return update_csv(bucket, path, data)
 
-    blob.upload_from_string(output_io.getvalue(), content_type="text/csv")
-    res.logger.info(f"[GCS|F04]\t\t-> Appended {len(data)} rows (no header) to '{path}'")
+    if header == fieldnames:
+        output_io.write(existing if existing.endswith("\n") else existing + "\n")    # stesse colonne: semplice append
+        writer = csv.DictWriter(output_io, fieldnames=fieldnames, restval="")
+    else:
+        columns = (header or []) + [name for name in fieldnames if name not in (header or [])]
+        writer = csv.DictWriter(output_io, fieldnames=columns, restval="")
+        writer.writeheader()
+        if header is not None:
+            writer.writerows(csv.DictReader(io.StringIO(existing)))     # righe precedenti, con le nuove colonne vuote
+
+    writer.writerows(data)
+
+    bucket.blob(path).upload_from_string(output_io.getvalue(), content_type="text/csv")
+    res.logger.info(f"[GCS|F04]\t\t-> Appended {len(data)} rows to '{path}'" + ("" if header == fieldnames else " (header rewritten)"))
+
+
+# F05 - Concatenazione lato server (compose) di più file in uno solo, senza scaricarli: GCS accetta al massimo 32 sorgenti per compose,
+#       quindi i file sono uniti ad albero (gruppi di 32 in file intermedi sotto 'tmp_prefix', poi eliminati).
+#       I file mancanti sono esclusi e segnalati (come in 'stream_jsonl_blobs'): una sola sorgente assente farebbe fallire l'intero compose
+def compose_blobs(bucket: storage.Bucket, blobs: list[storage.Blob], path: str, tmp_prefix: str, content_type: str = "application/json"):
+    sources = existing_blobs(bucket, blobs)
+    intermediates = []
+    level = 0
+
+    def compose_group(args):
+        k, group = args
+        target = bucket.blob(posixpath.join(tmp_prefix, f"level{level}_{k:05d}.jsonl"))
+        target.content_type = content_type
+        target.compose(group)
+        return target
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, res.merge_download_workers)) as executor:
+            while len(sources) > COMPOSE_MAX_SOURCES:
+                groups = [sources[i:i + COMPOSE_MAX_SOURCES] for i in range(0, len(sources), COMPOSE_MAX_SOURCES)]
+                sources = list(executor.map(compose_group, enumerate(groups)))  # compose di uno stesso livello in parallelo, ordine preservato
+                intermediates.extend(sources)
+                level += 1
+
+        target = bucket.blob(path)
+        target.content_type = content_type
+        if sources:
+            target.compose(sources)
+        else:
+            target.upload_from_string(b"", content_type=content_type)    # compose richiede almeno una sorgente
+        res.logger.info(f"[GCS|F05]\t\t-> Composed {len(sources)}/{len(blobs)} files into '{path}' ({level} intermediate levels)")
+
+    finally:
+        for blob in intermediates:
+            try:
+                blob.delete()
+            except Exception as e:
+                res.logger.warning(f"[GCS|F05]\t\t-> Failed to delete intermediate file '{blob.name}' ({type(e).__name__}): {str(e)}")
+
+
+# F05B - File effettivamente presenti tra quelli indicati (stesso ordine), con un unico listing del loro prefisso comune
+def existing_blobs(bucket: storage.Bucket, blobs: list[storage.Blob]) -> list[storage.Blob]:
+    blobs = list(blobs)
+    if not blobs:
+        return []
+
+    prefix = posixpath.commonprefix([blob.name for blob in blobs])
+    names = {blob.name for blob in bucket.list_blobs(prefix=prefix)}
+
+    for blob in blobs:
+        if blob.name not in names:
+            res.logger.error(f"[GCS|F05B]\t\t-> Missing file '{blob.name}', skipped")
+    return [blob for blob in blobs if blob.name in names]
+
+
+# C01 - Upload resumable a chunk su un oggetto temporaneo, pubblicato sul percorso finale solo a upload completato ('commit').
+#       Un writer abbandonato dopo un errore viene comunque finalizzato dal garbage collector ('io.IOBase.__del__' -> 'close()'):
+#       scrivendo sul percorso finale, un upload interrotto sovrascriverebbe il file valido con uno parziale
+class StagedUpload:
+    def __init__(self, bucket: storage.Bucket, path: str, mode: str = "wb", content_type: str = None):
+        self.path = path
+        self._bucket = bucket
+        self._tmp_blob = bucket.blob(f"{path}.tmp-{uuid.uuid4().hex[:8]}")
+        self._writer = self._tmp_blob.open(mode, chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type)
+
+    def write(self, data):
+        return self._writer.write(data)
+
+    # Finalizzazione dell'upload e copia lato server (rewrite, anche a più passi per oggetti grandi) sul percorso finale
+    def commit(self):
+        self._writer.close()
+
+        target = self._bucket.blob(self.path)
+        token, _, _ = target.rewrite(self._tmp_blob)
+        while token is not None:
+            token, _, _ = target.rewrite(self._tmp_blob, token=token)
+
+        self._tmp_blob.delete()
+
+    # Annullamento: l'oggetto temporaneo è finalizzato subito (non più tardi dal garbage collector, dopo la sua eliminazione) ed eliminato
+    def abort(self):
+        try:
+            self._writer.close()
+            self._tmp_blob.delete()
+        except Exception as e:  # l'errore originale resta quello da propagare
+            res.logger.warning(f"[GCS|C01]\t\t-> Failed to discard temporary upload of '{self.path}' ({type(e).__name__}): {str(e)}")
@@ -0,0 +1,134 @@
+import json, time, random, posixpath
+
+from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed, TooManyRequests
+from utils.resource_manager import resource_manager as res
+from utils.gcs_utils import get_run_dir, get_run_doc_path
+
+
+MAX_UPDATE_ATTEMPTS = 10    # tentativi di aggiornamento di un documento conteso da più invocazioni concorrenti
+
+STATE_COLLECTING = "collecting"     # batch ancora in arrivo
+STATE_MERGING = "merging"           # tutti i batch registrati: merge assegnato a una sola invocazione
+STATE_DONE = "done"                 # merge completato
+
+
+# F01 - Numero di shard del manifest di una run (i batch sono distribuiti per 'batch_id % n_shards' per ridurre la contesa sulle scritture):
+#       fissato dal server alla creazione della run (campo 'manifest_num_shards' del suo documento), così tutte le invocazioni concordano
+#       anche dopo un cambio di configurazione; dalla configurazione solo per i batch senza run ID
+def get_num_shards(metadata: dict) -> int:
+    return max(1, min(metadata["num_batches"], metadata.get("manifest_num_shards") or res.manifest_num_shards))
+
+
+# F02 - Numero di batch attesi in uno shard
+def expected_batches(num_batches: int, n_shards: int, shard: int) -> int:
+    return (num_batches - shard + n_shards - 1) // n_shards
+
+
+# F03 - Percorsi dei documenti del manifest (uno per shard più uno di riepilogo), nello spazio della run: ogni run ha un proprio lock di merge
+def shard_path(manifest_name: str, shard: int, run_id: str = None) -> str:
+    return posixpath.join(get_run_dir(res.gcs_manifest_dir, run_id), f"{manifest_name}_manifest_{shard:04d}.json")
+
+def manifest_path(manifest_name: str, run_id: str = None) -> str:
+    return posixpath.join(get_run_dir(res.gcs_manifest_dir, run_id), f"{manifest_name}_manifest.json")
+
+# F03B - Nome del manifest di un'analisi: il dataset per le run (già separate dal prefisso), altrimenti dataset e istante di avvio
+#        dell'analisi, così che una nuova analisi senza run ID non trovi il manifest 'done' della precedente (e il merge sia rieseguito)
+def manifest_name(dataset_name: str, metadata: dict, run_id: str = None) -> str:
+    started_at = metadata.get("analysis_started_at")
+    if run_id or started_at is None:
+        return dataset_name
+    return f"{dataset_name}_{int(started_at * 1000)}"
+
+
+# F04 - Download di un documento JSON con la sua generation (0 se non esiste)
+def download_doc(bucket: storage.Bucket, path: str) -> tuple[dict | None, int]:
+    blob = bucket.get_blob(path)
+    if blob is None:
+        return None, 0
+
+    try:
+        return json.loads(blob.download_as_text(if_generation_match=blob.generation)), blob.generation
+    except (NotFound, PreconditionFailed):
+        return download_doc(bucket, path)   # documento riscritto tra lettura dei metadati e download: nuovo tentativo
+
+
+# F05 - Aggiornamento atomico di un documento JSON (read-modify-write con precondizione sulla generation)
+#       'update_fn(doc)' riceve il documento corrente (None se assente) e restituisce quello nuovo, oppure None se non c'è nulla da scrivere
+def update_doc(bucket: storage.Bucket, path: str, update_fn) -> dict:
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        doc, generation = download_doc(bucket, path)
+        new_doc = update_fn(doc)
+        if new_doc is None:
+            return doc
+
+        try:
+            bucket.blob(path).upload_from_string(
+                json.dumps(new_doc, separators=(",", ":")),
+                content_type="application/json",
+                if_generation_match=generation  # 0 = crea solo se non esiste
+            )
+            return new_doc
+
+        except (PreconditionFailed, TooManyRequests):
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))   # scrittura concorrente di un'altra invocazione: backoff e nuovo tentativo
+
+    raise RuntimeError(f"Manifest '{path}' still contended after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+# F06 - Registrazione di un batch completato nel suo shard. Restituisce True se lo shard contiene tutti i batch attesi
+#       (operazione idempotente: eventi duplicati o batch rianalizzati non alterano il conteggio)
+def register_batch(bucket: storage.Bucket, name: str, batch_id: int, num_batches: int, n_shards: int, run_id: str = None) -> bool:
+    shard = batch_id % n_shards
+
+    def add_batch(doc):
+        doc = doc or {"shard": shard, "batches": []}
+        if batch_id in doc["batches"]:
+            return None
+        doc["batches"].append(batch_id)
+        return doc
+
+    doc = update_doc(bucket, shard_path(name, shard, run_id), add_batch)
+    return len(doc["batches"]) >= expected_batches(num_batches, n_shards, shard)
+
+
+# F07 - Registrazione di uno shard completo nel documento di riepilogo. Restituisce True se l'invocazione corrente ('owner') deve eseguire il merge:
+#       la transizione 'collecting' -> 'merging' avviene con una sola scrittura condizionata, quindi è vinta da una sola invocazione
+def register_shard(bucket: storage.Bucket, name: str, batch_id: int, num_batches: int, n_shards: int, owner: str, run_id: str = None) -> bool:
+    shard = batch_id % n_shards
+
+    def add_shard(doc):
+        doc = doc or {"num_batches": num_batches, "num_shards": n_shards, "completed_shards": [], "state": STATE_COLLECTING}
+        if shard in doc["completed_shards"]:
+            return None
+        doc["completed_shards"].append(shard)
+
+        if len(doc["completed_shards"]) >= n_shards and doc["state"] == STATE_COLLECTING:
+            doc["state"] = STATE_MERGING
+            doc["merge_owner"] = owner
+            doc["merge_started_at"] = time.time()
+        return doc
+
+    doc = update_doc(bucket, manifest_path(name, run_id), add_shard)
+    return doc["state"] == STATE_MERGING and doc.get("merge_owner") == owner   # stesso 'owner' anche quando l'evento viene riconsegnato dopo un errore
+
+
+# F08 - Chiusura del manifest al termine del merge
+def mark_done(bucket: storage.Bucket, name: str, run_id: str = None):
+    def set_done(doc):
+        doc["state"] = STATE_DONE
+        doc["merge_completed_at"] = time.time()
+        return doc
+
+    update_doc(bucket, manifest_path(name, run_id), set_done)
+
+
+# F09 - Aggiornamento del documento di stato di una run (letto dal server in '/runs/{run_id}')
+def update_run(bucket: storage.Bucket, run_id: str, **fields):
+    def set_fields(doc):
+        if doc is None:
+            return None     # run senza documento di stato (non creata dal server): nulla da aggiornare
+        doc.update(fields)
+        return doc
+
+    update_doc(bucket, get_run_doc_path(run_id), set_fields)
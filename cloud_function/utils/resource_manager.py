@@ -19,7 +19,13 @@ class ResourceManager:
         self._gcs_result_dir = "results"
         self._gcs_batch_metrics_dir = "batch_metrics"
         self._gcs_batch_result_dir = "batch_results"
-        self._merge_lock_flag_filename = "merge_lock.flag"
+        self._gcs_manifest_dir = "batch_manifests"
+        self._gcs_runs_dir = "runs"
+        self._manifest_num_shards = 16
+        self._merge_download_workers = 32
+        self._merge_mode = "compose"
+        self._merge_json_artifact = False
+        self._gcs_compose_tmp_dir = "compose_tmp"
         # (dove possibile, impostare come valori di default quelli locali al server Fast API)
         self.initialize()
 
@@ -41,7 +47,13 @@ class ResourceManager:
         self._gcs_result_dir = conf.get("gcs_result_dir", self._gcs_result_dir)
         self._gcs_batch_metrics_dir = conf.get("gcs_batch_metrics_dir", self._gcs_batch_metrics_dir)
         self._gcs_batch_result_dir = conf.get("gcs_batch_result_dir", self._gcs_batch_result_dir)
-        self._merge_lock_flag_filename = conf.get("merge_lock_flag_filename", self._merge_lock_flag_filename)
+        self._gcs_manifest_dir = conf.get("gcs_manifest_dir", self._gcs_manifest_dir)
+        self._gcs_runs_dir = conf.get("gcs_runs_dir", self._gcs_runs_dir)
+        self._manifest_num_shards = conf.get("manifest_num_shards", self._manifest_num_shards)
+        self._merge_download_workers = conf.get("merge_download_workers", self._merge_download_workers)
+        self._merge_mode = conf.get("merge_mode", self._merge_mode)
+        self._merge_json_artifact = conf.get("merge_json_artifact", self._merge_json_artifact)
+        self._gcs_compose_tmp_dir = conf.get("gcs_compose_tmp_dir", self._gcs_compose_tmp_dir)
 
         self._initialized = True
         self._logger.info("[RM|F02]\t-> Resource manager initialized")
@@ -76,8 +88,32 @@ class ResourceManager:
         return self._gcs_batch_result_dir
 
     @property
-    def merge_lock_flag_filename(self):
-        return self._merge_lock_flag_filename
+    def gcs_manifest_dir(self):
+        return self._gcs_manifest_dir
+
+    @property
+    def gcs_runs_dir(self):
+        return self._gcs_runs_dir
+
+    @property
+    def manifest_num_shards(self):
+        return self._manifest_num_shards
+
+    @property
+    def merge_download_workers(self):
+        return self._merge_download_workers
+
+    @property
+    def merge_mode(self):
+        return self._merge_mode
+
+    @property
+    def merge_json_artifact(self):
+        return self._merge_json_artifact
+
+    @property
+    def gcs_compose_tmp_dir(self):
+        return self._gcs_compose_tmp_dir
 
 
 # Istanza singletone da far importare agli altri moduli
@@ -2,9 +2,20 @@ import json, time, asyncio
 import pandas as pd
 import utils.gcs_utils as gcs
 import utils.metrics_utils as mtr
+import utils.vertexai_utils as vxc
 
 from utils.resource_manager import resource_manager as res
-from utils.cache_utils import alert_hash, cleanup_cache, download_cache, upload_cache
+from utils.cache_utils import alert_hash, result_cache, chat_cache
+from utils.canon_utils import get_rules
+from utils.context_utils import build_chat_context, estimate_tokens
+from utils.dedup_utils import group_by_key, chunked, inflight_registry
+from utils.concurrency_utils import AdaptiveLimiter, shared_limiter
+from utils.retry_utils import RetryBudget, get_retry_policy, create_retry_budget
+
+
+VALID_CLASSES = ("false_positive", "real_threat")
+MAX_OUTPUT_TOKENS_PER_ALERT = 512   # stesso limite della richiesta singola, moltiplicato per il numero di alert impacchettati
+MAX_OUTPUT_TOKENS = 8192            # limite massimo di token in output del modello
 
 
 # F01 - Costruzione prompt per richiesta Gemini
@@ -52,6 +63,33 @@ def build_prompt_optimized(alert) -> str:
     """
 
 
+# F01C - Costruzione prompt "impacchettato": più alert (ognuno con un indice locale) classificati con una sola richiesta Gemini
+def build_packed_prompt(alerts: list[dict]) -> str:
+    entries = "\n".join(
+        json.dumps({"idx": j, "alert": alert}, separators=(",", ":"), ensure_ascii=False, default=str)
+        for j, alert in enumerate(alerts)
+    )
+
+    return f"""
+Sei un assistente di sicurezza informatica. Ricevi {len(alerts)} alert da un sistema IDS, ognuno con un indice "idx".
+Per ciascun alert il tuo compito è:
+- Determinare se si tratta di un "false_positive" o di una "real_threat"
+- Spiegare in italiano, con linguaggio chiaro ma tecnico, il motivo della classificazione
+
+Esempio:
+ALERT:
+{{"idx":0,"alert":{{"time":1642213952,"name":"Wazuh: ClamAV database update","ip":"172.17.131.81","host":"mail","short":"W-Sys-Cav","time_label":"false_positive","event_label":"-"}}}}
+Risposta:
+[{{"idx":0,"class":"false_positive","explanation":"Aggiornamento del database ClamAV da host interno. Attività pianificata e legittima."}}]
+
+Ora analizza questi alert:
+ALERT:
+{entries}
+
+Rispondi con un solo array JSON contenente un oggetto {{ "idx": ..., "class": ..., "explanation": ... }} per ogni alert, nello stesso ordine.
+""".strip()
+
+
 # F02 - Interpretazione risposta Gemini & costruzione JSON da restituire
 def process_model_response(text: str, alert: dict, alert_id: int = 0) -> dict:
     text = text.strip()
@@ -79,62 +117,213 @@ def process_model_response(text: str, alert: dict, alert_id: int = 0) -> dict:
             "explanation": f"Output non valido: {text}"
         }
 
+# F02B - Interpretazione risposta Gemini a un prompt impacchettato: indice locale -> risultato (le entry mancanti o malformate sono omesse)
+def process_packed_response(text: str, alerts: list[dict], alert_ids: list[int]) -> dict[int, dict]:
+    text = text.strip()
+
+    if "[" in text and "]" in text:
+        text = text[text.find("["):text.rfind("]") + 1]  # pulizia testo Gemini
+
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError as e:
+        msg = text[:200].replace("\n", " ").replace("\"", "'")
+        res.logger.warning(f"[data|F02B]\t\t-> Failed to parse JSON array: {str(e)} | Response: {msg}")
+        return {}
+
+    results = {}
+    for item in parsed if isinstance(parsed, list) else []:
+        if not isinstance(item, dict):
+            continue
+
+        j = item.get("idx")
+        if not isinstance(j, int) or not 0 <= j < len(alerts) or j in results:
+            continue
+        if item.get("class") not in VALID_CLASSES or not item.get("explanation"):
+            continue
+
+        results[j] = {
+            "id": alert_ids[j],
+            "timestamp": alerts[j].get("time", res.not_available),
+            "class": item["class"],
+            "explanation": item["explanation"]
+        }
+
+    return results
+
 # F03 - Analisi asincrona i-esimo alert di batch
-async def analyze_batch_alert(i: int, alert: dict, semaphore) -> dict:
+async def analyze_batch_alert(i: int, alert: dict, limiter: AdaptiveLimiter, budget: RetryBudget) -> dict:
     prompt = build_prompt(alert)
+
+    async def request():
+        async with limiter.slot():  # timeout ed errori di quota attraversano lo slot, così che il limitatore possa ridurre la concorrenza
+            return await asyncio.wait_for(res.model_client.generate(prompt, res.gen_conf), timeout=60)
     
-    async with semaphore:
-        try:
-            response = await asyncio.wait_for(
-                asyncio.to_thread(res.model.generate_content, prompt, generation_config=res.gen_conf),
-                timeout=60
-            )
-            return process_model_response(response.text, alert, i)
-        
-        except asyncio.TimeoutError:
-            return {
-                "batch_id": i,
-                "timestamp": alert.get("time", res.not_available),
-                "class": "error",
-                "explanation": "Timeout: il modello ha impiegato troppo tempo per rispondere (impostare eventualmente un timeout maggiore)"
-            }
+    try:
+        text = await get_retry_policy().run(request, budget)    # errori transitori (timeout, 429, 5xx) ritentati con backoff
+        return process_model_response(text, alert, i)
     
-        except Exception as e:
-            return {
-                "batch_id": i,
-                "timestamp": alert.get("time", res.not_available),
-                "class": "error",
-                "explanation": f"{type(e).__name__}: {str(e)}"
-            }
+    except asyncio.TimeoutError:
+        return {
+            "id": i,
+            "timestamp": alert.get("time", res.not_available),
+            "class": "error",
+            "explanation": "Timeout: il modello ha impiegato troppo tempo per rispondere (impostare eventualmente un timeout maggiore)"
+        }
+
+    except Exception as e:
+        return {
+            "id": i,
+            "timestamp": alert.get("time", res.not_available),
+            "class": "error",
+            "explanation": f"{type(e).__name__}: {str(e)}"
+        }
+
+
+# F03B - Analisi asincrona di un pacchetto di alert con una sola richiesta (ritentando singolarmente gli alert mancanti o malformati)
+async def analyze_alert_pack(alert_ids: list[int], alerts: list[dict], limiter: AdaptiveLimiter, budget: RetryBudget) -> list[dict]:
+    if len(alerts) == 1:
+        return [await analyze_batch_alert(alert_ids[0], alerts[0], limiter, budget)]
+
+    prompt = build_packed_prompt(alerts)
+    gen_conf = vxc.get_generation_config(max_output_tokens=min(MAX_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS_PER_ALERT * len(alerts)))
+    parsed = {}
+
+    async def request():
+        async with limiter.slot():
+            return await asyncio.wait_for(res.model_client.generate(prompt, gen_conf), timeout=60)
+
+    try:
+        text = await get_retry_policy().run(request, budget)
+        parsed = process_packed_response(text, alerts, alert_ids)
+
+    except Exception as e:
+        res.logger.warning(f"[data|F03B]\t\t-> Packed request for {len(alerts)} alerts failed ({type(e).__name__}): {str(e)}")
+
+    # Fallback: richiesta singola per ogni alert senza risposta valida
+    missing = [j for j in range(len(alerts)) if j not in parsed]
+    if missing:
+        res.logger.info(f"[data|F03B]\t\t-> {len(missing)}/{len(alerts)} alerts missing from packed response, retrying one by one")
+        retried = await asyncio.gather(*(analyze_batch_alert(alert_ids[j], alerts[j], limiter, budget) for j in missing))
+        parsed.update(zip(missing, retried))
+
+    return [parsed[j] for j in range(len(alerts))]
 
 
-# F04 - Analisi asincrona di batch
-async def analyze_batch(batch_df: pd.DataFrame, batch_id: int, start_row: int, dataset_name: str) -> list[dict]:
+# F04 - Analisi asincrona di batch (con consultazione della cache dei risultati)
+async def analyze_batch(batch_df: pd.DataFrame, batch_id: int, start_row: int, dataset_name: str, run_id: str = None) -> list[dict]:
     res.logger.info(f"[data|F04]\t\t-> Processing batch {batch_id} containing {batch_df.shape[0]} alerts")
     timer_start, timestamp_start = mtr.init_monitoring()
 
     batch_size = len(batch_df)
-    concurrency = min(batch_size, res.max_concurrent_requests)   # in caso di pochi alert (es: 3) evito l'apertura di 16 thread (='max_concurrent_requests' attuale)
-    semaphore = asyncio.Semaphore(concurrency)
 
     try:
         # Trasformazione dei record del dataframe in lista di oggetti json
         alerts = batch_df.to_dict(orient='records') 
+        ids = [start_row + i for i in range(batch_size)]    # ID a partire da 0
 
-        # Parallelizzazione delle analisi sugli alert
-        tasks = [
-            analyze_batch_alert(start_row + i - 1, alert, semaphore)    # il -1 fa in modo che gli ID partano da 0
-            for i, alert in enumerate(alerts, start=1)
-        ]
+        # Chiavi canoniche degli alert (i campi volatili, es: 'time', sono ignorati secondo le regole del dataset in 'config.json')
+        rules = get_rules(dataset_name)
+        keys = [alert_hash(alert, rules) for alert in alerts]
+
+        # Consultazione cache (LRU locale, poi shard GCS): gli alert già classificati non generano richieste a Gemini
+        cached = await result_cache.lookup(set(keys)) if res.cache_enabled else {}
+
+        results = [None] * batch_size
+        pending = []    # posizioni degli alert non presenti in cache
+
+        for k, alert in enumerate(alerts):
+            entry = cached.get(keys[k])
+            if entry is not None:
+                results[k] = build_result(ids[k], alert, entry)
+            else:
+                pending.append(k)
+
+        # Deduplicazione: gli alert equivalenti (stessa chiave canonica) generano una sola richiesta, con un alert rappresentativo per gruppo
+        groups = group_by_key(keys, pending)
+
+        # Prenotazione delle chiavi: i gruppi già in analisi in un altro batch dello stesso worker attendono quella richiesta
+        claims = {key: inflight_registry.claim(key) for key in groups}
+        owned = [key for key, (_, owner) in claims.items() if owner]
+
+        try:
+            # Impacchettamento dei gruppi posseduti: 'prompt_pack_size' alert per richiesta (1 = un prompt per alert)
+            packs = chunked(owned, res.prompt_pack_size)
+
+            # Limite alle richieste in volo: adattivo (AIMD) e condiviso tra i batch del worker, oppure fisso e locale al batch
+            if res.adaptive_concurrency:
+                limiter = shared_limiter
+            else:
+                concurrency = max(1, min(len(packs), res.max_concurrent_requests))    # in caso di pochi alert (es: 3) evito l'apertura di 16 slot (='max_concurrent_requests' attuale)
+                limiter = AdaptiveLimiter(concurrency, concurrency, concurrency, res.target_latency)   # min = max: nessun adattamento
+
+            queue_peak = limiter.track_queue_peak()
+
+            # Budget di retry del batch (gli errori transitori non possono moltiplicare il numero di richieste oltre 'retry_budget_ratio')
+            budget = create_retry_budget(len(owned))
+
+            async def analyze_pack(pack_keys: list[str]):
+                try:
+                    pack_results = await analyze_alert_pack(
+                        [ids[groups[key][0]] for key in pack_keys],
+                        [alerts[groups[key][0]] for key in pack_keys],
+                        limiter,
+                        budget
+                    )
+                except BaseException as e:
+                    for key in pack_keys:
+                        inflight_registry.fail(key, e)  # sblocco degli eventuali batch in attesa di queste chiavi
+                    raise
+
+                for key, result in zip(pack_keys, pack_results):
+                    inflight_registry.resolve(key, result)
+
+            # Parallelizzazione delle analisi (tutti i pacchetti terminano, risolvendo o liberando le proprie chiavi, prima di un eventuale errore)
+            outcomes = await asyncio.gather(*(analyze_pack(pack) for pack in packs), return_exceptions=True)
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
+
+        except BaseException as e:
+            # Chiavi possedute non ancora risolte (errore prima o durante le richieste): i batch in attesa ricevono l'eccezione invece di
+            # restare bloccati per sempre. Una future ancora in sospeso è sicuramente registrata sotto la propria chiave
+            for key in owned:
+                if not claims[key][0].done():
+                    inflight_registry.fail(key, e)
+            raise
+
+        group_results = {key: await inflight_registry.wait(future) for key, (future, _) in claims.items()}
+
+        # Propagazione del risultato di ogni gruppo a tutti i suoi alert (ognuno con il proprio ID e timestamp)
+        for key, positions in groups.items():
+            for k in positions:
+                results[k] = build_result(ids[k], alerts[k], group_results[key])
+
+        # Salvataggio in cache dei nuovi risultati (le classificazioni fallite e quelle condivise, già salvate dal batch che le ha richieste, sono escluse)
+        if res.cache_enabled:
+            await result_cache.store({
+                key: group_results[key]
+                for key in owned
+                if group_results[key].get("class") != "error"
+            })
 
-        results = await asyncio.gather(*tasks)  # unione dei risultati dei singoli task: creazione file result del batch
-        
         # Metriche
-        metrics = mtr.finalize_monitoring(timer_start, timestamp_start, batch_id, batch_size, concurrency)
-        metrics_path = gcs.get_blob_path(res.gcs_batch_metrics_dir, dataset_name, f"metrics_{batch_id}", "jsonl")
-        await gcs.upload_as_jsonl(metrics_path, [metrics]) # NB: passare le metriche dentro una lista
+        batch_stats = {
+            "cache_hits": batch_size - len(pending),
+            "cache_misses": len(pending) if res.cache_enabled else 0,
+            "n_unique_prompts": len(owned),                     # alert distinti effettivamente inviati a Gemini
+            "n_dedup_in_batch": len(pending) - len(groups),     # alert risolti da un alert equivalente dello stesso batch
+            "n_dedup_cross_batch": len(groups) - len(owned),    # gruppi risolti da una richiesta già in corso in un altro batch
+            "prompt_pack_size": res.prompt_pack_size,
+            "n_model_requests": len(packs)                      # richieste a Gemini (senza contare i fallback singoli)
+        }
+        batch_stats.update(limiter.snapshot(queue_peak))  # limite di concorrenza corrente e profondità della coda delle richieste in attesa
+        metrics = mtr.finalize_monitoring(timer_start, timestamp_start, batch_id, batch_size, limiter.limit, batch_stats)
+        metrics = mtr.update_metrics(results, batch_size, metrics, budget.stats())     # errori di classificazione e retry
+        metrics_path = gcs.get_blob_path(gcs.get_run_dir(res.gcs_batch_metrics_dir, run_id), dataset_name, f"metrics_{batch_id}", "jsonl")
+        await gcs.upload_as_jsonl(metrics_path, [metrics]) # NB: passare le metriche dentro una lista (caricate una sola volta, già complete)
         
-        res.logger.info(f"[data|F04]\t\t-> Batch {batch_id}, time elapsed: {metrics['time_sec']}s")
+        res.logger.info(f"[data|F04]\t\t-> Batch {batch_id}, time elapsed: {metrics['time_sec']}s, cache hits: {batch_stats['cache_hits']}/{batch_size}, prompts sent: {batch_stats['n_unique_prompts']} in {len(packs)} requests, concurrency limit: {limiter.limit}")
 
         return results
 
@@ -142,82 +331,100 @@ async def analyze_batch(batch_df: pd.DataFrame, batch_id: int, start_row: int, d
         res.logger.error(f"[data|F04]\t\t-> Error in batch {batch_id} ({type(e).__name__}): {str(e)}")
         raise
 
-# F04B - Analisi asincrona di batch con gestione cache (OUTDATED!)
-async def analyze_batch_cached(batch_df: pd.DataFrame, batch_id: int, start_row: int, dataset_name: str) -> list[dict]:
-    res.logger.info(f"[data|F04B]\t\t-> Processing batch {batch_id} containing {batch_df.shape[0]} alerts")
-    start = mtr.init_monitoring()
+# F04B - Costruzione del risultato di un alert a partire da un'entry di cache o dal risultato di un alert equivalente
+def build_result(alert_id: int, alert: dict, entry: dict) -> dict:
+    return {
+        "id": alert_id,
+        "timestamp": alert.get("time", res.not_available),
+        "class": entry["class"],
+        "explanation": entry["explanation"]
+    }
 
-    concurrency = min(len(batch_df), res.max_concurrent_requests)   # in caso di pochi alert (es: 3) evito l'apertura di 16 thread (='max_concurrent_requests' attuale)
-    semaphore = asyncio.Semaphore(concurrency)
 
-    try:
-        # Estrazione lista nomi file cache (le graffe trasformano la lista in un set)
-        existing_cache_hashes = {
-            blob.name.split("/")[-1].replace(".json", "")  # es: "cache/H123.json" -> "H123"
-            for blob in res.bucket.list_blobs(prefix=res.gcs_cache_dir + "/")
-        }
-
-        # Pulizia cache
-        if len(existing_cache_hashes) > 1000:   # TODO: decidere quale soglia usare
-            cleanup_cache()
-        
-        ### START - Funzione da parallelizzare (classificazione alert, gestione cache inclusa)
-        async def process_alert(i, alert) -> dict:
-            h = alert_hash(alert)
 
-            if h in existing_cache_hashes:
-                result = download_cache(h)
-            else:
-                result = await analyze_batch_alert(i, alert, semaphore)
+# F05 - Analisi quesito utente per l'endpoint '/chat' (risposta e statistiche del prompt: dimensione e latenza).
+#       Una domanda equivalente già posta sulla stessa selezione di alert è servita dalla cache delle risposte
+async def analyze_chat_question(question: str, alerts: list[dict] | dict) -> dict:
+    try:
+        started_at = time.perf_counter()
+        cache_key = chat_cache.key(question, alerts)
 
-                # Salvataggio cache
-                upload_cache(h, {
-                    "last_modified": time.time(),
-                    "class": result.get("class", "error"),
-                    "explanation": result.get("explanation", "error")
-                })
+        cached = chat_cache.get(cache_key)
+        if cached is not None:
+            return {"explanation": cached["explanation"], "stats": cached_chat_stats(cached, started_at)}
 
-            result["id"] = i
-            return result
-        ### END
+        prompt, stats = build_chat_prompt(question, alerts)
+        explanation = await res.model_client.generate(prompt, res.gen_conf)
 
-        # Trasformazione dei record del dataframe in lista di oggetti json
-        alerts = batch_df.to_dict(orient='records')
+        stats["latency_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+        stats["cached"] = False
+        chat_cache.put(cache_key, {"explanation": explanation, "stats": dict(stats)})
 
-        # Parallelizzazione delle analisi sugli alert
-        tasks = [
-            process_alert(start_row + i, alert)
-            for i, alert in enumerate(alerts, start=1)
-        ]
-    
-        results = await asyncio.gather(*tasks)  # unione dei risultati dei singoli task: creazione file result del batch
-        # Metriche
-        metrics = mtr.finalize_monitoring(start, batch_id, len(batch_df))
-        metrics_path = f"{res.gcs_batch_metrics_dir}/{dataset_name}_batch_{batch_id}.jsonl"
-        await gcs.upload_as_jsonl(metrics_path, [metrics]) # NB: passare le metriche dentro una lista
-        
-        res.logger.info(f"[data|F04B]\t\t-> Batch {batch_id}, Time elapsed: {metrics['time_sec']}s, RAM usage: {metrics['ram_mb']}MB")
-        
-        return results
+        res.logger.info(f"[data|F05]\t\t-> Chat answer: {format_chat_stats(stats)}")
+        return {"explanation": explanation, "stats": stats}
 
     except Exception as e:
-        res.logger.error(f"[data|F04B]\t\t-> Error in batch {batch_id} ({type(e).__name__}): {str(e)}")
+        res.logger.error(f"[data|F05]\t\t-> Failed to generate a response ({type(e).__name__}): {str(e)}")
         raise
 
 
+# F05B - Creazione del prompt per un quesito utente dell'endpoint '/chat': contesto degli alert compresso entro il budget di token
+#        (riepilogo, duplicati raggruppati, JSON compatto). Restituisce il prompt e le statistiche del contesto
+def build_chat_prompt(question: str, alerts: list[dict] | dict) -> tuple[str, dict]:
+    context, stats = build_chat_context(alerts)
+    prompt = (
+        f"Domanda: {question}\n\n"
+        f"Alert selezionati:\n{context}\n\n"
+        "Fornisci una risposta testuale, tenendo conto sia della domanda che del contesto degli alert."
+    )
+
+    stats.update(prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt), budget=res.chat_context_budget)
+    return prompt, stats
+
+
+# F05C - Analisi in streaming di un quesito utente: frammenti della risposta man mano che il modello li genera
+#        ('stats', se indicato, è completato con le statistiche del prompt e le latenze del primo frammento e della risposta)
+async def stream_chat_answer(question: str, alerts: list[dict] | dict, stats: dict = None):
+    started_at = time.perf_counter()
+    stats = {} if stats is None else stats
 
-# F05 - Analisi quesito utente per l'endpoint '/chat'
-def analyze_chat_question(question: str, alerts: list[dict] | dict):
     try:
-        alerts_str = alerts if isinstance(alerts, str) else json.dumps(alerts, indent=2, ensure_ascii=False)
-        full_prompt = (
-            f"Domanda: {question}\n\n"
-            f"Alert selezionati:\n{alerts_str}\n\n"
-            "Fornisci una risposta testuale, tenendo conto sia della domanda che del contesto degli alert."
-        )
+        cache_key = chat_cache.key(question, alerts)
+
+        cached = chat_cache.get(cache_key)
+        if cached is not None:    # risposta in cache: un unico frammento
+            stats.update(cached_chat_stats(cached, started_at))
+            yield cached["explanation"]
+            return
+
+        prompt, prompt_stats = build_chat_prompt(question, alerts)
+        stats.update(prompt_stats)
+
+        chunks = []
+        async for text in res.model_client.stream(prompt, res.gen_conf):
+            if "first_token_ms" not in stats:
+                stats["first_token_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+            chunks.append(text)
+            yield text
+
+        stats["latency_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+        stats["cached"] = False
+        chat_cache.put(cache_key, {"explanation": "".join(chunks), "stats": dict(stats)})   # solo risposte complete
 
-        return res.model.generate_content(full_prompt, generation_config=res.gen_conf).text
+        res.logger.info(f"[data|F05C]\t\t-> Chat answer streamed: {format_chat_stats(stats)}")
 
     except Exception as e:
-        res.logger.error(f"[data|F05]\t\t-> Failed to generate a response ({type(e).__name__}): {str(e)}")
+        res.logger.error(f"[data|F05C]\t\t-> Failed to stream a response ({type(e).__name__}): {str(e)}")
         raise
+
+
+# F05D - Statistiche di una risposta '/chat' servita dalla cache: quelle del prompt originale, con la latenza effettiva
+def cached_chat_stats(cached: dict, started_at: float) -> dict:
+    stats = {**cached["stats"], "cached": True, "latency_ms": round((time.perf_counter() - started_at) * 1000, 1)}
+    stats.pop("first_token_ms", None)
+    return stats
+
+
+# F05E - Statistiche di una risposta '/chat' in formato leggibile (log)
+def format_chat_stats(stats: dict) -> str:
+    return ", ".join(f"{k}={v}" for k, v in stats.items())
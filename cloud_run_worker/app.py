@@ -1,19 +1,24 @@
 # CRW: Cloud Run Worker
 
-import asyncio
+import json, asyncio
 import utils.gcs_utils as gcs
-import utils.metrics_utils as mtr
+import utils.progress_utils as prg
 
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from concurrent.futures import ThreadPoolExecutor
 from utils.resource_manager import resource_manager as res
-from analyze_data import analyze_chat_question, analyze_batch, analyze_batch_cached
+from analyze_data import analyze_chat_question, stream_chat_answer, analyze_batch
+from utils.cache_utils import result_cache, chat_cache
+from utils.concurrency_utils import reload_shared_limiter
 
 
 app = FastAPI()
 
 executor = ThreadPoolExecutor(max_workers=16)
 asyncio.get_event_loop().set_default_executor(executor) # aumento del limite massimo di thread concorrenti di asyncio
+# NB: i thread servono ormai solo all'I/O su GCS: le richieste a Gemini usano l'API asincrona del client del modello ('res.model_client'),
+#     quindi il numero di richieste in volo è limitato dal limitatore di concorrenza ('utils/concurrency_utils.py') e non dal numero di thread
 
 
 # E01 - Ricezione di richieste anomale dirette alla root del worker
@@ -32,6 +37,9 @@ async def health():
 @app.get("/reload-config")
 async def reload_config():
     res.reload_config()
+    result_cache.reload_config()
+    chat_cache.reload_config()
+    reload_shared_limiter()
     return {"message": "Resource manager reloaded"}
 
 
@@ -51,28 +59,29 @@ async def run_batch(request: Request):
             raise HTTPException(status_code=500, detail=msg)
 
         batch_id, start_row, end_row, batch_size, dataset_name, dataset_path = (body[field] for field in required_fields)
+        index_path = body.get("index_path")     # opzionale: assente per dataset caricati prima dell'introduzione dell'indice
+        run_id = body.get("run_id")             # opzionale: senza run ID i file sono scritti nelle cartelle condivise (task accodati prima dei run ID)
 
         # Download e suddivisione del dataset
-        batch_df = gcs.load_batch(dataset_path, start_row, end_row, batch_size)
+        batch_df = gcs.load_batch(dataset_path, start_row, end_row, batch_size, index_path)
 
         # Classificazione alert del batch
-        batch_results = await analyze_batch(batch_df, batch_id, start_row, dataset_name)
-        #batch_result_list = await analyze_batch_cached(batch_df, batch_id, start_row, dataset_name)
+        batch_results = await analyze_batch(batch_df, batch_id, start_row, dataset_name, run_id)
         
         # Salvataggio risultati su GCS
-        batch_results_path = gcs.get_blob_path(res.gcs_batch_result_dir, dataset_name, f"result_{batch_id}", "jsonl")
+        batch_results_path = gcs.get_blob_path(gcs.get_run_dir(res.gcs_batch_result_dir, run_id), dataset_name, f"result_{batch_id}", "jsonl")
         await gcs.upload_as_jsonl(batch_results_path, batch_results)    # 'batch_results' è una lista di oggetti JSON
 
-        # Calcolo numero errori di classificazione e aggiornamento metriche
-        batch_metrics_path = gcs.get_blob_path(res.gcs_batch_metrics_dir, dataset_name, f"metrics_{batch_id}", "jsonl")
-        updated_metrics = mtr.update_metrics(batch_results, len(batch_df), batch_metrics_path)
-        await gcs.upload_as_jsonl(batch_metrics_path, updated_metrics)
+        # Aggiornamento del documento di avanzamento letto da '/batch-results-status' del server
+        if body.get("num_batches"):
+            await prg.record_batch(dataset_name, batch_id, body["num_batches"], batch_results, run_id, body.get("progress_num_shards"))
 
         res.logger.info(f"[app|E04]\t\t-> Parallel analysis completed: batch result file uploaded into '{batch_results_path}'")
 
         return {
             "status": "completed",
             "batch_id": batch_id,
+            "run_id": run_id,
             "batch_path": batch_results_path
         }
     
@@ -82,9 +91,10 @@ async def run_batch(request: Request):
         return {"detail": msg}
     
 
-# E05 - Ricezione richieste d'analisi di un solo alert (da '/chat' di server)
+# E05 - Ricezione richieste d'analisi di un solo alert (da '/chat' di server). Con 'stream=true' la risposta è un flusso SSE:
+#       eventi 'token' ({"text"}) man mano che il modello genera, poi 'done' ({"explanation", "stats"}) oppure 'error' ({"detail"})
 @app.post("/run-chatbot")
-async def run_alert(req: Request):
+async def run_alert(req: Request, stream: bool = False):
     data = await req.json()
     question = data["question"]
     alerts = data["alerts"]
@@ -94,6 +104,26 @@ async def run_alert(req: Request):
         res.logger.error(msg)
         raise HTTPException(status_code=400, detail=msg)
 
-    return {
-        "explanation": analyze_chat_question(question, alerts)
-    }
+    if not stream:
+        return await analyze_chat_question(question, alerts)   # explanation, stats
+
+    def format_event(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), ensure_ascii=False)}\n\n"
+
+    async def event_stream():
+        chunks, stats = [], {}
+        try:
+            async for text in stream_chat_answer(question, alerts, stats):
+                chunks.append(text)
+                yield format_event("token", {"text": text})
+            yield format_event("done", {"explanation": "".join(chunks), "stats": stats})
+        except Exception as e:   # risposta già avviata (status 200): l'errore viaggia come evento del flusso
+            yield format_event("error", {"detail": f"{type(e).__name__}: {str(e)}"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# E06 - Statistiche della cache delle risposte '/chat' di questa istanza del worker (dimensione, hit, miss e hit rate)
+@app.get("/chat-cache-stats")
+async def chat_cache_stats():
+    return chat_cache.stats()
@@ -0,0 +1,36 @@
+# Test del contesto '/chat' (utils/context_utils.py) con righe nel formato inviato dalla dashboard ('selectedAlerts' di Chatbot.js)
+
+from utils.context_utils import build_chat_context, group_alerts
+from utils.cache_utils import ChatCache
+
+
+def dashboard_rows(n: int) -> list[dict]:
+    return [
+        {"id": i, "timestamp": f"2025-01-01T00:00:{i:02d}", "class": "false_positive", "explanation": f"Spiegazione {i}"}
+        for i in range(n)
+    ]
+
+
+def test_dashboard_rows_are_not_merged():
+    context, stats = build_chat_context(dashboard_rows(5))
+
+    assert stats["n_alerts"] == 5
+    assert stats["n_groups"] == 5
+    assert stats["n_included"] == 5
+    assert all(f"Spiegazione {i}" in context for i in range(5))
+
+
+def test_only_exact_duplicates_are_grouped():
+    rows = dashboard_rows(2)
+    rows.append({**rows[0], "id": 99})  # stesso contenuto della prima riga, ID diverso
+
+    groups = group_alerts(rows)
+
+    assert [group["count"] for group in groups] == [2, 1]
+    assert groups[0]["ids"] == [0, 99]
+
+def test_chat_cache_key_depends_on_selection_content():
+    rows = dashboard_rows(4)
+
+    assert ChatCache().key("why?", rows[:2]) != ChatCache().key("why?", rows[2:4])
+    assert ChatCache().key("Why? ", rows[:2]) == ChatCache().key("why", rows[1::-1])
@@ -0,0 +1,73 @@
+# Test dell'aggiornamento condizionato dei documenti JSON su GCS (utils/gcs_utils.py, F05) e del suo uso negli shard di avanzamento
+
+import json
+import pytest
+
+import utils.gcs_utils as gcs
+from utils.progress_utils import update_shard, shard_path
+
+PATH = "docs/doc.json"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(gcs.time, "sleep", lambda seconds: None)
+
+
+def read(bucket, path: str = PATH) -> dict:
+    return json.loads(bucket.objects[path][0])
+
+
+def increment(doc):
+    doc = doc or {"n": 0}
+    return {**doc, "n": doc["n"] + 1}
+
+
+def test_creates_then_updates_document(bucket):
+    gcs.update_json(PATH, increment)
+    gcs.update_json(PATH, increment)
+
+    assert read(bucket) == {"n": 2}
+
+
+def test_no_write_when_nothing_changes(bucket):
+    gcs.update_json(PATH, increment)
+    generation = bucket.objects[PATH][1]
+
+    assert gcs.update_json(PATH, lambda doc: None) == {"n": 1}
+    assert bucket.objects[PATH][1] == generation
+
+
+def test_concurrent_write_is_retried_on_the_new_generation(bucket):
+    gcs.update_json(PATH, increment)
+    calls = []
+
+    def increment_with_race(doc):
+        calls.append(doc)
+        if len(calls) == 1:
+            bucket.blob(PATH).upload_from_string(json.dumps({"n": 10}))   # scrittura di un altro worker tra lettura e scrittura
+        return increment(doc)
+
+    gcs.update_json(PATH, increment_with_race)
+
+    assert [doc["n"] for doc in calls] == [1, 10]
+    assert read(bucket) == {"n": 11}    # nessun aggiornamento perso
+
+
+def test_gives_up_after_max_attempts(bucket):
+    def always_raced(doc):
+        bucket.blob(PATH).upload_from_string(json.dumps({"n": -1}))
+        return increment(doc)
+
+    with pytest.raises(RuntimeError):
+        gcs.update_json(PATH, always_raced, max_attempts=3)
+
+
+def test_progress_shard_counts_each_batch_once(bucket):
+    for batch_id in (0, 2, 2, 4):   # batch 2 rieseguito da Cloud Tasks
+        update_shard("D", batch_id, 6, {"n_alerts": 5}, run_id="r1", n_shards=2)
+
+    doc = read(bucket, shard_path("D", 0, 6, "r1", 2)[0])
+
+    assert doc["n_completed"] == 3
+    assert doc["n_alerts"] == 15
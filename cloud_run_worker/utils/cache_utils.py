@@ -1,40 +1,220 @@
-import json, time, hashlib
+import re, json, time, asyncio, hashlib, unicodedata
+
+from collections import OrderedDict
 from utils.resource_manager import resource_manager as res
+from utils.canon_utils import canonicalize, is_missing
+from utils.gcs_utils import download_json, update_json
+
+
+MAX_WRITE_ATTEMPTS = 5  # tentativi di scrittura di uno shard in caso di conflitto (aggiornamento concorrente da parte di un altro worker)
+
+
+# F01 - Compute hash from alert (sulla sua forma canonica: i campi volatili indicati dalle regole non influenzano la chiave)
+def alert_hash(alert: dict, rules: dict = None) -> str:
+    raw = json.dumps(canonicalize(alert, rules or {}), sort_keys=True, default=str)
+    return hashlib.md5(raw.encode()).hexdigest()
 
 
-# Compute hash from alert
-def alert_hash(alert: dict) -> str:
-    raw = json.dumps(alert, sort_keys=True)
+# F02 - Hash del contenuto esatto di un alert (tutti i campi, esclusi quelli indicati; valori mancanti ignorati)
+def content_hash(alert: dict, exclude: tuple = ()) -> str:
+    content = {k: v for k, v in alert.items() if k not in exclude and not is_missing(v)}
+    raw = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
     return hashlib.md5(raw.encode()).hexdigest()
 
 
-# Pulizia cache meno recente
-def cleanup_cache():
-    blobs = res.bucket.list_blobs(prefix=f"{res.gcs_cache_dir}/")
-    now = time.time()
-    
-    deleted = 0
-    for blob in blobs:
-        try:
-            data = json.loads(blob.download_as_text())
-            last_mod = data.get("last_modified", 0)
+# C01 - Cache LRU in memoria, con numero massimo di entry e scadenza (TTL) basata sull'istante di creazione dell'entry
+class LRUCache:
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data = OrderedDict()  # chiave -> (timestamp, valore), dalla meno alla più recentemente usata
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        ts, value = item
+        if time.time() - ts > self._ttl:
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value, ts: float = None):
+        self._data[key] = (ts if ts is not None else time.time(), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)  # eviction dell'entry usata meno di recente
+
+    def resize(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# C02 - Cache dei risultati di classificazione su due livelli: LRU locale al worker + shard JSON su GCS (molti hash per oggetto)
+class ResultCache:
+    def __init__(self):
+        self._lru = LRUCache(res.cache_lru_size, res.max_cache_age)
+        self._shard_loaded_at = {}  # shard -> istante dell'ultimo download (le sue entry valide sono già state copiate nella LRU)
+
+    # Path dello shard GCS che contiene l'hash
+    def shard_path(self, h: str) -> str:
+        return f"{res.gcs_cache_dir}/shard_{int(h[:8], 16) % res.cache_num_shards:04d}.json"
+
+    # Allineamento dei limiti della LRU alla configurazione corrente (dopo '/reload-config')
+    def reload_config(self):
+        self._lru.resize(res.cache_lru_size, res.max_cache_age)
+
+    # Ricerca di più hash: prima nella LRU, poi (per i soli mancanti) negli shard GCS, scaricati in parallelo una sola volta ciascuno
+    async def lookup(self, hashes: set[str]) -> dict[str, dict]:
+        found = {}
+        missing_by_shard = {}
+        now = time.time()
+
+        for h in hashes:
+            entry = self._lru.get(h)
+            if entry is not None:
+                found[h] = entry
+                continue
+
+            path = self.shard_path(h)
+            if now - self._shard_loaded_at.get(path, 0) < res.cache_shard_refresh:
+                continue    # shard scaricato di recente: l'hash non era presente (o è stato rimosso dalla LRU), niente nuova richiesta
+            missing_by_shard.setdefault(path, []).append(h)
+
+        if missing_by_shard:
+            shards = await asyncio.gather(*(
+                asyncio.to_thread(download_json, path)
+                for path in missing_by_shard
+            ))
+
+            for path, (entries, _) in zip(missing_by_shard, shards):
+                entries = entries or {}     # shard non ancora creato
+                self._load_shard(path, entries)
+
+                for h in missing_by_shard[path]:
+                    entry = entries.get(h)  # letto dallo shard e non dalla LRU, che potrebbe averlo già rimosso (shard più grande della LRU)
+                    if entry is not None and now - entry.get("last_modified", 0) <= res.max_cache_age:
+                        found[h] = entry
+                        self._lru.put(h, entry, entry["last_modified"])
+
+        return found
+
+    # Salvataggio di nuovi risultati: LRU immediata, shard GCS aggiornati in parallelo (read-modify-write con precondizione sulla generation)
+    async def store(self, entries: dict[str, dict]):
+        if not entries:
+            return
+
+        now = time.time()
+        by_shard = {}
+
+        for h, entry in entries.items():
+            value = {"class": entry["class"], "explanation": entry["explanation"], "last_modified": now}
+            self._lru.put(h, value, now)
+            by_shard.setdefault(self.shard_path(h), {})[h] = value
+
+        outcomes = await asyncio.gather(
+            *(asyncio.to_thread(self._update_shard, path, new_entries) for path, new_entries in by_shard.items()),
+            return_exceptions=True
+        )
+
+        for path, outcome in zip(by_shard, outcomes):
+            if isinstance(outcome, Exception):
+                res.logger.warning(f"[cache|C02]\t\t-> Failed to update '{path}' ({type(outcome).__name__}): {str(outcome)}")
+            else:
+                self._load_shard(path, outcome)     # NB: la LRU viene modificata solo dall'event loop, mai dai thread di I/O
+
+
+    # Copia nella LRU delle entry non scadute di uno shard appena scaricato
+    def _load_shard(self, path: str, entries: dict):
+        now = time.time()
+        for h, value in entries.items():
+            ts = value.get("last_modified", 0)
+            if now - ts <= res.max_cache_age:
+                self._lru.put(h, value, ts)
+
+        self._shard_loaded_at[path] = now
+
+    # Aggiornamento atomico di uno shard: unione delle nuove entry, rimozione di quelle scadute (TTL) e scrittura condizionata
+    def _update_shard(self, path: str, new_entries: dict) -> dict:
+        def merge_entries(entries):
+            now = time.time()
+            entries = {h: v for h, v in (entries or {}).items() if now - v.get("last_modified", 0) <= res.max_cache_age}
+            entries.update(new_entries)
+            return entries
+
+        return update_json(path, merge_entries, MAX_WRITE_ATTEMPTS, backoff=0.2)
+
+
+# C03 - Cache in memoria delle risposte '/chat': chiave = domanda normalizzata + hash del contenuto della selezione di alert
+#       (indipendente dall'ordine di selezione), LRU con TTL e contatori di hit/miss
+class ChatCache:
+    def __init__(self):
+        self._lru = LRUCache(res.chat_cache_size, res.chat_cache_ttl)
+        self._hits = 0
+        self._misses = 0
+
+    # Normalizzazione della domanda: forma Unicode, maiuscole, spazi e punteggiatura finale non distinguono due domande
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        text = unicodedata.normalize("NFKC", question).casefold()
+        return re.sub(r"\s+", " ", text).strip(" ?!.;:")
+
+    # Hash della selezione: multinsieme degli hash del contenuto esatto degli alert, ID compreso (non la chiave canonica della
+    # classificazione: selezioni diverse devono avere chiavi diverse)
+    @staticmethod
+    def selection_hash(alerts: list[dict] | dict | str) -> str:
+        if isinstance(alerts, str):
+            return hashlib.md5(alerts.encode()).hexdigest()
+
+        hashes = sorted(content_hash(alert) for alert in ([alerts] if isinstance(alerts, dict) else alerts))
+        return hashlib.md5(",".join(hashes).encode()).hexdigest()
+
+    def key(self, question: str, alerts: list[dict] | dict | str) -> str:
+        return f"{self.selection_hash(alerts)}:{hashlib.md5(self.normalize_question(question).encode()).hexdigest()}"
+
+    # Ricerca di una risposta (None se assente, scaduta o cache disabilitata)
+    def get(self, key: str) -> dict | None:
+        if not res.chat_cache_enabled:
+            return None
 
-            if now - last_mod > res.max_cache_age:
-                blob.delete()
-                deleted += 1
-        except Exception as e:
-            res.logger.warning(f"[CRR][cache_utils][cleanup] Failed cleanup of {blob.name}: {e}")
+        entry = self._lru.get(key)
+        if entry is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return entry
 
-    res.logger.debug(f"[CRR][cache_utils][cleanup] Cleanup completed. Deleted files: {deleted}")
+    def put(self, key: str, entry: dict):
+        if res.chat_cache_enabled:
+            self._lru.put(key, entry)
 
+    # Allineamento dei limiti della LRU alla configurazione corrente (dopo '/reload-config')
+    def reload_config(self):
+        self._lru.resize(res.chat_cache_size, res.chat_cache_ttl)
 
-# Salva cache (un file di cache per ogni alert)
-def upload_cache(h: str, data: dict):
-    blob = res.bucket.blob(f"{res.gcs_cache_dir}/{h}.json")
-    blob.upload_from_string(json.dumps(data))
+    # Statistiche della cache (per istanza del worker)
+    def stats(self) -> dict:
+        n_lookups = self._hits + self._misses
+        return {
+            "enabled": res.chat_cache_enabled,
+            "size": len(self._lru),
+            "max_size": res.chat_cache_size,
+            "ttl": res.chat_cache_ttl,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / n_lookups if n_lookups else 0.0
+        }
 
 
-# Leggi cache
-def download_cache(h: str) -> dict:    
-    blob = res.bucket.blob(f"{res.gcs_cache_dir}/{h}.json")
-    return json.loads(blob.download_as_text())
+# Istanze singletone da far importare agli altri moduli
+result_cache = ResultCache()
+chat_cache = ChatCache()
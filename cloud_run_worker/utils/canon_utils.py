@@ -0,0 +1,81 @@
+import math, ipaddress
+
+from utils.resource_manager import resource_manager as res
+
+
+DEFAULT_IPV6_PREFIX = 64    # prefisso applicato agli indirizzi IPv6 quando la regola specifica solo quello IPv4
+
+
+# F01 - Regole di canonicalizzazione di un dataset ('config.json' -> 'canonicalization': regole "default", poi l'eventuale profilo scelto
+#       dal dataset, poi le sue regole). Le regole di default sono esatte (tutti i campi, escluso 'time'): gli accorpamenti più
+#       aggressivi (es: campi chiave ridotti, sottoreti) sono attivati solo per i dataset che li richiedono
+def get_rules(dataset_name: str) -> dict:
+    conf = res.canonicalization or {}
+    override = conf.get("datasets", {}).get(dataset_name, {})
+    if isinstance(override, str):   # es: "datasets": {"my_dataset": "aggressive"}
+        override = {"profile": override}
+
+    rules = dict(conf.get("default", {}))
+    if override.get("profile"):
+        rules.update(conf.get("profiles", {}).get(override["profile"], {}))
+    rules.update({k: v for k, v in override.items() if k != "profile"})
+    return rules
+    # Esempio di regole:
+    #   {
+    #       "key_fields": ["name", "short", "host", "ip"],  -> campi che identificano l'alert (vuoto = tutti)
+    #       "drop_fields": ["time"],                        -> campi ignorati
+    #       "bucket_fields": {"time": 3600},                -> campi numerici arrotondati a intervalli (es: ora)
+    #       "subnet_fields": {"ip": 24}                     -> indirizzi IP ridotti alla sottorete (prefisso IPv4)
+    #   }
+
+
+# F02 - Costruzione della forma canonica di un alert (usata come chiave di cache e di deduplicazione, mai inviata al modello)
+def canonicalize(alert: dict, rules: dict) -> dict:
+    key_fields = rules.get("key_fields") or list(alert)
+    drop_fields = set(rules.get("drop_fields", []))
+    bucket_fields = rules.get("bucket_fields", {})
+    subnet_fields = rules.get("subnet_fields", {})
+
+    canonical = {}
+    for field in key_fields:
+        value = alert.get(field)
+
+        if field in drop_fields or is_missing(value):   # i valori mancanti (None/NaN) non distinguono gli alert
+            continue
+
+        if field in bucket_fields:
+            value = to_bucket(value, bucket_fields[field])
+        elif field in subnet_fields:
+            value = to_subnet(value, subnet_fields[field])
+
+        canonical[field] = value
+
+    return canonical
+
+
+# F03 - Controllo valore mancante (pandas rappresenta le colonne assenti in una riga come NaN)
+def is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+# F04 - Arrotondamento di un valore numerico all'inizio del suo intervallo (es: timestamp -> ora)
+def to_bucket(value, size: float):
+    try:
+        return int(float(value) // size * size)
+    except (TypeError, ValueError):
+        return value
+
+
+# F05 - Riduzione di un indirizzo IP alla sua sottorete (es: "10.0.1.17" -> "10.0.1.0/24")
+def to_subnet(value, prefix: int | dict):
+    try:
+        address = ipaddress.ip_address(str(value).strip())
+    except ValueError:
+        return value    # valore non IP: lasciato invariato
+
+    if isinstance(prefix, dict):
+        prefix = prefix.get(f"v{address.version}", 32 if address.version == 4 else DEFAULT_IPV6_PREFIX)
+    elif address.version == 6:
+        prefix = DEFAULT_IPV6_PREFIX
+
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
@@ -0,0 +1,178 @@
+import re, time, weakref, asyncio
+
+from collections import deque
+from contextlib import asynccontextmanager
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests, ServiceUnavailable, DeadlineExceeded, InternalServerError
+from utils.resource_manager import resource_manager as res
+
+
+OVERLOAD_ERRORS = ("timeout", "quota", "unavailable")  # classi di errore che segnalano saturazione del modello (riduzione del limite)
+HTTP_STATUS_PATTERN = re.compile(r"\b(?:HTTP|status|code)\b\D{0,12}\b(429|500|503)\b", re.IGNORECASE)  # es: "HTTP 503", "status code: 429"
+
+
+# F01 - Classificazione di un errore del modello: "timeout", "quota" (429), "unavailable" (5xx) o "other"
+def classify_error(e: BaseException) -> str:
+    if isinstance(e, (asyncio.TimeoutError, DeadlineExceeded)):
+        return "timeout"
+    if isinstance(e, (ResourceExhausted, TooManyRequests)):
+        return "quota"
+    if isinstance(e, (ServiceUnavailable, InternalServerError)):
+        return "unavailable"
+
+    # Alcuni errori arrivano come eccezioni generiche: si ricorre al codice HTTP dell'eccezione o, in mancanza, a quello citato nel
+    # messaggio (solo se preceduto da "HTTP"/"status"/"code": cifre qualsiasi, es. ID o conteggi di token, non contano)
+    status = getattr(e, "code", None) or getattr(e, "status_code", None)
+    if not isinstance(status, int):
+        match = HTTP_STATUS_PATTERN.search(str(e))
+        status = int(match.group(1)) if match else None
+
+    if status == 429 or "Resource exhausted" in str(e):
+        return "quota"
+    if status in (500, 503):
+        return "unavailable"
+    return "other"
+
+
+# C01 - Limitatore di concorrenza AIMD (Additive Increase, Multiplicative Decrease) per le richieste a Gemini:
+#       +1 richiesta in volo per ogni "finestra" di risposte sane, limite ridotto di un fattore in caso di timeout o errori di quota
+class AdaptiveLimiter:
+    def __init__(self, initial: int, min_limit: int, max_limit: int, target_latency: float, backoff: float = 0.5):
+        self._waiters = deque()     # future delle richieste in coda, in ordine di arrivo
+        self._in_flight = 0
+        self._queue_peak = 0
+        self._peak_trackers = weakref.WeakSet()   # picchi della coda per batch (vedi 'track_queue_peak')
+        self._last_decrease = 0.0
+        self._n_decreases = 0
+        self.configure(initial, min_limit, max_limit, target_latency, backoff)
+
+    # Aggiornamento dei parametri (es: dopo '/reload-config'), mantenendo il limite corrente entro i nuovi estremi
+    def configure(self, initial: int, min_limit: int, max_limit: int, target_latency: float, backoff: float = 0.5):
+        self._min = max(1, min_limit)
+        self._max = max(self._min, max_limit)
+        self._target_latency = target_latency
+        self._backoff = backoff
+        self._limit = float(min(max(initial, self._min), self._max))
+        self._wake()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    # Occupazione di uno slot per la durata di una richiesta (con misura della latenza e aggiornamento del limite)
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        start = time.perf_counter()
+
+        try:
+            yield
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError) and classify_error(e) in OVERLOAD_ERRORS:
+                self._decrease()
+            raise
+        else:
+            self._on_success(time.perf_counter() - start)
+        finally:
+            self._in_flight -= 1
+            self._wake()
+
+    # Avvio della misura del picco della coda per un batch: con il limitatore condiviso, ogni batch ha il proprio picco
+    # (un azzeramento a ogni lettura cancellerebbe quello dei batch concorrenti)
+    def track_queue_peak(self) -> "QueuePeak":
+        peak = QueuePeak(len(self._waiters))
+        self._peak_trackers.add(peak)   # riferimento debole: la misura termina con il batch che la conserva
+        return peak
+
+    # Stato del limitatore da esportare nelle metriche del batch ('peak' = picco della coda del batch, altrimenti quello globale)
+    def snapshot(self, peak: "QueuePeak" = None) -> dict:
+        return {
+            "concurrency_limit": self.limit,
+            "in_flight_requests": self._in_flight,
+            "queue_depth": len(self._waiters),
+            "queue_depth_peak": peak.value if peak is not None else self._queue_peak,
+            "n_limit_decreases": self._n_decreases
+        }
+
+
+    async def _acquire(self):
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self._queue_peak = max(self._queue_peak, len(self._waiters))
+        for peak in self._peak_trackers:
+            peak.value = max(peak.value, len(self._waiters))
+
+        try:
+            await future    # lo slot viene assegnato (e 'in_flight' incrementato) da '_wake'
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():    # slot già assegnato: va restituito
+                self._in_flight -= 1
+                self._wake()
+            else:
+                self._waiters.remove(future)
+            raise
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+    def _on_success(self, latency: float):
+        if latency > self._target_latency:
+            return  # latenza oltre la soglia: il limite non cresce (ma non viene ridotto, come avviene invece per gli errori)
+
+        self._limit = min(self._max, self._limit + 1 / self._limit)    # incremento additivo: +1 dopo 'limit' risposte sane
+        self._wake()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self._target_latency:
+            return  # una sola riduzione per finestra: gli errori di una stessa ondata di richieste non fanno crollare il limite
+
+        self._last_decrease = now
+        limit = max(self._min, self._limit * self._backoff)
+        if int(limit) == self.limit:
+            return  # limite già al minimo (o limitatore a concorrenza fissa)
+
+        self._n_decreases += 1
+        self._limit = limit
+        res.logger.warning(f"[concurrency|C01]\t-> Model overloaded: concurrency limit reduced to {self.limit}")
+
+
+# C02 - Picco della profondità della coda del limitatore osservato durante un batch
+class QueuePeak:
+    __slots__ = ("value", "__weakref__")
+
+    def __init__(self, value: int = 0):
+        self.value = value
+
+
+# F02 - Creazione del limitatore condiviso dall'intero processo (tutti i batch in esecuzione sul worker competono per la stessa quota)
+def create_shared_limiter() -> AdaptiveLimiter:
+    return AdaptiveLimiter(
+        initial=res.max_concurrent_requests,
+        min_limit=res.min_concurrent_requests,
+        max_limit=res.max_concurrency_limit,
+        target_latency=res.target_latency,
+        backoff=res.concurrency_backoff
+    )
+
+
+# F03 - Allineamento del limitatore condiviso alla configurazione corrente
+def reload_shared_limiter():
+    shared_limiter.configure(
+        initial=res.max_concurrent_requests,
+        min_limit=res.min_concurrent_requests,
+        max_limit=res.max_concurrency_limit,
+        target_latency=res.target_latency,
+        backoff=res.concurrency_backoff
+    )
+
+
+# Istanza singletone da far importare agli altri moduli
+shared_limiter = create_shared_limiter()
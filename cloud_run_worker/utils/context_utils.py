@@ -0,0 +1,94 @@
+import json
+
+from collections import Counter
+from utils.resource_manager import resource_manager as res
+from utils.canon_utils import is_missing
+from utils.cache_utils import content_hash
+
+
+CHARS_PER_TOKEN = 4         # stima dei token di un testo (nessuna chiamata aggiuntiva a Gemini per contarli)
+ID_FIELD = "id"             # identificativo di una riga: escluso dal confronto tra duplicati, riportato nel gruppo
+
+
+# F01 - Stima del numero di token di un testo
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+# F02 - Serializzazione JSON compatta (senza indentazione né spazi, valori mancanti omessi)
+def compact_json(obj) -> str:
+    if isinstance(obj, dict):
+        obj = {k: v for k, v in obj.items() if not is_missing(v)}
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+# F03 - Raggruppamento dei soli alert duplicati esatti (stesso contenuto in tutti i campi tranne l'ID; non la chiave canonica della
+#       classificazione, che unirebbe alert distinti per orario o indirizzo): un alert rappresentativo per gruppo, con numero di
+#       occorrenze e ID delle righe. I gruppi sono ordinati per numerosità (a parità, per prima apparizione)
+def group_alerts(alerts: list[dict]) -> list[dict]:
+    groups = {}
+
+    for alert in alerts:
+        group = groups.setdefault(content_hash(alert, exclude=(ID_FIELD,)), {"alert": alert, "count": 0, "ids": []})
+        group["count"] += 1
+        if not is_missing(alert.get(ID_FIELD)):
+            group["ids"].append(alert[ID_FIELD])
+
+    result = []
+    for group in sorted(groups.values(), key=lambda g: -g["count"]):
+        entry = {"count": group["count"], "alert": group["alert"]}
+        if group["count"] > 1 and group["ids"]:
+            entry["ids"] = group["ids"]
+        result.append(entry)
+
+    return result
+
+
+# F04 - Riepilogo della selezione: numero di alert e di gruppi, valori più frequenti dei campi di riepilogo (es: name, host, class)
+def summarize_alerts(alerts: list[dict], groups: list[dict]) -> dict:
+    summary = {"n_alerts": len(alerts), "n_unique": len(groups)}
+
+    for field in res.chat_summary_fields:
+        counts = Counter(str(alert[field]) for alert in alerts if not is_missing(alert.get(field)))
+        if counts:
+            summary[field] = dict(counts.most_common(res.chat_summary_top))
+            if len(counts) > res.chat_summary_top:
+                summary[field]["(altri)"] = sum(counts.values()) - sum(summary[field].values())
+
+    return summary
+
+
+# F05 - Costruzione del contesto di un quesito '/chat' entro il budget di token: riepilogo della selezione, poi gli alert raggruppati
+#       (dai gruppi più numerosi) finché il budget lo consente. Restituisce il contesto e le sue statistiche
+def build_chat_context(alerts: list[dict] | dict | str, budget: int = None) -> tuple[str, dict]:
+    budget = budget or res.chat_context_budget
+
+    if isinstance(alerts, str):     # contesto già serializzato dal chiamante: solo troncato al budget
+        context = alerts[:budget * CHARS_PER_TOKEN]
+        return context, {"n_alerts": None, "n_groups": None, "n_included": None, "truncated": len(context) < len(alerts)}
+
+    alerts = [alerts] if isinstance(alerts, dict) else list(alerts)
+    groups = group_alerts(alerts)
+
+    lines = [f"Riepilogo: {compact_json(summarize_alerts(alerts, groups))}", "Alert (raggruppati, 'count' = occorrenze):"]
+    used = sum(estimate_tokens(line) + 1 for line in lines)
+
+    n_included = 0
+    for group in groups:
+        line = compact_json({**group, "alert": {k: v for k, v in group["alert"].items() if not is_missing(v)}})
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+        n_included += 1
+
+    if n_included < len(groups):
+        lines.append(f"(altri {len(groups) - n_included} gruppi di alert omessi per limiti di contesto: fare riferimento al riepilogo)")
+
+    return "\n".join(lines), {
+        "n_alerts": len(alerts),
+        "n_groups": len(groups),
+        "n_included": n_included,
+        "truncated": n_included < len(groups)
+    }
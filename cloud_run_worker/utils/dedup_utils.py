@@ -0,0 +1,61 @@
+import asyncio
+
+
+# F01 - Raggruppamento delle posizioni degli alert per chiave canonica (l'ordine di prima apparizione è preservato)
+def group_by_key(keys: list[str], positions: list[int]) -> dict[str, list[int]]:
+    groups = {}
+    for k in positions:
+        groups.setdefault(keys[k], []).append(k)
+    return groups
+
+
+# F02 - Suddivisione di una lista in blocchi di dimensione massima 'size' (es: alert da impacchettare in un solo prompt)
+def chunked(items: list, size: int) -> list[list]:
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# C01 - Coalescenza delle richieste in volo (singleflight): batch concorrenti sullo stesso worker che contengono alert
+#       equivalenti attendono la stessa richiesta a Gemini invece di inviarne una nuova
+class InflightRegistry:
+    def __init__(self):
+        self._inflight = {}     # chiave canonica -> future del risultato della richiesta in corso
+
+    # Prenotazione di una chiave: restituisce la future del risultato e se il chiamante ne è il proprietario (deve inviare la richiesta)
+    def claim(self, key: str) -> tuple[asyncio.Future, bool]:
+        future = self._inflight.get(key)
+        if future is not None:
+            return future, False
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future, True
+
+    # Pubblicazione del risultato di una chiave posseduta
+    def resolve(self, key: str, result: dict):
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    # Rilascio di una chiave posseduta senza risultato (errore o cancellazione): i batch in attesa ricevono l'eccezione
+    def fail(self, key: str, exc: BaseException):
+        future = self._inflight.pop(key, None)
+        if future is None or future.done():
+            return
+
+        if isinstance(exc, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(exc)
+            future.exception()  # segna l'eccezione come letta (evita warning se nessun altro batch era in attesa)
+
+    # Attesa del risultato di una chiave posseduta da un altro batch
+    async def wait(self, future: asyncio.Future) -> dict:
+        return await asyncio.shield(future)     # 'shield': la cancellazione di un batch in attesa non annulla la richiesta altrui
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+# Istanza singletone da far importare agli altri moduli
+inflight_registry = InflightRegistry()
@@ -1,17 +1,33 @@
-import os, io, json, asyncio, posixpath
+import os, io, json, time, random, struct, asyncio, posixpath
 import pandas as pd
 
+from google.api_core.exceptions import NotFound, PreconditionFailed, TooManyRequests
 from utils.resource_manager import resource_manager as res
 
 
+ROW_INDEX_ENTRY_SIZE = 8    # ogni entry dell'indice delle righe è un intero unsigned a 64 bit little-endian ('<Q')
+MAX_UPDATE_ATTEMPTS = 10    # tentativi di aggiornamento di un documento conteso da più worker (o batch) concorrenti
+
+
 # F01 - Costruzione path remoto (usato in VMS per i file 'result', 'metrics' e 'metadata')
 def get_blob_path(folder: str, dataset_filename: str, suffix: str, file_format: str) -> str:
     dataset_name = os.path.splitext(dataset_filename)[0]    # Es: "AAA.json" -> "AAA" oppure "AAA" -> "AAA"
     return posixpath.join(folder, f"{dataset_name}_{suffix}.{file_format}")
 
 
+# F01B - Directory di una cartella nello spazio di una run ('runs/<run_id>/<folder>'); senza run ID, la cartella condivisa (analisi avviate prima dei run ID)
+def get_run_dir(folder: str, run_id: str = None) -> str:
+    return posixpath.join(res.gcs_runs_dir, run_id, folder) if run_id else folder
+
+
 # F02 - Caricamento del solo chunk d'interesse dal dataset su GCS (previene memory leaks in RAM)
-def load_batch(path: str, start_row: int, end_row: int, chunksize: int) -> pd.DataFrame:
+def load_batch(path: str, start_row: int, end_row: int, chunksize: int, index_path: str = None) -> pd.DataFrame:
+    if index_path:
+        try:
+            return load_batch_by_index(path, index_path, start_row, end_row)
+        except Exception as e:
+            res.logger.warning(f"[gcs|F02]\t\t-> Ranged read via '{index_path}' failed ({type(e).__name__}): {str(e)}. Falling back to full scan")
+
     stream = io.BytesIO(res.bucket.blob(path).download_as_bytes())
 
     batch_data = []
@@ -45,12 +61,42 @@ def load_batch(path: str, start_row: int, end_row: int, chunksize: int) -> pd.Da
     #   df = pd.read_json(io.StringIO(data), lines=True)
     #   batch_df = df.iloc[start_row:end_row]
 
+# F02B - Caricamento del batch tramite indice delle righe (lettura ranged dei soli byte del batch)
+def load_batch_by_index(path: str, index_path: str, start_row: int, end_row: int) -> pd.DataFrame:
+    if end_row <= start_row:
+        return pd.DataFrame()
+
+    # Lettura degli offset delle righe del batch più quello della riga successiva (l'indice contiene 'num_rows + 1' entry)
+    n_entries = end_row - start_row + 1
+    raw = res.bucket.blob(index_path).download_as_bytes(
+        start=start_row * ROW_INDEX_ENTRY_SIZE,
+        end=(end_row + 1) * ROW_INDEX_ENTRY_SIZE - 1
+    )
+
+    if len(raw) != n_entries * ROW_INDEX_ENTRY_SIZE:
+        raise IndexError(f"Rows {start_row}-{end_row} out of index bounds")
+
+    byte_start = struct.unpack_from("<Q", raw, 0)[0]
+    byte_end = struct.unpack_from("<Q", raw, len(raw) - ROW_INDEX_ENTRY_SIZE)[0]
+
+    # Unica richiesta HTTP range sul dataset (estremo 'end' incluso)
+    data = res.bucket.blob(path).download_as_bytes(start=byte_start, end=byte_end - 1)
+    batch_df = pd.read_json(io.BytesIO(data), lines=True)
+
+    if len(batch_df) != end_row - start_row:
+        raise ValueError(f"Expected {end_row - start_row} rows, got {len(batch_df)} (stale index?)")
+
+    return batch_df
+    # Nota:
+    # L'indice ('<dataset>_index.bin', accanto ai metadati) è generato dal server insieme ai metadati del dataset.
+    # In questo modo l'I/O di ogni batch è proporzionale alla dimensione del batch e non a quella del dataset.
+
 
 # F03 - Upload asincrono di lista di oggetti JSON su GCS
 async def upload_as_jsonl(path: str, data: list[dict]):
     await asyncio.to_thread(
         lambda: res.bucket.blob(path).upload_from_string(
-            "\n".join(json.dumps(obj) for obj in data),
+            "".join(json.dumps(obj) + "\n" for obj in data),   # newline finale: i file dei batch vengono concatenati con compose nel merge
             content_type="application/json"
         )
     )
@@ -58,3 +104,39 @@ async def upload_as_jsonl(path: str, data: list[dict]):
     # Questa funzione asincrona consente di non dover aspettare il termine dell'operazione di upload dati in caso venga ricevuta
     # una seconda richiesta di upload. In questo modo, le operazioni partono in parallelo invece che attendere la fine
     # di quella già in esecuzione.
+
+
+# F04 - Download di un documento JSON con la sua generation (None e 0 se non esiste)
+def download_json(path: str) -> tuple[dict | None, int]:
+    blob = res.bucket.get_blob(path)
+    if blob is None:
+        return None, 0
+
+    try:
+        return json.loads(blob.download_as_text(if_generation_match=blob.generation)), blob.generation
+    except (NotFound, PreconditionFailed):
+        return download_json(path)  # documento riscritto tra lettura dei metadati e download: nuovo tentativo
+
+
+# F05 - Aggiornamento atomico di un documento JSON (read-modify-write con precondizione sulla generation, usato per shard di cache e avanzamento)
+#       'update_fn(doc)' riceve il documento corrente (None se assente) e restituisce quello nuovo, oppure None se non c'è nulla da scrivere;
+#       restituisce il documento scritto (o quello corrente, se invariato)
+def update_json(path: str, update_fn, max_attempts: int = MAX_UPDATE_ATTEMPTS, backoff: float = 0.1) -> dict | None:
+    for attempt in range(max_attempts):
+        doc, generation = download_json(path)
+        new_doc = update_fn(doc)
+        if new_doc is None:
+            return doc
+
+        try:
+            res.bucket.blob(path).upload_from_string(
+                json.dumps(new_doc, separators=(",", ":")),
+                content_type="application/json",
+                if_generation_match=generation  # 0 = crea solo se non esiste
+            )
+            return new_doc
+
+        except (PreconditionFailed, TooManyRequests):
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))   # scrittura concorrente: backoff e nuovo tentativo
+
+    raise RuntimeError(f"Document '{path}' still contended after {max_attempts} attempts")
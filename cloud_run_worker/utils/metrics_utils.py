@@ -1,4 +1,4 @@
-import os, time, json, psutil
+import os, time, psutil
 from utils.resource_manager import resource_manager as res
 
 
@@ -16,7 +16,7 @@ def init_monitoring() -> tuple[float, float]:
 
 
 # F03 - Finalizzazione misurazioni
-def finalize_monitoring(timer_start: float, timestamp_start: float, batch_id: int, batch_size: int, concurrency: int) -> dict:
+def finalize_monitoring(timer_start: float, timestamp_start: float, batch_id: int, batch_size: int, concurrency: int, batch_stats: dict = None) -> dict:
     elapsed = time.perf_counter() - timer_start
     ram = get_memory_usage_mb()
 
@@ -34,25 +34,18 @@ def finalize_monitoring(timer_start: float, timestamp_start: float, batch_id: in
         "avg_time_per_alert": avg_time,         # tempo d'elaborazione medio di ogni alert
         "timestamp": timestamp_start            # timestamp istante inizio analisi del batch
     }
+    metrics.update(batch_stats or {})           # contatori specifici dell'analisi (es: 'cache_hits', 'cache_misses')
 
     return metrics
 
 
-# F04 - Calcolo errori in batch e aggiornamento metriche
-def update_metrics(batch_results: list[dict], batch_size: int, path: str) -> list[dict]:
+# F04 - Calcolo errori e retry del batch e aggiornamento metriche (in memoria, prima dell'unico upload del file di metriche)
+def update_metrics(batch_results: list[dict], batch_size: int, metrics: dict, retry_stats: dict = None) -> dict:
     n_errors = sum(1 for r in batch_results if r.get("class") == "error")
     error_rate = n_errors / batch_size if batch_size else 0.0
     success_rate = 1 - n_errors / batch_size if batch_size else 0.0
     n_timeouts = sum("Timeout" in r.get("explanation", "") for r in batch_results)
-    
-    # Scarica metriche esistenti
-    blob = res.bucket.blob(path)
-    if not blob.exists():
-        res.logger.error(f"[metrics|F04]\t-> File '{path}' not found")
-        raise FileNotFoundError(f"File '{path}' not found")
-    
-    metrics_text = blob.download_as_text()
-    metrics = json.loads(metrics_text)
+    retry_stats = retry_stats or {}
 
     # Aggiungi le nuove metriche
     metrics["n_classified"] = batch_size - n_errors # classificazioni riuscite
@@ -61,8 +54,13 @@ def update_metrics(batch_results: list[dict], batch_size: int, path: str) -> lis
     metrics["error_rate"] = error_rate              # tasso di classificazione fallite
     metrics["has_errors"] = n_errors > 0            # flag utile per sapere immediatamente se ci sono errori nel batch
     metrics["n_timeouts"] = n_timeouts              # numero di errori dovuti a timeout
+    metrics["n_retries"] = retry_stats.get("n_retries", 0)                              # tentativi aggiuntivi dopo errori transitori
+    metrics["n_retries_timeout"] = retry_stats.get("n_retries_timeout", 0)              # ... dovuti a timeout
+    metrics["n_retries_quota"] = retry_stats.get("n_retries_quota", 0)                  # ... dovuti a errori di quota (429)
+    metrics["n_retries_unavailable"] = retry_stats.get("n_retries_unavailable", 0)      # ... dovuti a servizio non disponibile (5xx)
+    metrics["n_retry_budget_exhausted"] = retry_stats.get("n_retry_budget_exhausted", 0)    # retry negati per esaurimento del budget del batch
 
-    return [metrics]
+    return metrics
 
 # Elenco nomi metriche (per header CSV):
-# batch_id,batch_size,max_concurrent_reqs,parallelism_used,alert_throughput,ram_mb,time_sec,avg_time_per_alert,timestamp,n_classified,success_rate,has_errors,n_errors,error_rate,n_timeouts
+# batch_id,batch_size,max_concurrent_reqs,parallelism_used,alert_throughput,ram_mb,time_sec,avg_time_per_alert,timestamp,cache_hits,cache_misses,n_unique_prompts,n_dedup_in_batch,n_dedup_cross_batch,prompt_pack_size,n_model_requests,concurrency_limit,in_flight_requests,queue_depth,queue_depth_peak,n_limit_decreases,n_classified,success_rate,has_errors,n_errors,error_rate,n_timeouts,n_retries,n_retries_timeout,n_retries_quota,n_retries_unavailable,n_retry_budget_exhausted
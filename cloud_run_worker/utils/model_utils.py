@@ -0,0 +1,98 @@
+#NB: non usare la classe ResourceManager, o potrebbero verificarsi dei loop di import
+
+import re, json, zlib, random, asyncio
+
+from abc import ABC, abstractmethod
+from utils.logger_utils import logger
+
+
+FAKE_CLASSES = ("false_positive", "real_threat")
+FAKE_CHAT_ANSWER = "Risposta simulata (fake model): nessuna richiesta è stata inviata a Gemini."
+FAKE_FIRST_TOKEN_LATENCY = 0.2  # latenza simulata del primo frammento in streaming
+FAKE_TOKEN_INTERVAL = 0.02      # intervallo simulato tra due frammenti
+PACKED_ENTRY_PATTERN = re.compile(r'\{"idx":(\d+),"alert":')   # entry di un prompt impacchettato (vedi 'build_packed_prompt')
+
+
+# C01 - Interfaccia dei client del modello generativo: ogni richiesta in volo costa una coroutine, non un thread
+class ModelClient(ABC):
+    name = "base"
+
+    @abstractmethod     # un client senza 'generate' fallisce alla creazione, non a metà di un batch
+    async def generate(self, prompt: str, generation_config=None) -> str:
+        ...
+
+    # Generazione in streaming (frammenti di testo man mano che vengono prodotti); senza supporto nativo, un unico frammento finale
+    async def stream(self, prompt: str, generation_config=None):
+        yield await self.generate(prompt, generation_config)
+
+
+# C02 - Client Vertex AI basato sull'API asincrona nativa ('generate_content_async')
+class VertexModelClient(ModelClient):
+    name = "vertex"
+
+    def __init__(self, model):
+        self._model = model
+
+    async def generate(self, prompt: str, generation_config=None) -> str:
+        response = await self._model.generate_content_async(prompt, generation_config=generation_config)
+        return response.text
+
+    async def stream(self, prompt: str, generation_config=None):
+        responses = await self._model.generate_content_async(prompt, generation_config=generation_config, stream=True)
+        async for response in responses:
+            try:
+                text = response.text
+            except ValueError:  # frammento senza testo (es: solo motivo di terminazione o metadati di sicurezza)
+                continue
+            if text:
+                yield text
+
+
+# C03 - Client simulato (nessuna chiamata a Gemini): latenza configurabile e risposte sintatticamente valide, per misurare il throughput offline
+class FakeModelClient(ModelClient):
+    name = "fake"
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2):
+        self._latency = latency
+        self._jitter = jitter
+
+    async def generate(self, prompt: str, generation_config=None) -> str:
+        await asyncio.sleep(max(0.0, self._latency + random.uniform(-self._jitter, self._jitter)))
+
+        # Prompt impacchettato: un oggetto per ogni indice locale presente nella sezione finale del prompt
+        tail = prompt.rsplit("ALERT:", 1)[-1]
+        indexes = [int(j) for j in PACKED_ENTRY_PATTERN.findall(tail)]
+        if indexes:
+            return json.dumps([self._fake_result(prompt, j) | {"idx": j} for j in indexes])
+
+        if "ALERT:" in prompt:
+            return json.dumps(self._fake_result(prompt, 0))
+
+        return FAKE_CHAT_ANSWER
+
+    async def stream(self, prompt: str, generation_config=None):
+        if "ALERT:" in prompt:
+            yield await self.generate(prompt, generation_config)
+            return
+
+        await asyncio.sleep(min(self._latency, FAKE_FIRST_TOKEN_LATENCY))
+        for word in re.findall(r"\S+\s*", FAKE_CHAT_ANSWER):
+            yield word
+            await asyncio.sleep(FAKE_TOKEN_INTERVAL)
+
+    # Classificazione deterministica (stesso prompt -> stessa classe), così da rendere ripetibili le misure
+    def _fake_result(self, prompt: str, j: int) -> dict:
+        cls = FAKE_CLASSES[zlib.crc32(f"{j}:{prompt}".encode()) % len(FAKE_CLASSES)]
+        return {"class": cls, "explanation": "Classificazione simulata (fake model)."}
+
+
+# F01 - Creazione del client del modello indicato in configurazione ('model_client': "vertex" | "fake")
+def create_client(kind: str, model=None, fake_latency: float = 0.5) -> ModelClient:
+    if kind == "fake":
+        logger.warning(f"[model|F01]\t\t-> Using fake model client (latency {fake_latency}s): no request will reach Gemini")
+        return FakeModelClient(latency=fake_latency)
+
+    if kind != "vertex":
+        logger.warning(f"[model|F01]\t\t-> Unknown model client '{kind}', falling back to 'vertex'")
+
+    return VertexModelClient(model)
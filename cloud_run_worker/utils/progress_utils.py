@@ -0,0 +1,54 @@
+import time, base64, asyncio, posixpath
+
+from utils.resource_manager import resource_manager as res
+from utils.gcs_utils import get_run_dir, update_json
+
+
+# F01 - Percorso dello shard di avanzamento di un batch (i batch sono distribuiti per 'batch_id % n_shards', così da non superare
+#       il limite di GCS di circa una scrittura al secondo per oggetto). Stesso schema letto dal server in '/batch-results-status'.
+#       'n_shards' è fissato dal server nel documento della run e ricevuto nel task: solo i task senza questo campo usano la configurazione
+def shard_path(dataset_name: str, batch_id: int, num_batches: int, run_id: str = None, n_shards: int = None) -> tuple[str, int, int]:
+    n_shards = n_shards or max(1, min(num_batches, res.progress_num_shards))
+    shard = batch_id % n_shards
+    return posixpath.join(get_run_dir(res.gcs_progress_dir, run_id), f"{dataset_name}_progress_{shard:04d}.json"), shard, n_shards
+
+
+# F02 - Registrazione di un batch completato nel documento di avanzamento: bitmap dei batch completati, contatori e timestamp
+async def record_batch(dataset_name: str, batch_id: int, num_batches: int, batch_results: list[dict], run_id: str = None, n_shards: int = None):
+    stats = {
+        "n_alerts": len(batch_results),
+        "n_errors": sum(1 for r in batch_results if r.get("class") == "error"),
+        "n_timeouts": sum("Timeout" in r.get("explanation", "") for r in batch_results)
+    }
+
+    try:
+        await asyncio.to_thread(update_shard, dataset_name, batch_id, num_batches, stats, run_id, n_shards)
+    except Exception as e:  # l'avanzamento è solo informativo: un errore non deve far fallire il batch
+        res.logger.warning(f"[progress|F02]\t-> Failed to record batch {batch_id} ({type(e).__name__}): {str(e)}")
+
+
+# F03 - Aggiornamento atomico di uno shard (read-modify-write con precondizione sulla generation, vedi 'gcs_utils.F05')
+def update_shard(dataset_name: str, batch_id: int, num_batches: int, stats: dict, run_id: str = None, n_shards: int = None):
+    path, shard, n_shards = shard_path(dataset_name, batch_id, num_batches, run_id, n_shards)
+    bit = batch_id // n_shards  # posizione del batch nella bitmap dello shard
+
+    def add_batch(doc):
+        now = time.time()
+        if doc is None:
+            doc = {"shard": shard, "num_shards": n_shards, "num_batches": num_batches, "n_completed": 0,
+                   "n_alerts": 0, "n_errors": 0, "n_timeouts": 0, "started_at": now, "last_update": now}
+        bitmap = bytearray(base64.b64decode(doc.get("bitmap", "")))
+        bitmap.extend(bytes(max(0, bit // 8 + 1 - len(bitmap))))
+
+        if bitmap[bit // 8] & (1 << bit % 8):
+            return None     # batch già registrato (es: task rieseguito da Cloud Tasks): contatori invariati
+
+        bitmap[bit // 8] |= 1 << bit % 8
+        doc["bitmap"] = base64.b64encode(bytes(bitmap)).decode()
+        doc["n_completed"] += 1
+        for field, value in stats.items():
+            doc[field] = doc.get(field, 0) + value
+        doc["last_update"] = now
+        return doc
+
+    update_json(path, add_batch)
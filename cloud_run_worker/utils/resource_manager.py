@@ -1,5 +1,6 @@
 import json
 import utils.vertexai_utils as vxc
+import utils.model_utils as mdl
 
 from google.cloud import storage
 from utils.logger_utils import logger
@@ -16,14 +17,41 @@ class ResourceManager:
         self._logger = logger
         self._model = None
         self._gen_conf = None
+        self._model_client = None
+        self._model_client_kind = "vertex"
+        self._fake_model_latency = 0.5
         self._bucket = None
         self._max_concurrent_requests = 16
+        self._adaptive_concurrency = True
+        self._min_concurrent_requests = 1
+        self._max_concurrency_limit = 64
+        self._target_latency = 20.0
+        self._concurrency_backoff = 0.5
+        self._retry_max_attempts = {"timeout": 2, "quota": 5, "unavailable": 4, "other": 1}
+        self._retry_base_delay = 1.0
+        self._retry_max_delay = 30.0
+        self._retry_budget_ratio = 0.2
+        self._prompt_pack_size = 1
         self._max_cache_age = 60 * 60 * 24 * 7
+        self._cache_enabled = True
+        self._cache_lru_size = 10000
+        self._cache_num_shards = 256
+        self._cache_shard_refresh = 300
+        self._canonicalization = {}
+        self._chat_context_budget = 8000
+        self._chat_summary_fields = ["name", "host", "class"]
+        self._chat_summary_top = 10
+        self._chat_cache_enabled = True
+        self._chat_cache_size = 1000
+        self._chat_cache_ttl = 60 * 60
         self._not_available = "N/A"
         self._gcs_cache_dir = "cache"
         self._gcs_result_dir = "results"
         self._gcs_batch_metrics_dir = "batch_metrics"
         self._gcs_batch_result_dir = "batch_results"
+        self._gcs_progress_dir = "batch_progress"
+        self._gcs_runs_dir = "runs"
+        self._progress_num_shards = 8
         # (dove possibile, impostare come valori di default quelli locali al server Fast API)
         self.initialize()
 
@@ -45,19 +73,49 @@ class ResourceManager:
 
         # Variabili d'ambiente condivise su GCS
         self._max_concurrent_requests = conf.get("max_concurrent_requests", self._max_concurrent_requests)
+        self._adaptive_concurrency = conf.get("adaptive_concurrency", self._adaptive_concurrency)
+        self._min_concurrent_requests = conf.get("min_concurrent_requests", self._min_concurrent_requests)
+        self._max_concurrency_limit = conf.get("max_concurrency_limit", self._max_concurrency_limit)
+        self._target_latency = conf.get("target_latency", self._target_latency)
+        self._concurrency_backoff = conf.get("concurrency_backoff", self._concurrency_backoff)
+        self._retry_max_attempts = conf.get("retry_max_attempts", self._retry_max_attempts)
+        self._retry_base_delay = conf.get("retry_base_delay", self._retry_base_delay)
+        self._retry_max_delay = conf.get("retry_max_delay", self._retry_max_delay)
+        self._retry_budget_ratio = conf.get("retry_budget_ratio", self._retry_budget_ratio)
+        self._prompt_pack_size = conf.get("prompt_pack_size", self._prompt_pack_size)
         self._max_cache_age = conf.get("max_cache_age", self._max_cache_age)
+        self._cache_enabled = conf.get("cache_enabled", self._cache_enabled)
+        self._cache_lru_size = conf.get("cache_lru_size", self._cache_lru_size)
+        self._cache_num_shards = conf.get("cache_num_shards", self._cache_num_shards)
+        self._cache_shard_refresh = conf.get("cache_shard_refresh", self._cache_shard_refresh)
+        self._canonicalization = conf.get("canonicalization", self._canonicalization)
+        self._chat_context_budget = conf.get("chat_context_budget", self._chat_context_budget)
+        self._chat_summary_fields = conf.get("chat_summary_fields", self._chat_summary_fields)
+        self._chat_summary_top = conf.get("chat_summary_top", self._chat_summary_top)
+        self._chat_cache_enabled = conf.get("chat_cache_enabled", self._chat_cache_enabled)
+        self._chat_cache_size = conf.get("chat_cache_size", self._chat_cache_size)
+        self._chat_cache_ttl = conf.get("chat_cache_ttl", self._chat_cache_ttl)
         self._not_available = conf.get("not_available", self._not_available)
         self._gcs_cache_dir = conf.get("gcs_cache_dir", self._gcs_cache_dir)
         self._gcs_result_dir = conf.get("gcs_result_dir", self._gcs_result_dir)
         self._gcs_batch_metrics_dir = conf.get("gcs_batch_metrics_dir", self._gcs_batch_metrics_dir)
         self._gcs_batch_result_dir = conf.get("gcs_batch_result_dir", self._gcs_batch_result_dir)
+        self._gcs_progress_dir = conf.get("gcs_progress_dir", self._gcs_progress_dir)
+        self._gcs_runs_dir = conf.get("gcs_runs_dir", self._gcs_runs_dir)
+        self._progress_num_shards = conf.get("progress_num_shards", self._progress_num_shards)
+        self._model_client_kind = conf.get("model_client", self._model_client_kind)
+        self._fake_model_latency = conf.get("fake_model_latency", self._fake_model_latency)
+
+        # Client del modello (API asincrona nativa di Vertex AI, oppure client simulato per misure offline)
+        self._model_client = mdl.create_client(self._model_client_kind, self._model, self._fake_model_latency)
 
         # Warm-up modello Gemini (risolve il problema del Cold Start o del caricamento on-demand del modello AI)
-        try:
-            self._model.generate_content("ping", generation_config=self._gen_conf)
-            self._logger.info("[RM|F02]\t\t-> Warm-up request sent to Gemini")
-        except Exception as e:
-            self._logger.warning(f"[RM|F02]\t\t-> Warm-up failed ({type(e).__name__}): {str(e)}")
+        if self._model_client_kind != "fake":
+            try:
+                self._model.generate_content("ping", generation_config=self._gen_conf)
+                self._logger.info("[RM|F02]\t\t-> Warm-up request sent to Gemini")
+            except Exception as e:
+                self._logger.warning(f"[RM|F02]\t\t-> Warm-up failed ({type(e).__name__}): {str(e)}")
 
         self._initialized = True
         self._logger.info("[RM|F02]\t\t-> Resource manager initialized")
@@ -66,6 +124,33 @@ class ResourceManager:
     def reload_config(self):
         conf = json.loads(self._bucket.blob(CONFIG_FILENAME).download_as_text())
         self._max_concurrent_requests = conf.get("max_concurrent_requests", self._max_concurrent_requests)
+        self._adaptive_concurrency = conf.get("adaptive_concurrency", self._adaptive_concurrency)
+        self._min_concurrent_requests = conf.get("min_concurrent_requests", self._min_concurrent_requests)
+        self._max_concurrency_limit = conf.get("max_concurrency_limit", self._max_concurrency_limit)
+        self._target_latency = conf.get("target_latency", self._target_latency)
+        self._concurrency_backoff = conf.get("concurrency_backoff", self._concurrency_backoff)
+        self._retry_max_attempts = conf.get("retry_max_attempts", self._retry_max_attempts)
+        self._retry_base_delay = conf.get("retry_base_delay", self._retry_base_delay)
+        self._retry_max_delay = conf.get("retry_max_delay", self._retry_max_delay)
+        self._retry_budget_ratio = conf.get("retry_budget_ratio", self._retry_budget_ratio)
+        self._prompt_pack_size = conf.get("prompt_pack_size", self._prompt_pack_size)
+        self._max_cache_age = conf.get("max_cache_age", self._max_cache_age)
+        self._cache_enabled = conf.get("cache_enabled", self._cache_enabled)
+        self._cache_lru_size = conf.get("cache_lru_size", self._cache_lru_size)
+        self._canonicalization = conf.get("canonicalization", self._canonicalization)
+        self._chat_context_budget = conf.get("chat_context_budget", self._chat_context_budget)
+        self._chat_summary_fields = conf.get("chat_summary_fields", self._chat_summary_fields)
+        self._chat_summary_top = conf.get("chat_summary_top", self._chat_summary_top)
+        self._chat_cache_enabled = conf.get("chat_cache_enabled", self._chat_cache_enabled)
+        self._chat_cache_size = conf.get("chat_cache_size", self._chat_cache_size)
+        self._chat_cache_ttl = conf.get("chat_cache_ttl", self._chat_cache_ttl)
+
+        # Cambio di client del modello (es: benchmark offline con 'model_client' = "fake")
+        kind = conf.get("model_client", self._model_client_kind)
+        latency = conf.get("fake_model_latency", self._fake_model_latency)
+        if (kind, latency) != (self._model_client_kind, self._fake_model_latency):
+            self._model_client_kind, self._fake_model_latency = kind, latency
+            self._model_client = mdl.create_client(kind, self._model, latency)
 
 
     @property
@@ -76,6 +161,10 @@ class ResourceManager:
     def model(self):
         return self._model
 
+    @property
+    def model_client(self):
+        return self._model_client
+
     @property
     def gen_conf(self):
         return self._gen_conf
@@ -88,10 +177,94 @@ class ResourceManager:
     def max_concurrent_requests(self):
         return self._max_concurrent_requests
     
+    @property
+    def adaptive_concurrency(self):
+        return self._adaptive_concurrency
+
+    @property
+    def min_concurrent_requests(self):
+        return self._min_concurrent_requests
+
+    @property
+    def max_concurrency_limit(self):
+        return self._max_concurrency_limit
+
+    @property
+    def target_latency(self):
+        return self._target_latency
+
+    @property
+    def concurrency_backoff(self):
+        return self._concurrency_backoff
+
+    @property
+    def retry_max_attempts(self):
+        return self._retry_max_attempts
+
+    @property
+    def retry_base_delay(self):
+        return self._retry_base_delay
+
+    @property
+    def retry_max_delay(self):
+        return self._retry_max_delay
+
+    @property
+    def retry_budget_ratio(self):
+        return self._retry_budget_ratio
+
+    @property
+    def prompt_pack_size(self):
+        return self._prompt_pack_size
+
     @property
     def max_cache_age(self):
         return self._max_cache_age
 
+    @property
+    def cache_enabled(self):
+        return self._cache_enabled
+
+    @property
+    def cache_lru_size(self):
+        return self._cache_lru_size
+
+    @property
+    def cache_num_shards(self):
+        return self._cache_num_shards
+
+    @property
+    def cache_shard_refresh(self):
+        return self._cache_shard_refresh
+
+    @property
+    def canonicalization(self):
+        return self._canonicalization
+
+    @property
+    def chat_context_budget(self):
+        return self._chat_context_budget
+
+    @property
+    def chat_summary_fields(self):
+        return self._chat_summary_fields
+
+    @property
+    def chat_summary_top(self):
+        return self._chat_summary_top
+
+    @property
+    def chat_cache_enabled(self):
+        return self._chat_cache_enabled
+
+    @property
+    def chat_cache_size(self):
+        return self._chat_cache_size
+
+    @property
+    def chat_cache_ttl(self):
+        return self._chat_cache_ttl
+
     @property
     def not_available(self):
         return self._not_available
@@ -112,6 +285,18 @@ class ResourceManager:
     def gcs_batch_result_dir(self):
         return self._gcs_batch_result_dir
 
+    @property
+    def gcs_progress_dir(self):
+        return self._gcs_progress_dir
+
+    @property
+    def gcs_runs_dir(self):
+        return self._gcs_runs_dir
+
+    @property
+    def progress_num_shards(self):
+        return self._progress_num_shards
+
 
 # Istanza singletone da far importare agli altri moduli
 resource_manager = ResourceManager()
\ No newline at end of file
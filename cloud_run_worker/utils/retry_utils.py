@@ -0,0 +1,73 @@
+import math, random, asyncio
+
+from utils.resource_manager import resource_manager as res
+from utils.concurrency_utils import classify_error
+
+
+# C01 - Budget di tentativi aggiuntivi di un batch: limita il numero totale di retry, così che un'ondata di errori non moltiplichi il carico su Gemini
+class RetryBudget:
+    def __init__(self, max_retries: int):
+        self._remaining = max(0, max_retries)
+        self.n_retries = 0          # tentativi aggiuntivi effettuati
+        self.n_exhausted = 0        # retry negati per esaurimento del budget
+        self.by_class = {}          # tentativi aggiuntivi per classe di errore
+
+    # Prenotazione di un retry (False se il budget è esaurito)
+    def try_spend(self, error_class: str) -> bool:
+        if self._remaining <= 0:
+            self.n_exhausted += 1
+            return False
+
+        self._remaining -= 1
+        self.n_retries += 1
+        self.by_class[error_class] = self.by_class.get(error_class, 0) + 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "n_retries": self.n_retries,
+            "n_retries_timeout": self.by_class.get("timeout", 0),
+            "n_retries_quota": self.by_class.get("quota", 0),
+            "n_retries_unavailable": self.by_class.get("unavailable", 0),
+            "n_retry_budget_exhausted": self.n_exhausted
+        }
+
+
+# C02 - Politica di retry: numero massimo di tentativi per classe di errore e attesa esponenziale con jitter ("full jitter")
+class RetryPolicy:
+    def __init__(self, max_attempts: dict, base_delay: float, max_delay: float):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    # Attesa prima del tentativo successivo al tentativo 'attempt' (da 1): uniforme in [0, min(max_delay, base_delay * 2^(attempt-1))]
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (attempt - 1)))
+
+    # Esecuzione della richiesta prodotta da 'request_factory', ritentata finché l'errore è transitorio e tentativi e budget lo consentono
+    async def run(self, request_factory, budget: RetryBudget):
+        attempt = 1
+        while True:
+            try:
+                return await request_factory()
+
+            except Exception as e:
+                error_class = classify_error(e)
+                if attempt >= self._max_attempts.get(error_class, 1) or not budget.try_spend(error_class):
+                    raise
+
+                delay = self.backoff(attempt)
+                res.logger.info(f"[retry|C02]\t\t-> Attempt {attempt} failed ({error_class}: {type(e).__name__}), retrying in {delay:.2f}s")
+
+            await asyncio.sleep(delay)  # attesa fuori dallo slot del limitatore: durante il backoff la concorrenza è libera per altre richieste
+            attempt += 1
+
+
+# F01 - Creazione della politica di retry secondo la configurazione corrente
+def get_retry_policy() -> RetryPolicy:
+    return RetryPolicy(res.retry_max_attempts, res.retry_base_delay, res.retry_max_delay)
+
+
+# F02 - Creazione del budget di retry di un batch, proporzionale al numero di richieste da inviare
+def create_retry_budget(n_requests: int) -> RetryBudget:
+    return RetryBudget(math.ceil(n_requests * res.retry_budget_ratio))
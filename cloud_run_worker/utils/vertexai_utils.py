@@ -38,10 +38,10 @@ def get_model() -> GenerativeModel:
 
 
 # F03 - Configuration (low temperature = more deterministic)
-def get_generation_config() -> GenerationConfig:
+def get_generation_config(max_output_tokens: int = 512) -> GenerationConfig:
     return GenerationConfig(
         temperature=0.2,
         top_p=1,
         top_k=1,
-        max_output_tokens=512
+        max_output_tokens=max_output_tokens
     )
@@ -1,16 +1,20 @@
 # VMS: Virtual Machine Server
 
-import os ,json, posixpath
+import os, time, asyncio
 import utils.gcs_utils as gcs
-import utils.io_utils as iou
 import utils.metrics_utils as mtr
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Query
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from utils.resource_manager import resource_manager as res
-from utils.cloud_utils import call_worker, enqueue_batch_analysis_tasks
-from utils.lock_utils import release_merge_lock
-from utils.metadata_utils import create_metadata, download_metadata, upload_metadata
+from utils.cloud_utils import call_worker, stream_worker, start_enqueue_job, get_enqueue_progress, get_http_client, close_http_client
+from utils.metadata_utils import ingest_dataset, download_metadata, upload_metadata
+from utils.result_utils import result_store, DEFAULT_PAGE_LIMIT
+from utils.progress_utils import read_progress
+from utils.run_utils import create_run, resolve_run, update_run, delete_run, STATUS_FAILED
+from utils.stream_utils import stream_hub
+from utils.storage_utils import storage
 
 
 
@@ -21,12 +25,14 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],    # TODO: prima di pushare in produzione, da sostituire con URL di API in frontend (compito Samu)
     allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
     allow_headers=["Content-Type", "Authorization"],
 )
 # Comando per lanciare il server:
 #   uvicorn app:app --host 0.0.0.0 --port 8000
 
+last_run_id = None  # ultima run avviata da questo server (default di '/batch-results-status' e '/analysis-stream')
+
 
 # F01 - Function 1
 @app.on_event("startup")
@@ -42,10 +48,20 @@ async def startup_event():
     
     # Upload file su GCS
     blob = res.bucket.blob(res.config_filename)
-    blob.upload_from_filename(path)
+    await storage.run("upload_config", blob.upload_from_filename, path)
 
     res.logger.info(f"[app|F01]\t\t-> File '{path}' uploaded to GCS as '/{res.config_filename}'")
 
+    # Client HTTP condiviso per le chiamate al worker (connessioni riusate tra le richieste)
+    get_http_client()
+
+
+# F02 - Rilascio delle connessioni del client HTTP condiviso e del thread pool dello storage
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    storage.shutdown()
+
 
 
 # == Endpoints ====================================================================================
@@ -71,29 +87,15 @@ async def health_check():
     return {"server (VMS)": "running", "worker (CRW)": msg}
 
 
-# E03 - Check numero di file result temporanei creati fino al momento della chiamata
+# E03 - Check dell'avanzamento dell'analisi (documenti di avanzamento pubblicati dal worker: nessun listing dei batch result file)
+#       Run indicata da 'run_id', oppure ultima run avviata su 'dataset_filename', oppure ultima run avviata da questo server
 @app.get("/batch-results-status")
-async def check_batch_results():
+async def check_batch_results(dataset_filename: str = Query(None), run_id: str = Query(None)):
     try:
-        blobs = res.bucket.list_blobs(prefix=res.gcs_batch_result_dir + "/")
-        count = 0
-        dataset_name = None
-        metadata = {}
-        
-        for blob in blobs:
-            filename = os.path.basename(blob.name)
-
-            if "_result_" in filename and filename.endswith(".jsonl"):
-                count += 1
-            
-                if not dataset_name:
-                    dataset_name = os.path.basename(blob.name).split("_result_")[0]     # es: "ABC_result_0.jsonl" -> "ABC"
-                    metadata = download_metadata(dataset_name) or {}
-        
-        if not dataset_name or not metadata:
-            raise ValueError(f"Undefined 'dataset_name' field. This field will be available once the first batch result file has been loaded. Try again in a few seconds")
+        metadata = await storage.run("resolve_run", resolve_run, dataset_filename, run_id or (None if dataset_filename else last_run_id))
         if not metadata:
-            raise FileNotFoundError(f"Metadata of '{dataset_name}' not found")
+            raise FileNotFoundError(f"Metadata of '{dataset_filename}' not found")
+        dataset_name = metadata["dataset_name"]
 
         batches = metadata.get("num_batches")
         if not isinstance(batches, int) or batches < 1:
@@ -102,13 +104,20 @@ async def check_batch_results():
                 "still processing, or missing metadata. Try again later or re-upload the dataset to regenerate metadata"
             )
 
+        progress = await read_progress(dataset_name, metadata)
+        count = progress["n_completed"]
+
         status = "pending" if count == 0 else "partial" if count < batches else "completed"
         completion_rate = f"{count}/{batches} batches analyzed" if batches > 0 else res.not_available
 
         return {
             "status": status,
             "completion_rate": completion_rate,
-            "dataset_name": dataset_name or res.not_available
+            "dataset_name": dataset_name or res.not_available,
+            "run_id": metadata.get("run_id", res.not_available),
+            "run_status": metadata.get("status", res.not_available),     # 'running', 'merging' o 'completed' (merge handler)
+            "enqueue": get_enqueue_progress(metadata) or res.not_available,
+            **progress
         }
 
     except Exception as e:
@@ -117,14 +126,44 @@ async def check_batch_results():
         raise HTTPException(status_code=500, detail=msg)
 
 
+# E03B - Stream (Server-Sent Events) dell'avanzamento dell'analisi e degli alert classificati di ogni batch completato
+#        Eventi: 'progress' (stessi campi di '/batch-results-status'), 'batch' ({ batch_id, alerts }), 'completed', 'error'
+@app.get("/analysis-stream")
+async def analysis_stream(dataset_filename: str = Query(None), run_id: str = Query(None)):
+    try:
+        metadata = await storage.run("resolve_run", resolve_run, dataset_filename, run_id or (None if dataset_filename else last_run_id))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"[app|E03B]\t\t-> {str(e)}")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if not isinstance(metadata.get("num_batches"), int):
+        raise HTTPException(status_code=404, detail=f"[app|E03B]\t\t-> No analysis started on '{dataset_filename}'")
+
+    return StreamingResponse(
+        stream_hub.events(metadata),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 
 # -- ANALISI ALERT --------------------------------------------------------------------------------
 
-# E04 - Analisi singolo alert
+# E04 - Analisi singolo alert. Con 'stream=true' (o 'Accept: text/event-stream') la risposta del worker è inoltrata man mano
+#       che viene generata, come flusso SSE: eventi 'token' ({"text"}), poi 'done' ({"explanation", "stats"}) oppure 'error' ({"detail"})
 @app.post("/chat")
-async def chat(request: Request):
+async def chat(request: Request, stream: bool = False):
     try:
         data = await request.json() # question, data
+
+        if stream or "text/event-stream" in request.headers.get("accept", ""):
+            return StreamingResponse(
+                await stream_worker(url=f"{res.worker_url}/run-chatbot?stream=true", json=data, read_timeout=res.chat_read_timeout),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
         return await call_worker(
             method="POST",
             url=f"{res.worker_url}/run-chatbot",
@@ -150,22 +189,15 @@ async def upload_dataset(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail=msg)
     
     try:
-        # Upload dataset
-        data = await file.read()
-        dataset_path = posixpath.join(res.gcs_dataset_dir, dataset_filename)
-        res.bucket.blob(dataset_path).upload_from_string(data, content_type=file.content_type)
+        # Upload dataset in streaming, con calcolo di metadati, indice delle righe e hash del contenuto nella stessa passata
+        metadata = await ingest_dataset(file, dataset_filename)
+        dataset_path = metadata["dataset_path"]
 
         res.logger.info(f"[app|E05]\t\t-> Dataset file '{dataset_filename}' uploaded to '{dataset_path}'")
 
         # Upload metadata dataset
-        metadata = create_metadata(dataset_filename)
         metadata_path = gcs.get_blob_path(res.gcs_dataset_dir, dataset_filename, "metadata", "json")
-        
-        blob = res.bucket.blob(metadata_path)
-        blob.upload_from_string(
-            json.dumps(metadata, indent=2),
-            content_type="application/json"
-        )
+        await storage.run("upload_metadata", upload_metadata, dataset_filename, metadata)
 
         res.logger.info(f"[app|E05]\t\t-> Metadata uploaded to '{metadata_path}'")
 
@@ -183,32 +215,46 @@ async def upload_dataset(file: UploadFile = File(...)):
 
 
 # E06 - Analisi dataset remoto (già caricato su GCS tramite '/upload-alerts')
+#       Ogni analisi è una run con un proprio ID e un proprio spazio su GCS ('runs/<run_id>/'): nessuna pulizia di directory condivise,
+#       quindi più dataset (o più analisi dello stesso dataset) possono essere elaborati in parallelo dagli stessi worker
 @app.get("/analyze-dataset")
 async def analyze_dataset(dataset_filename: str = Query(...)):
     try:
-        # Pulizia e preparazione
-        await gcs.empty_dir(res.gcs_batch_metrics_dir)  # svuotamento directory dei batch metrics file
-        await gcs.empty_dir(res.gcs_batch_result_dir)   # svuotamento directory dei batch result file
-        release_merge_lock()                            # uscita del merge handler dalla sospensione delle sue attività (eliminazione flag)
-        res.logger.info("[app|E06]\t\t-> Directory emptied and lock released")
-
-        # Lettura metadati del dataset
-        metadata = download_metadata(dataset_filename)
-        batch_size = res.batch_size                 # letto qui per avere il valore più recente/aggiornato (invece che in 'create_metadata')
+        # Lettura metadati del dataset (operazioni su GCS nel thread pool dello storage: l'event loop resta libero)
+        metadata = await storage.run("download_metadata", download_metadata, dataset_filename)
+        batch_size = res.batch_size                 # letto qui per avere il valore più recente/aggiornato (invece che in 'ingest_dataset')
         n_batches = max(1, (metadata["num_rows"] + batch_size - 1) // batch_size)
 
         metadata["num_batches"] = n_batches         # assegnazione dei dati mancanti
         metadata["batch_size"] = batch_size
+        metadata["analysis_started_at"] = time.time()  # riferimento per velocità e tempo stimato in '/batch-results-status'
+
+        run = await storage.run("create_run", create_run, metadata)    # documento di stato della run (numero e dimensione dei batch propri della run)
+        metadata["run_id"] = run["run_id"]          # ultima run avviata sul dataset (default delle richieste senza 'run_id')
+
+        try:
+            await storage.run("upload_metadata", upload_metadata, dataset_filename, metadata)   # upload dei nuovi metadati su GCS
+            res.logger.info("[app|E06]\t\t-> Metadata updated and uploaded on GCS")
 
-        upload_metadata(dataset_filename, metadata) # upload dei nuovi metadati su GCS
-        res.logger.info("[app|E06]\t\t-> Metadata updated and uploaded on GCS")
+            # Creazione e analisi dei singoli batch tramite Cloud Task (in background: la risposta non attende l'accodamento)
+            enqueue_progress = start_enqueue_job(run)
 
-        # Creazione e analisi dei singoli batch tramite Cloud Task
-        enqueue_batch_analysis_tasks(metadata)
+        except Exception as e:
+            # Run creata ma mai avviata: segnata come fallita, invece di restare "running" per sempre
+            try:
+                await storage.run("update_run", update_run, run["run_id"], status=STATUS_FAILED, error=f"{type(e).__name__}: {str(e)}")
+            except Exception as update_error:
+                res.logger.warning(f"[app|E06]\t\t-> Failed to mark run '{run['run_id']}' as failed ({type(update_error).__name__}): {str(update_error)}")
+            raise
+
+        global last_run_id
+        last_run_id = run["run_id"]
 
         return {
             "status": "analysis started",
-            "message": "Metadata extracted successfully. Batch slicing has been started in the background",
+            "run_id": run["run_id"],
+            "message": "Metadata extracted successfully. Batch tasks are being enqueued in the background",
+            "enqueue": enqueue_progress,
             "metadata": metadata
         }
     
@@ -219,17 +265,76 @@ async def analyze_dataset(dataset_filename: str = Query(...)):
 
 
 # E07 - Visualizzazione file con alert classificati
+#       Senza parametri restituisce l'intera lista (comportamento originale); con almeno un filtro o parametro di paginazione restituisce
+#       una pagina { items, total, offset, limit, next_cursor }. 'cursor' = 'next_cursor' della pagina precedente (paginazione per ID)
+#       Con 'run_id' sono letti i risultati di quella run, altrimenti gli ultimi pubblicati per il dataset
 @app.get("/result")
-def get_result(dataset_filename: str = Query(...)):
-    blob_path = gcs.get_blob_path(res.gcs_result_dir, dataset_filename, "result", "json")
-    local_path = res.vms_result_path
+def get_result(
+    dataset_filename: str = Query(...),
+    run_id: str = Query(None),
+    offset: int = Query(None, ge=0),
+    limit: int = Query(None, ge=1),
+    alert_class: str = Query(None, alias="class"),
+    time_from: float = Query(None),
+    time_to: float = Query(None),
+    alert_id: int = Query(None, alias="id"),
+    cursor: int = Query(None)
+):
+    paginated = any(p is not None for p in (offset, limit, alert_class, time_from, time_to, alert_id, cursor))
+
+    try:
+        page = result_store.query(
+            dataset_filename,
+            alert_class=alert_class,
+            time_from=time_from,
+            time_to=time_to,
+            alert_id=alert_id,
+            cursor=cursor,
+            offset=offset or 0,
+            limit=min(limit or DEFAULT_PAGE_LIMIT, res.result_page_max_limit) if paginated else None,
+            run_id=run_id
+        )
+        return page if paginated else page["items"]
+
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        msg = f"[app|E07]\t\t-> Failed to read results of '{dataset_filename}' ({type(e).__name__}): {str(e)}"
+        res.logger.error(msg)
+        raise HTTPException(status_code=500, detail=msg)
 
+
+# E08 - Stato di una run: documento della run (stato del merge, percorsi dei risultati) e avanzamento dei batch
+@app.get("/runs/{run_id}")
+async def get_run_status(run_id: str):
     try:
-        # Lettura dati
-        gcs.download_to(blob_path, local_path)
-        return iou.read_json(local_path)
+        run = await storage.run("resolve_run", resolve_run, run_id=run_id)
+        return {**run, "enqueue": get_enqueue_progress(run), "progress": await read_progress(run["dataset_name"], run)}
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        msg = f"[app|E07]\t\t-> Failed to read '{local_path}' ({type(e).__name__}): {str(e)}"
+        msg = f"[app|E08]\t\t-> {type(e).__name__}: {str(e)}"
+        res.logger.error(msg)
+        raise HTTPException(status_code=500, detail=msg)
+
+
+# E09 - Eliminazione dei file di una run (batch, manifest, avanzamento e risultati propri della run; gli ultimi risultati pubblicati restano)
+@app.delete("/runs/{run_id}")
+async def remove_run(run_id: str):
+    try:
+        await delete_run(run_id)
+        await asyncio.to_thread(result_store.drop_run, run_id)     # cache SQLite locale della run (attende un'eventuale costruzione in corso)
+        return {"status": "deleted", "run_id": run_id}
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        msg = f"[app|E09]\t\t-> {type(e).__name__}: {str(e)}"
         res.logger.error(msg)
         raise HTTPException(status_code=500, detail=msg)
 
@@ -240,5 +345,23 @@ def get_result(dataset_filename: str = Query(...)):
 # E10 - Aggiornamento variabili d'ambiente modificate a runtime (in particolare, dal benchmark)
 @app.get("/reload-config")
 async def reload_config():
-    res.reload_config()
+    await storage.run("reload_config", res.reload_config)
     return {"message": "Resource manager reloaded"}
+
+
+# E11 - Statistiche delle chiamate a GCS eseguite dagli endpoint asincroni (chiamate, errori, latenze e attesa in coda per operazione)
+@app.get("/storage-stats")
+async def storage_stats():
+    return storage.stats()
+
+
+# E12 - Statistiche della cache delle risposte '/chat' del worker (per istanza di Cloud Run: quella che riceve la richiesta)
+@app.get("/chat-cache-stats")
+async def chat_cache_stats():
+    try:
+        return await call_worker(method="GET", url=f"{res.worker_url}/chat-cache-stats")
+
+    except Exception as e:
+        msg = f"[app|E12]\t\t-> {type(e).__name__}: {str(e)}"
+        res.logger.error(msg)
+        raise HTTPException(status_code=500, detail=msg)
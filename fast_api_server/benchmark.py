@@ -10,6 +10,7 @@ from utils.benchmark_utils import run_benchmark
 
 DEFAULT_BATCH_SIZE_SUP = 250
 DEFAULT_MAX_REQS_SUP = 16
+DEFAULT_PACK_SIZE_SUP = 20
 
 app = FastAPI()
 # Comando per lanciare il server:
@@ -26,7 +27,10 @@ def start_benchmark(
     batch_size_step: int = Query(1),
     max_reqs_inf: int = Query(1),
     max_reqs_sup: int = Query(DEFAULT_MAX_REQS_SUP),
-    max_reqs_step: int = Query(1)
+    max_reqs_step: int = Query(1),
+    pack_size_inf: int = Query(1),
+    pack_size_sup: int = Query(1),
+    pack_size_step: int = Query(1)
 ):
     if batch_size_sup > DEFAULT_BATCH_SIZE_SUP:
         msg = f"[benchmark|E01]\t-> 'sup_batch_size' cannot exceed {DEFAULT_BATCH_SIZE_SUP}"
@@ -36,6 +40,10 @@ def start_benchmark(
         msg = f"[benchmark|E01]\t-> 'sup_max_reqs' cannot exceed {DEFAULT_MAX_REQS_SUP}"
         res.logger.error(msg)
         raise HTTPException(status_code=400, detail=msg)
+    if pack_size_sup > DEFAULT_PACK_SIZE_SUP:
+        msg = f"[benchmark|E01]\t-> 'pack_size_sup' cannot exceed {DEFAULT_PACK_SIZE_SUP}"
+        res.logger.error(msg)
+        raise HTTPException(status_code=400, detail=msg)
     
 
     background_tasks.add_task(
@@ -46,7 +54,10 @@ def start_benchmark(
         batch_size_step,
         max_reqs_inf,
         max_reqs_sup,
-        max_reqs_step
+        max_reqs_step,
+        pack_size_inf,
+        pack_size_sup,
+        pack_size_step
     )
 
     return {"message": "Benchmark started in background. Keep an eye on the server log to spot eventual errors"}
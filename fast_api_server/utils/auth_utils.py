@@ -1,17 +1,80 @@
 # Auth Utils: modulo dedicato alla gestione dell'autenticazione delle richieste HTTP
 
+import json, time, base64, asyncio
+
+from urllib.parse import urlsplit
 from google.auth.transport.requests import Request as GoogleRequest
 from google.oauth2 import id_token
 from utils.resource_manager import resource_manager as res
 
 
-# F01 - Creazione header per chiamate al runner su Cloud Run
-def get_auth_header(audience_url: str) -> dict:
+TOKEN_REFRESH_MARGIN = 300  # secondi prima della scadenza in cui il token viene rinnovato in background (durata tipica: 1 ora)
+TOKEN_DEFAULT_TTL = 3000    # durata assunta se la scadenza non è leggibile dal token
+
+
+# F01 - Audience del token per un URL di Cloud Run: l'origine del servizio (un solo token per tutti gli endpoint del worker)
+def get_audience(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+# F02 - Richiesta di un nuovo ID token (chiamata bloccante: da eseguire fuori dall'event loop) e lettura della sua scadenza
+def fetch_token(audience: str) -> tuple[str, float]:
+    token = id_token.fetch_id_token(GoogleRequest(), audience)
+
     try:
-        auth_req = GoogleRequest()
-        token = id_token.fetch_id_token(auth_req, audience_url)
+        payload = token.split(".")[1]
+        expires_at = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"]
+    except Exception:
+        expires_at = time.time() + TOKEN_DEFAULT_TTL
+
+    return token, expires_at
+
+
+# C01 - Cache degli ID token per audience: un token valido viene riusato; a meno di 'TOKEN_REFRESH_MARGIN' secondi dalla scadenza
+#       è rinnovato in background (le richieste continuano a usare quello corrente), e solo un token scaduto fa attendere la richiesta
+class TokenCache:
+    def __init__(self):
+        self._tokens = {}       # audience -> (token, istante di scadenza)
+        self._locks = {}        # audience -> lock del rinnovo (richieste concorrenti attendono un solo rinnovo)
+        self._refreshing = {}   # audience -> rinnovo anticipato in corso
+
+    # Creazione header per chiamate al worker su Cloud Run
+    async def get_auth_header(self, url: str) -> dict:
+        audience = get_audience(url)
+        token, expires_at = self._tokens.get(audience, (None, 0))
+        remaining = expires_at - time.time()
+
+        if remaining <= 0:
+            token = await self._refresh(audience)
+        elif remaining < TOKEN_REFRESH_MARGIN and audience not in self._refreshing:
+            self._refreshing[audience] = asyncio.create_task(self._refresh(audience, background=True))
+
         return {"Authorization": f"Bearer {token}"}
-    
-    except Exception as e:
-        res.logger.error(f"[auth][F01]\t\t-> Failed to create authentication header ({type(e).__name__}): {str(e)}")
-        raise
+
+
+    async def _refresh(self, audience: str, background: bool = False) -> str | None:
+        lock = self._locks.setdefault(audience, asyncio.Lock())
+
+        try:
+            async with lock:
+                token, expires_at = self._tokens.get(audience, (None, 0))
+                if expires_at - time.time() >= TOKEN_REFRESH_MARGIN:
+                    return token    # rinnovato da un'altra richiesta mentre questa era in attesa del lock
+
+                token, expires_at = await asyncio.to_thread(fetch_token, audience)
+                self._tokens[audience] = (token, expires_at)
+                return token
+
+        except Exception as e:
+            res.logger.error(f"[auth|C01]\t\t-> Failed to create authentication header ({type(e).__name__}): {str(e)}")
+            if not background:  # un rinnovo anticipato fallito non blocca nulla: il token corrente resta valido fino alla scadenza
+                raise
+
+        finally:
+            if background:
+                self._refreshing.pop(audience, None)
+
+
+# Istanza singletone da far importare agli altri moduli
+token_cache = TokenCache()
@@ -24,7 +24,10 @@ async def run_benchmark(
     batch_size_step,
     max_reqs_inf,
     max_reqs_sup,
-    max_reqs_step
+    max_reqs_step,
+    pack_size_inf=1,
+    pack_size_sup=1,
+    pack_size_step=1
 ):
     # Eliminazione di eventuali flag residue
     if os.path.exists(res.vms_benchmark_stop_flag):
@@ -42,6 +45,7 @@ async def run_benchmark(
     
     curr_batch_size = batch_size_inf
     curr_max_reqs = max_reqs_inf
+    curr_pack_size = pack_size_inf
     
     # Salvataggio backup del file 'config.json' e aggiornamento di contesto del benchmark
     backup_config()
@@ -54,76 +58,84 @@ async def run_benchmark(
         max_reqs=curr_max_reqs,
         max_reqs_sup=max_reqs_sup,
         max_reqs_step=max_reqs_step,
+        pack_size=curr_pack_size,
+        pack_size_sup=pack_size_sup,
+        pack_size_step=pack_size_step,
         status="running"
     )
     
     revised_batch_size_sup = min(batch_size_sup, tot_alerts)
-    while curr_batch_size <= revised_batch_size_sup:
-        curr_max_reqs = 4 if curr_batch_size > 100 else max_reqs_inf
-        # NB: all'aumentare della dimensione dei batch, il numero di thread paralleli viene resettato a un nuovo limite inferiore pari a 4.
-        #     Questo permette di velocizzare i tempi e di non considerare i casi estremi in cui viene elaborato un batch da centinaia
-        #     di alert sequenzialmente.
+    while curr_pack_size <= pack_size_sup:
+        curr_batch_size = batch_size_inf    # ogni dimensione dei pacchetti di alert per prompt ripercorre l'intera griglia batch size x max reqs
+        while curr_batch_size <= revised_batch_size_sup:
+            curr_max_reqs = 4 if curr_batch_size > 100 else max_reqs_inf
+            # NB: all'aumentare della dimensione dei batch, il numero di thread paralleli viene resettato a un nuovo limite inferiore pari a 4.
+            #     Questo permette di velocizzare i tempi e di non considerare i casi estremi in cui viene elaborato un batch da centinaia
+            #     di alert sequenzialmente.
         
-        while curr_max_reqs <= max_reqs_sup:
-            if check_stop_flag():
-                res.logger.info("[benchmark|F01]\t-> Benchmark execution interrupted by stop flag")
-                return
-
-            # Aggiornamento variabili d'ambiente su JSON
-            await update_config_json(curr_batch_size, curr_max_reqs)
-            update_benchmark_context(
-                tot_alerts=tot_alerts,
-                batch_size=curr_batch_size,
-                max_reqs=curr_max_reqs,
-                last_request=f"/{DATASET_ANALYSIS}" # specificata qui per l'ampio transitorio che separa richiesta e risposta (potrebbe creare inconsistenza tra contesto e ciò che sta realmente accadendo)
-            )
-
-            # Invio richiesta HTTP ad '/analyze-dataset'
-            res.logger.info(f"[benchmark|F01]\t-> Sending request to '/{DATASET_ANALYSIS}'")
-            requests.get(f"http://localhost:8000/{DATASET_ANALYSIS}?dataset_filename={dataset_filename}", timeout=30)   # da far invocare al benchmark in esecuzione come server alternativo su una porta diversa, altrimenti deadlock
-
-            # Polling su '/monitor-batch-results'
-            update_benchmark_context(last_request=f"/{RESULTS_CHECK}", status="polling")
-            attempts = 0
-            while True:
+            while curr_max_reqs <= max_reqs_sup:
                 if check_stop_flag():
                     res.logger.info("[benchmark|F01]\t-> Benchmark execution interrupted by stop flag")
                     return
+
+                # Aggiornamento variabili d'ambiente su JSON
+                await update_config_json(curr_batch_size, curr_max_reqs, curr_pack_size)
+                update_benchmark_context(
+                    tot_alerts=tot_alerts,
+                    batch_size=curr_batch_size,
+                    max_reqs=curr_max_reqs,
+                    pack_size=curr_pack_size,
+                    last_request=f"/{DATASET_ANALYSIS}" # specificata qui per l'ampio transitorio che separa richiesta e risposta (potrebbe creare inconsistenza tra contesto e ciò che sta realmente accadendo)
+                )
+
+                # Invio richiesta HTTP ad '/analyze-dataset'
+                res.logger.info(f"[benchmark|F01]\t-> Sending request to '/{DATASET_ANALYSIS}'")
+                requests.get(f"http://localhost:8000/{DATASET_ANALYSIS}?dataset_filename={dataset_filename}", timeout=30)   # da far invocare al benchmark in esecuzione come server alternativo su una porta diversa, altrimenti deadlock
+
+                # Polling su '/monitor-batch-results'
+                update_benchmark_context(last_request=f"/{RESULTS_CHECK}", status="polling")
+                attempts = 0
+                while True:
+                    if check_stop_flag():
+                        res.logger.info("[benchmark|F01]\t-> Benchmark execution interrupted by stop flag")
+                        return
                 
-                response = requests.get(f"http://localhost:8000/{RESULTS_CHECK}")
+                    response = requests.get(f"http://localhost:8000/{RESULTS_CHECK}?dataset_filename={dataset_filename}")
                 
-                # Gestione errori (sia i 404 previsti che quelli di natura ignota)
-                if response.status_code != 200:             # NB: gli errori 404 previsti sono quelli che si verificano quando non è presente alcun file nella dir GCS '/batch_results' (risultati non ancora pronti)
-                    if attempts >= MAX_POLLING_ATTEMPTS:    # non viene usato un 'while(true)' per prevenire eventuali loop infiniti in presenza di errori ignoti
-                        update_benchmark_context(status="error")
-                        restore_config()
-                        res.logger.error(f"[benchmark|F01]\t-> Polling failed: '/{RESULTS_CHECK}' returned status {response.status_code}")
-                        return
+                    # Gestione errori (sia i 404 previsti che quelli di natura ignota)
+                    if response.status_code != 200:             # NB: gli errori 404 previsti sono quelli che si verificano quando non è presente alcun file nella dir GCS '/batch_results' (risultati non ancora pronti)
+                        if attempts >= MAX_POLLING_ATTEMPTS:    # non viene usato un 'while(true)' per prevenire eventuali loop infiniti in presenza di errori ignoti
+                            update_benchmark_context(status="error")
+                            restore_config()
+                            res.logger.error(f"[benchmark|F01]\t-> Polling failed: '/{RESULTS_CHECK}' returned status {response.status_code}")
+                            return
                     
-                    res.logger.warning(f"[benchmark|F01]\t-> Attempt {attempts + 1}/{MAX_POLLING_ATTEMPTS}: no batch results found yet")
-                    polling_period = 5 + attempts^2
-                    time.sleep(polling_period if polling_period < 60 else 60)   # attesa esponenziale, con limite superiore fissato a 60
-                    attempts += 1
-                    continue
+                        res.logger.warning(f"[benchmark|F01]\t-> Attempt {attempts + 1}/{MAX_POLLING_ATTEMPTS}: no batch results found yet")
+                        polling_period = 5 + attempts^2
+                        time.sleep(polling_period if polling_period < 60 else 60)   # attesa esponenziale, con limite superiore fissato a 60
+                        attempts += 1
+                        continue
                 
-                if response.json().get("status") == "completed":
-                    break
+                    if response.json().get("status") == "completed":
+                        break
                 
-                res.logger.info("[benchmark|F01]\t-> Waiting to get all the batch result files")
-                time.sleep(15 if tot_alerts < 500 else 30)
+                    res.logger.info("[benchmark|F01]\t-> Waiting to get all the batch result files")
+                    time.sleep(15 if tot_alerts < 500 else 30)
 
-            res.logger.info(f"[benchmark|F01]\t-> Dataset analysis completed. Waiting 30 seconds as inter-analysis buffer")
-            update_benchmark_context(status="running")
+                res.logger.info(f"[benchmark|F01]\t-> Dataset analysis completed. Waiting 30 seconds as inter-analysis buffer")
+                update_benchmark_context(status="running")
 
-            curr_max_reqs = get_next_val(curr=curr_max_reqs, sup=max_reqs_sup, step=max_reqs_step)
-            if curr_batch_size != revised_batch_size_sup or curr_max_reqs != max_reqs_sup:  # se è l'ultima iterazione, non attendo
-                time.sleep(30)  # man mano che si inviano richieste senza sosta, i tempi d'elaborazione si allungano. Una breve pausa intermedia aiuta a tornare in margini accettabili
+                curr_max_reqs = get_next_val(curr=curr_max_reqs, sup=max_reqs_sup, step=max_reqs_step)
+                if curr_batch_size != revised_batch_size_sup or curr_max_reqs != max_reqs_sup or curr_pack_size != pack_size_sup:  # se è l'ultima iterazione, non attendo
+                    time.sleep(30)  # man mano che si inviano richieste senza sosta, i tempi d'elaborazione si allungano. Una breve pausa intermedia aiuta a tornare in margini accettabili
 
-        curr_batch_size = get_next_val(curr=curr_batch_size, sup=revised_batch_size_sup, step=batch_size_step)
+            curr_batch_size = get_next_val(curr=curr_batch_size, sup=revised_batch_size_sup, step=batch_size_step)
+
+        curr_pack_size = get_next_val(curr=curr_pack_size, sup=pack_size_sup, step=pack_size_step)
 
     restore_config()
     update_benchmark_context(status="completed")
-    res.logger.info(f"[benchmark|F01]\t-> Benchmark naturally completed with batch size {curr_batch_size-1}/{revised_batch_size_sup} and max reqs {curr_max_reqs-1}/{max_reqs_sup}")
+    res.logger.info(f"[benchmark|F01]\t-> Benchmark naturally completed with batch size {curr_batch_size-1}/{revised_batch_size_sup}, max reqs {curr_max_reqs-1}/{max_reqs_sup} and pack size {curr_pack_size-1}/{pack_size_sup}")
 
 
 # F02 - Salvataggio di variabili d'ambiente originali in un file copia temporaneo
@@ -146,7 +158,7 @@ def restore_config():
 
 
 # F04 - Aggiornamento variabili d'ambiente in 'config.json'
-async def update_config_json(batch_size, max_reqs):
+async def update_config_json(batch_size, max_reqs, pack_size=1):
     local_path = res.vms_config_path
     blob_path = res.config_filename
 
@@ -156,6 +168,8 @@ async def update_config_json(batch_size, max_reqs):
 
     config["batch_size"] = batch_size
     config["max_concurrent_requests"] = max_reqs
+    config["prompt_pack_size"] = pack_size
+    config["adaptive_concurrency"] = False  # il benchmark misura livelli di concorrenza fissi: il limitatore adattivo li altererebbe
 
     # Aggiornamento 'config.json' locale e remoto
     iou.write_json(config, local_path)      # scrittura file locale
@@ -171,7 +185,7 @@ async def update_config_json(batch_size, max_reqs):
         res.logger.error(msg)
         raise HTTPException(status_code=500, detail=msg)
 
-    res.logger.info(f"[benchmark|F04]\t-> File '{res.config_filename}' updated (batch_size: {batch_size}, max_concurrent_reqs: {max_reqs})")
+    res.logger.info(f"[benchmark|F04]\t-> File '{res.config_filename}' updated (batch_size: {batch_size}, max_concurrent_reqs: {max_reqs}, prompt_pack_size: {pack_size})")
 
 # F05 - Salvataggio contesto del benchmark
 def update_benchmark_context(
@@ -183,6 +197,9 @@ def update_benchmark_context(
     max_reqs=None,
     max_reqs_sup=None,
     max_reqs_step=None,
+    pack_size=None,
+    pack_size_sup=None,
+    pack_size_step=None,
     last_request=None,
     status=None
 ):
@@ -220,6 +237,15 @@ def update_benchmark_context(
     if max_reqs_step is not None:
         context["max_reqs_step"] = max_reqs_step
 
+    if pack_size is not None or pack_size_sup is not None:
+        current_val = context.get("prompt_pack_size", "0/0").split("/")
+        new_val = pack_size if pack_size is not None else int(current_val[0])
+        new_val_sup = pack_size_sup if pack_size_sup is not None else int(current_val[1])
+        context["prompt_pack_size"] = f"{new_val}/{new_val_sup}"
+
+    if pack_size_step is not None:
+        context["pack_size_step"] = pack_size_step
+
     if last_request is not None:
         context["last_request"] = last_request  # ultima richiesta HTTP inviata
 
@@ -0,0 +1,135 @@
+# Cache Utils: modulo per la cache locale (memoria + disco) dei blob GCS letti di frequente dal server
+
+import os, time, atexit, hashlib, tempfile, threading
+
+from collections import OrderedDict
+from google.api_core.exceptions import NotFound, NotModified
+from utils.resource_manager import resource_manager as res
+
+
+# C01 - Cache dei blob indicizzata per percorso e generation: entro 'blob_cache_ttl' secondi il contenuto è servito localmente,
+#       poi viene rivalidato con un download condizionato ('if_generation_not_match'), che trasferisce dati solo se il blob è cambiato.
+#       Il TTL (10s) è più lungo dell'intervallo di polling di progressi e stream: i blob scritti dal server passano da 'put' e sono
+#       subito aggiornati, mentre i progressi scritti dal worker compaiono con al più 'blob_cache_ttl' secondi di ritardo
+class BlobCache:
+    def __init__(self):
+        self._entries = OrderedDict()   # percorso -> {"generation", "checked_at", "data" (None se solo su disco), "file", "size"}, in ordine LRU
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        # La cache su disco è legata al processo: ogni processo usa una propria cartella sotto 'vms_blob_cache_dir' e alla chiusura
+        # rimuove solo i file che ha scritto (la radice configurata può essere condivisa o contenere altro)
+        os.makedirs(res.vms_blob_cache_dir, exist_ok=True)
+        self._cache_dir = tempfile.mkdtemp(prefix="blob_cache_", dir=res.vms_blob_cache_dir)
+        atexit.register(self.close)
+
+    # Contenuto di un blob (FileNotFoundError se non esiste, senza chiamate 'exists()' separate)
+    def read_bytes(self, path: str) -> bytes:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and time.monotonic() - entry["checked_at"] < res.blob_cache_ttl:
+                data = self._load(path, entry)
+                if data is not None:
+                    return data
+                entry = None    # file su disco rimosso esternamente: nuovo download
+
+        blob = res.bucket.blob(path)
+        try:
+            if entry is not None:
+                data = blob.download_as_bytes(if_generation_not_match=entry["generation"])
+            else:
+                data = blob.download_as_bytes()
+
+        except NotModified:     # blob invariato: il contenuto locale resta valido per un altro 'blob_cache_ttl'
+            with self._lock:
+                entry["checked_at"] = time.monotonic()
+                data = self._load(path, entry)
+            return data if data is not None else self.read_bytes(path)
+
+        except NotFound:
+            self.invalidate(path)
+            raise FileNotFoundError(f"Remote file '{path}' not found")    # log a carico del chiamante (per alcuni file l'assenza è attesa)
+
+        self.put(path, blob.generation, data)
+        return data
+
+    # Inserimento (o sostituzione) del contenuto di un blob, es: subito dopo averlo caricato su GCS
+    def put(self, path: str, generation: int, data: bytes):
+        with self._lock:
+            self._remove(path)  # prima della scrittura: la versione precedente può avere lo stesso nome di file (stessa generation)
+
+        file_path = os.path.join(self._cache_dir, f"{hashlib.sha1(path.encode()).hexdigest()}_{generation}")
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            keep_in_memory = len(data) <= res.blob_cache_max_item_bytes
+            self._entries[path] = {
+                "generation": generation,
+                "checked_at": time.monotonic(),
+                "data": data if keep_in_memory else None,
+                "file": file_path,
+                "size": len(data)
+            }
+            self._memory_bytes += len(data) if keep_in_memory else 0
+            self._disk_bytes += len(data)
+            self._evict()
+
+    # Rimozione di un blob dalla cache (es: blob eliminato o sovrascritto senza passare dalla cache)
+    def invalidate(self, path: str):
+        with self._lock:
+            self._remove(path)
+
+    # Rimozione dei file scritti dalla cache e della sua cartella (eseguita alla chiusura del processo)
+    def close(self):
+        with self._lock:
+            for path in list(self._entries):
+                self._remove(path)
+        try:
+            os.rmdir(self._cache_dir)   # non ricorsiva: eventuali file non scritti dalla cache restano al loro posto
+        except OSError:
+            pass
+
+
+    def _load(self, path: str, entry: dict) -> bytes | None:
+        if self._entries.get(path) is not entry:
+            return None     # entry sostituita o rimossa da un'altra richiesta nel frattempo
+        self._entries.move_to_end(path)
+        if entry["data"] is not None:
+            return entry["data"]
+
+        try:
+            with open(entry["file"], "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            self._remove(path)
+            return None
+
+    def _remove(self, path: str):
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return
+
+        self._memory_bytes -= entry["size"] if entry["data"] is not None else 0
+        self._disk_bytes -= entry["size"]
+        try:
+            os.remove(entry["file"])
+        except FileNotFoundError:
+            pass
+
+    # Eviction LRU: prima dalla memoria (il contenuto resta su disco), poi dal disco
+    def _evict(self):
+        for entry in self._entries.values():
+            if self._memory_bytes <= res.blob_cache_memory_bytes:
+                break
+            if entry["data"] is not None:
+                entry["data"] = None
+                self._memory_bytes -= entry["size"]
+
+        while self._disk_bytes > res.blob_cache_disk_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+
+# Istanza singletone da far importare agli altri moduli
+blob_cache = BlobCache()
@@ -1,27 +1,43 @@
 # Cloud Utils: modulo per la gestione delle comunicazioni server-worker (VSM-CRW)
 
-import json, httpx
+import json, time, httpx, random, asyncio, hashlib, importlib.util
 
 from google.cloud import tasks_v2
+from google.api_core.exceptions import AlreadyExists, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
 from utils.resource_manager import resource_manager as res
-from utils.auth_utils import get_auth_header
+from utils.auth_utils import token_cache
+from utils.run_utils import update_run
+from utils.storage_utils import storage
+from utils.stream_utils import format_event
 
 
-# F01 - Gestore chiamate al worker in esecuzione su Cloud Run
+ENQUEUE_MAX_ATTEMPTS = 5        # tentativi di creazione di un task (sicuri da ripetere: il nome del task è deterministico)
+ENQUEUE_RETRY_BASE_DELAY = 0.5  # attesa base (s) del backoff esponenziale tra i tentativi
+ENQUEUE_RETRY_ERRORS = (DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable)
+
+enqueue_jobs = {}           # run ID -> avanzamento dell'accodamento in corso (rimosso una volta salvato nel documento della run)
+_background_jobs = set()    # riferimenti ai job in background (altrimenti eliminabili dal garbage collector prima del termine)
+_tasks_client = None
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None    # HTTP/2 richiede il pacchetto opzionale 'h2' ('httpx[http2]')
+HTTP_MAX_CONNECTIONS = 100      # connessioni aperte al massimo dal client condiviso
+HTTP_MAX_KEEPALIVE = 20         # connessioni inattive mantenute aperte (riusate senza nuovo handshake TCP+TLS)
+HTTP_KEEPALIVE_EXPIRY = 60      # secondi dopo i quali una connessione inattiva viene chiusa
+HTTP_CONNECT_TIMEOUT = 10.0     # attesa massima (s) per aprire una connessione verso il worker
+_http_client = None
+
+
+# F01 - Gestore chiamate al worker in esecuzione su Cloud Run (client HTTP e ID token condivisi tra le chiamate)
 async def call_worker(method: str, url: str, json: dict = None, timeout: float = 30.0) -> dict:
-    headers = get_auth_header(url)
+    headers = await token_cache.get_auth_header(url)
 
     try:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            if method.upper() == "GET":
-                response = await client.get(url, headers=headers)
-            elif method.upper() == "POST":
-                response = await client.post(url, headers=headers, json=json)
-            else:
-                raise ValueError("[cloud|F01]\t\t-> Metodo HTTP non supportato")
-            
-            response.raise_for_status()
-            return response.json()
+        if method.upper() not in ("GET", "POST"):
+            raise ValueError("[cloud|F01]\t\t-> Metodo HTTP non supportato")
+
+        response = await get_http_client().request(method.upper(), url, headers=headers, json=json, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
 
     except httpx.RequestError as e:
         res.logger.error(f"[cloud|F01]\t\t-> Connection error ({type(e).__name__}): {str(e)}")
@@ -36,45 +52,199 @@ async def call_worker(method: str, url: str, json: dict = None, timeout: float =
         raise
 
 
-# F02 - Invio richieste multiple per l'analisi degli alert che compongono il batch
-def enqueue_batch_analysis_tasks(metadata: json):
-    client = tasks_v2.CloudTasksClient()
-    parent = client.queue_path(res.project_id, res.location, res.batch_analysis_queue_name)
+# F02 - Avvio in background dell'accodamento dei task di una run: l'endpoint risponde subito, l'avanzamento è consultabile
+#       tramite 'get_enqueue_progress' (e salvato nel documento della run al termine)
+def start_enqueue_job(run: dict) -> dict:
+    # Controllo campi (prima di rispondere: una run incompleta non viene avviata)
+    required_fields = ["run_id", "num_rows", "num_batches", "batch_size", "dataset_name", "dataset_path"]
+    missing = [field for field in required_fields if field not in run or run[field] is None]
 
-    # Controllo ed estrazione campi
-    required_fields = ["num_rows", "num_batches", "batch_size", "dataset_name", "dataset_path"]
-    missing = [field for field in required_fields if field not in metadata or metadata[field] is None]
-    
     if missing:
-        msg = f"Missing required fields: {', '.join(missing)}"
+        msg = f"[cloud|F02]\t\t-> Missing required fields: {', '.join(missing)}"
         res.logger.warning(msg)
-        raise httpx.HTTPException(status_code=500, detail=msg)
-
-    num_rows, num_batches, batch_size, dataset_name, dataset_path = (metadata[field] for field in required_fields)
-
-    # Invio richieste, una per batch
-    for i in range(num_batches):
-        payload = {
-            "batch_id": i,
-            "start_row": i * batch_size,
-            "end_row": min((i + 1) * batch_size, num_rows),
-            "batch_size": batch_size,
-            "dataset_name": dataset_name,
-            "dataset_path": dataset_path
-        }
+        raise ValueError(msg)
+
+    progress = {
+        "status": "enqueuing",
+        "n_total": run["num_batches"],
+        "n_enqueued": 0,
+        "n_already_existing": 0,    # task già creati da un tentativo precedente (stesso nome)
+        "n_failed": 0,
+        "started_at": time.time()
+    }
+    enqueue_jobs[run["run_id"]] = progress
+
+    job = asyncio.create_task(enqueue_batch_analysis_tasks(run, progress))
+    _background_jobs.add(job)
+    job.add_done_callback(_background_jobs.discard)
+    return progress
+
+
+# F03 - Avanzamento dell'accodamento di una run: quello in corso in questo processo, altrimenti quello salvato nel documento della run
+def get_enqueue_progress(run: dict) -> dict | None:
+    return enqueue_jobs.get(run.get("run_id")) or run.get("enqueue")
+
+
+# F04 - Invio richieste multiple per l'analisi degli alert che compongono il batch: un pool limitato di coroutine ('enqueue_concurrency')
+#       crea i task con il client asincrono di Cloud Tasks, senza bloccare l'event loop
+async def enqueue_batch_analysis_tasks(run: dict, progress: dict):
+    run_id = run["run_id"]
+    client = get_tasks_client()
+    parent = client.queue_path(res.project_id, res.location, res.batch_analysis_queue_name)
+    batch_ids = iter(range(run["num_batches"]))     # iteratore condiviso: ogni coroutine del pool preleva il prossimo batch libero
+
+    async def enqueue_worker():
+        for batch_id in batch_ids:
+            try:
+                if await create_batch_task(client, parent, run, batch_id):
+                    progress["n_already_existing"] += 1
+                progress["n_enqueued"] += 1
+            except Exception as e:
+                progress["n_failed"] += 1
+                progress["last_error"] = f"{type(e).__name__}: {str(e)}"
+                res.logger.error(f"[cloud|F04]\t\t-> Failed to enqueue batch {batch_id} of run '{run_id}' ({type(e).__name__}): {str(e)}")
+
+    try:
+        await asyncio.gather(*(enqueue_worker() for _ in range(max(1, min(res.enqueue_concurrency, run["num_batches"])))))
+        progress["status"] = "completed" if progress["n_failed"] == 0 else "failed"
+    except Exception as e:
+        progress["status"] = "failed"
+        progress["last_error"] = f"{type(e).__name__}: {str(e)}"
+        res.logger.error(f"[cloud|F04]\t\t-> Enqueue of run '{run_id}' aborted ({type(e).__name__}): {str(e)}")
+    finally:
+        progress["completed_at"] = time.time()
 
-        task = {
-            "http_request": {
-                "http_method": tasks_v2.HttpMethod.POST,
-                "url": f"{res.worker_url}/run-batch",
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps(payload).encode(),
-                "oidc_token": {
-                    "service_account_email": res.vm_service_account_email
-                }
+    res.logger.info(f"[cloud|F04]\t\t-> {progress['n_enqueued']}/{progress['n_total']} tasks created for run '{run_id}' in {progress['completed_at'] - progress['started_at']:.1f}s")
+
+    # Salvataggio dell'esito nel documento della run
+    try:
+        await storage.run("update_run", update_run, run_id, enqueue=progress)
+        enqueue_jobs.pop(run_id, None)
+    except Exception as e:
+        res.logger.error(f"[cloud|F04]\t\t-> Failed to save enqueue progress of run '{run_id}' ({type(e).__name__}): {str(e)}")
+
+
+# F05 - Creazione del task di un batch, con nome deterministico ('<hash>-<run_id>-<batch_id>', vedi F05B): un task ricreato dopo un errore transitorio
+#       (o da un nuovo tentativo di accodamento della stessa run) viene rifiutato da Cloud Tasks invece di essere duplicato.
+#       Restituisce True se il task esisteva già
+async def create_batch_task(client, parent: str, run: dict, batch_id: int) -> bool:
+    batch_size, num_rows = run["batch_size"], run["num_rows"]
+    payload = {
+        "batch_id": batch_id,
+        "start_row": batch_id * batch_size,
+        "end_row": min((batch_id + 1) * batch_size, num_rows),
+        "batch_size": batch_size,
+        "num_batches": run["num_batches"],  # per l'aggiornamento del documento di avanzamento (worker)
+        "progress_num_shards": run.get("progress_num_shards"),  # layout degli shard di avanzamento fissato nel documento della run
+        "dataset_name": run["dataset_name"],
+        "dataset_path": run["dataset_path"],
+        "index_path": run.get("index_path"),    # indice delle righe per la lettura ranged del batch (solo JSONL)
+        "run_id": run["run_id"]                 # spazio GCS della run ('runs/<run_id>/') in cui il worker scrive i propri file
+    }
+
+    task = {
+        "name": f"{parent}/tasks/{get_task_id(run['run_id'], batch_id)}",
+        "http_request": {
+            "http_method": tasks_v2.HttpMethod.POST,
+            "url": f"{res.worker_url}/run-batch",
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(payload).encode(),
+            "oidc_token": {
+                "service_account_email": res.vm_service_account_email
             }
         }
+    }
+
+    for attempt in range(ENQUEUE_MAX_ATTEMPTS):
+        try:
+            await client.create_task(parent=parent, task=task)
+            return False
+        except AlreadyExists:
+            return True
+        except ENQUEUE_RETRY_ERRORS:
+            if attempt == ENQUEUE_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(random.uniform(0, ENQUEUE_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+# F05B - ID deterministico del task di un batch ('<hash>-<run_id>-<batch_id>'): il prefisso hash distribuisce i nomi sullo spazio delle
+#        chiavi di Cloud Tasks (un prefisso sequenziale come il run ID, basato sull'orario, concentrerebbe i task su pochi intervalli)
+def get_task_id(run_id: str, batch_id: int) -> str:
+    task_id = f"{run_id}-{batch_id}"
+    return f"{hashlib.md5(task_id.encode()).hexdigest()[:8]}-{task_id}"
+
+
+# F06 - Client asincrono di Cloud Tasks, condiviso da tutti i job (creato alla prima richiesta, dentro l'event loop del server)
+def get_tasks_client() -> tasks_v2.CloudTasksAsyncClient:
+    global _tasks_client
+    if _tasks_client is None:
+        _tasks_client = tasks_v2.CloudTasksAsyncClient()
+    return _tasks_client
+
+
+# F07 - Client HTTP condiviso dal processo (pool di connessioni keep-alive, HTTP/2 se disponibile), creato all'avvio del server
+#       o alla prima chiamata (es: nel processo del benchmark)
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+        if not HTTP2_AVAILABLE:
+            res.logger.warning("[cloud|F07]\t\t-> Package 'h2' not installed: worker calls fall back to HTTP/1.1 (keep-alive pool)")
+    return _http_client
+
+
+# F08 - Chiusura del client HTTP condiviso (allo spegnimento del server)
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# F09 - Chiamata in streaming al worker (risposte SSE di '/run-chatbot?stream=true'): lo stato HTTP è verificato prima di restituire
+#       il flusso, così un errore del worker diventa un errore della richiesta; 'read_timeout' limita l'attesa tra due frammenti e non
+#       la durata complessiva della risposta (una risposta lunga non scade finché il modello continua a generare)
+async def stream_worker(url: str, json: dict, read_timeout: float):
+    headers = await token_cache.get_auth_header(url)
+    client = get_http_client()
+
+    try:
+        request = client.build_request(
+            "POST", url, headers=headers, json=json, timeout=httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT)
+        )
+        response = await client.send(request, stream=True)
+
+    except httpx.RequestError as e:
+        res.logger.error(f"[cloud|F09]\t\t-> Connection error ({type(e).__name__}): {str(e)}")
+        raise
+
+    try:
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        await response.aclose()
+        res.logger.error(f"[cloud|F09]\t\t-> Invalid HTTP response ({type(e).__name__}): {str(e)}")
+        raise
+
+    return relay_stream(response)
+
+
+# F10 - Inoltro dei frammenti (decodificati) di una risposta in streaming del worker, senza riassemblarli (un'interruzione a risposta avviata
+#       è segnalata al client con un evento 'error', lo stato HTTP è ormai già stato inviato)
+async def relay_stream(response: httpx.Response):
+    try:
+        async for chunk in response.aiter_bytes():   # contenuto già decodificato (gzip/br): il client riceve SSE in chiaro
+            yield chunk
 
-        client.create_task(parent=parent, task=task)
+    except httpx.HTTPError as e:
+        res.logger.error(f"[cloud|F10]\t\t-> Stream interrupted ({type(e).__name__}): {str(e)}")
+        yield format_event("error", {"detail": f"{type(e).__name__}: {str(e)}"}).encode()
 
-    res.logger.info(f"[cloud|F02]\t\t-> {num_batches} tasks created")
+    finally:
+        await response.aclose()
@@ -1,9 +1,12 @@
 # GCS Utils: modulo per la lettura/scrittura di file remoti e il download/upload
 
-import os, io, time, csv, json, asyncio, posixpath
+import os, io, csv, json, time, uuid, asyncio, posixpath
 
 from fastapi import HTTPException
+from google.api_core.exceptions import NotFound
 from utils.resource_manager import resource_manager as res
+from utils.cache_utils import blob_cache
+from utils.storage_utils import storage
 
 
 # F01 - Costruzione path remoto (usato in VMS per i file 'result', 'metrics' e 'metadata')
@@ -12,17 +15,22 @@ def get_blob_path(folder: str, dataset_filename: str, suffix: str, file_format:
     return posixpath.join(folder, f"{dataset_name}_{suffix}.{file_format}")
 
 
-# F02 - Lettura file JSON remoto
-def read_json(blob_path: str) -> list | dict:    # se nel file c'è un solo oggetto, sarà restituito un 'dict', altrimenti una 'list[dict]'
-    blob = res.bucket.blob(blob_path)
+# F01B - Directory di una cartella nello spazio di una run ('runs/<run_id>/<folder>'); senza run ID, la cartella condivisa (analisi avviate prima dei run ID)
+def get_run_dir(folder: str, run_id: str = None) -> str:
+    return posixpath.join(res.gcs_runs_dir, run_id, folder) if run_id else folder
 
-    if not blob.exists():
+
+# F02 - Lettura file JSON remoto (tramite la cache locale dei blob: nessun download se il blob non è cambiato)
+def read_json(blob_path: str) -> list | dict:    # se nel file c'è un solo oggetto, sarà restituito un 'dict', altrimenti una 'list[dict]'
+    try:
+        content = blob_cache.read_bytes(blob_path)
+    except FileNotFoundError:
         msg = f"[gcs|F02]\t\t-> Remote file '{blob_path}' not found"
         res.logger.error(msg)
         raise FileNotFoundError(msg)
-    
+
     try:
-        data = json.loads(blob.download_as_text())
+        data = json.loads(content)
     except Exception as e:
         msg = f"[gcs|F02]\t\t-> Failed to read remote JSON in '{blob_path}' ({type(e).__name__}): {str(e)}"
         res.logger.error(msg)
@@ -35,10 +43,12 @@ def read_json(blob_path: str) -> list | dict:    # se nel file c'è un solo ogge
 def write_json(data: dict, blob_path: str):
     try:
         blob = res.bucket.blob(blob_path)
+        content = json.dumps(data, indent=2).encode()
         blob.upload_from_string(
-            json.dumps(data, indent=2),
+            content,
             content_type='application/json'
         )
+        blob_cache.put(blob_path, blob.generation, content)    # la prossima lettura non richiede download
     except Exception as e:
         msg = f"[gcs|F03]\t\t-> Failed to write local JSON to '{blob_path}' ({type(e).__name__}): {str(e)}"
         res.logger.error(msg)
@@ -47,16 +57,18 @@ def write_json(data: dict, blob_path: str):
     res.logger.info(f"[gcs|F03]\t\t-> Local file JSON written to '{blob_path}'")
 
 
-# F04 - Download file remoto in locale
+# F04 - Download file remoto in locale (tramite la cache locale dei blob)
 def download_to(blob_path: str, local_path: str):
-    blob = res.bucket.blob(blob_path)
-    if not blob.exists():
+    try:
+        content = blob_cache.read_bytes(blob_path)
+    except FileNotFoundError:
         msg = f"[gcs|F04]\t\t-> Remote file '{blob_path}' not found"
         res.logger.error(msg)
         raise FileNotFoundError(msg)
-        
+
     try:
-        blob.download_to_filename(local_path)
+        with open(local_path, "wb") as f:
+            f.write(content)
     except Exception as e:
         msg = f"[gcs|F04]\t\t-> Failed to download '{blob_path}' to '{local_path}' ({type(e).__name__}): {str(e)}"
         res.logger.error(msg)
@@ -82,23 +94,21 @@ def upload_to(local_path: str, blob_path: str):
     res.logger.info(f"[gcs|F05]\t\t-> Local file '{local_path}' uploaded to '{blob_path}'")
 
 
-# F06 - Svuotamento directory remota
+# F06 - Svuotamento directory remota (listing ed eliminazioni nel thread pool dello storage, che ne limita anche la concorrenza)
 async def empty_dir(gcs_dir: str):    
-    blobs = list(res.bucket.list_blobs(prefix=f"{gcs_dir}/"))
-    loop = asyncio.get_running_loop()
-    semaphore = asyncio.Semaphore(16)
-
-    async def delete_blob_async(blob, loop, semaphore) -> int:
-        async with semaphore:
-            try:
-                await loop.run_in_executor(None, blob.delete)
-                return 1
-            except Exception as e:
-                res.logger.error(f"[gcs|F06]\t\t-> Error deleting blob '{blob.name}' ({type(e).__name__}): {str(e)}")
-                return 0
+    blobs = await storage.run("list_blobs", lambda: list(res.bucket.list_blobs(prefix=f"{gcs_dir}/")))
+
+    async def delete_blob_async(blob) -> int:
+        try:
+            await storage.run("delete_blob", blob.delete)
+            blob_cache.invalidate(blob.name)
+            return 1
+        except Exception as e:
+            res.logger.error(f"[gcs|F06]\t\t-> Error deleting blob '{blob.name}' ({type(e).__name__}): {str(e)}")
+            return 0
     
     tasks = [
-        delete_blob_async(blob, loop, semaphore)
+        delete_blob_async(blob)
         for blob in blobs
     ]
 
@@ -193,3 +203,41 @@ def remove_duplicate_rows():
         blob.upload_from_string(output_io.getvalue(), content_type='text/csv')
         res.logger.info(f"[GCS][remove_duplicates_in_dir] -> Cleaned duplicates in '{blob.name}'")
         time.sleep(3)   # attesa necessaria per ridurre l'overhead (altrimenti, errore 429)
+
+
+# C01 - Upload resumable a chunk su un oggetto temporaneo, pubblicato sul percorso finale solo a upload completato ('commit').
+#       Un 'BlobWriter' abbandonato dopo un errore viene comunque finalizzato dal garbage collector ('io.IOBase.__del__' -> 'close()'):
+#       scrivendo sul percorso finale, un upload interrotto sovrascriverebbe il file valido con uno parziale
+class StagedUpload:
+    def __init__(self, path: str, chunk_size: int, content_type: str = None):
+        self.path = path
+        self._tmp_blob = res.bucket.blob(f"{path}.tmp-{uuid.uuid4().hex[:8]}")
+        self._writer = self._tmp_blob.open("wb", chunk_size=chunk_size, content_type=content_type)
+
+    def write(self, data: bytes) -> int:
+        return self._writer.write(data)
+
+    # Finalizzazione dell'upload e copia lato server (rewrite, anche a più passi per oggetti grandi) sul percorso finale
+    def commit(self):
+        self._writer.close()
+
+        target = res.bucket.blob(self.path)
+        token, _, _ = target.rewrite(self._tmp_blob)
+        while token is not None:
+            token, _, _ = target.rewrite(self._tmp_blob, token=token)
+
+        self._delete_tmp()
+
+    # Annullamento: l'oggetto temporaneo è finalizzato subito (non più tardi dal garbage collector, dopo la sua eliminazione) ed eliminato
+    def abort(self):
+        try:
+            self._writer.close()
+            self._delete_tmp()
+        except Exception as e:  # l'errore originale resta quello da propagare
+            res.logger.warning(f"[gcs|C01]\t\t-> Failed to discard temporary upload of '{self.path}' ({type(e).__name__}): {str(e)}")
+
+    def _delete_tmp(self):
+        try:
+            self._tmp_blob.delete()
+        except NotFound:
+            pass
@@ -33,4 +33,4 @@ def write_json(data: list | dict, path: str):
     except Exception as e:
         msg = f"[io|F02]\t\t-> Failed to write JSON to '{path}' ({type(e).__name__}): {str(e)}"
         res.logger.error(msg)
-        raise HTTPException(status_code=500, detail=msg)
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=msg)
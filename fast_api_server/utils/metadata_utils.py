@@ -1,46 +1,23 @@
 # Metadata Utils: modulo per la gestione dei metadata associati ai dataset analizzati
 
-import os, io, posixpath
-import pandas as pd
+import os, hashlib, posixpath
 import utils.gcs_utils as gcs
 
+from fastapi import UploadFile
 from utils.resource_manager import resource_manager as res
+from utils.scan_utils import DatasetScanner, CHUNK_SIZE, SUPPORTED_FORMATS
+from utils.storage_utils import storage
 
 
-# F01 - Calcolo metadati di un dataset remoto
-def create_metadata(dataset_filename: str) -> dict:
-    gcs_dataset_path = posixpath.join(res.gcs_dataset_dir, dataset_filename)
-    dataset_name, file_format = os.path.splitext(dataset_filename)
-
-    # Download dati da GCS
-    blob = res.bucket.blob(gcs_dataset_path)
-
-    if not blob.exists():
-        msg = f"[metadata|F01]\t -> File '{gcs_dataset_path}' not found"
-        res.logger.error(msg)
-        raise FileNotFoundError(msg)
-
-    data = blob.download_as_text()
-
-    # Estrazione dati da file
-    if file_format == '.csv':
-        df = pd.read_csv(io.StringIO(data))
-    elif file_format == '.json':
-        df = pd.read_json(io.StringIO(data))
-    elif file_format == '.jsonl':
-        df = pd.read_json(io.StringIO(data), lines=True)
-    else:
-        msg = f"[metadata|F01]\t-> Invalid file format: '{file_format}' is not '.jsonl' or '.csv'"
-        res.logger.warning(msg)
-        raise ValueError(msg)
-
+# F01 - Composizione del dizionario dei metadati a partire dallo scanner
+def build_metadata(dataset_name: str, dataset_path: str, scanner: DatasetScanner, content_type: str, index_path: str, **extra) -> dict:
     return {
         "dataset_name": dataset_name,
-        "dataset_path": gcs_dataset_path,
-        "num_rows": df.shape[0],
-        "num_columns": df.shape[1],
-        "features": df.columns.tolist(),
-        "content_type": blob.content_type
+        "dataset_path": dataset_path,
+        **scanner.summary(),
+        "content_type": content_type,
+        "index_path": index_path,
+        **extra
     }
 
 
@@ -53,4 +30,66 @@ def download_metadata(dataset_filename: str) -> dict:
 # F03 - Upload metadati su file remoto
 def upload_metadata(dataset_filename: str, metadata: dict):
     path = gcs.get_blob_path(res.gcs_dataset_dir, dataset_filename, "metadata", "json")
-    gcs.write_json(metadata, path)
\ No newline at end of file
+    gcs.write_json(metadata, path)
+
+
+# F04 - Apertura in scrittura (upload resumable a chunk, pubblicato solo con 'commit') dell'indice delle righe di un dataset JSONL
+#       (riga i-esima -> offset in byte)
+def open_row_index(index_path: str) -> gcs.StagedUpload:
+    return gcs.StagedUpload(index_path, chunk_size=CHUNK_SIZE, content_type="application/octet-stream")
+    # Nota:
+    # L'indice permette al worker di scaricare, con una sola richiesta HTTP range, i soli byte delle righe del batch
+
+
+# F05 - Upload in streaming di un dataset ricevuto via multipart, con calcolo dei metadati nella stessa passata
+async def ingest_dataset(file: UploadFile, dataset_filename: str) -> dict:
+    dataset_path = posixpath.join(res.gcs_dataset_dir, dataset_filename)
+    dataset_name, file_format = os.path.splitext(dataset_filename)
+    index_path = gcs.get_blob_path(res.gcs_dataset_dir, dataset_filename, "index", "bin") if file_format == ".jsonl" else None
+    hasher = hashlib.sha256()
+
+    if file_format not in SUPPORTED_FORMATS:
+        msg = f"[metadata|F05]\t-> Invalid file format: '{file_format}' is not '.json', '.jsonl' or '.csv'"
+        res.logger.warning(msg)
+        raise ValueError(msg)
+
+    # Upload resumable a chunk (dataset e indice delle righe) su oggetti temporanei
+    writers = [await storage.run("upload_open", gcs.StagedUpload, dataset_path, chunk_size=CHUNK_SIZE, content_type=file.content_type)]
+    dataset_writer = writers[0]
+
+    try:
+        index_writer = await storage.run("upload_open", open_row_index, index_path) if index_path else None
+        if index_writer is not None:
+            writers.append(index_writer)
+        scanner = DatasetScanner(file_format, index_writer)
+
+        # Elaborazione di un chunk: hash, parsing/profilazione e upload (operazioni bloccanti, eseguite fuori dall'event loop)
+        def process_chunk(chunk: bytes):
+            hasher.update(chunk)
+            scanner.feed(chunk)
+            dataset_writer.write(chunk)
+
+        while chunk := await file.read(CHUNK_SIZE):
+            await storage.run("ingest_chunk", process_chunk, chunk)
+
+        await storage.run("ingest_close", scanner.close)
+
+    except BaseException:
+        # Upload annullati: un dataset non valido (o una richiesta interrotta) non sovrascrive quello già presente né il suo indice
+        for writer in writers:
+            await storage.run("upload_abort", writer.abort)
+        raise
+
+    # Pubblicazione sui percorsi finali, solo a scansione completata
+    for writer in writers:
+        await storage.run("upload_commit", writer.commit)
+
+    res.logger.info(f"[metadata|F05]\t-> Dataset '{dataset_filename}' streamed to '{dataset_path}' ({scanner.summary()['size_bytes']} bytes)")
+
+    return build_metadata(
+        dataset_name, dataset_path, scanner, file.content_type, index_path,
+        content_hash=f"sha256:{hasher.hexdigest()}"
+    )
+    # Nota:
+    # Rispetto al vecchio flusso ('file.read()' + 'upload_from_string' + 'create_metadata'), il file non viene mai caricato
+    # interamente in RAM e non viene riscaricato da GCS per calcolarne i metadati
@@ -0,0 +1,81 @@
+# Progress Utils: modulo per la lettura dell'avanzamento di un'analisi dai documenti pubblicati dal worker (nessun listing del bucket)
+
+import time, json, base64, asyncio, posixpath
+
+from utils.resource_manager import resource_manager as res
+from utils.cache_utils import blob_cache
+from utils.gcs_utils import get_run_dir
+from utils.storage_utils import storage
+
+
+# F00 - Numero di shard di avanzamento di una run: fissato alla creazione della run (campo 'progress_num_shards' del suo documento) e
+#       inviato al worker in ogni task, così che server e worker concordino anche dopo un cambio di configurazione ricaricato da uno solo
+def get_num_shards(num_batches: int, n_shards: int = None) -> int:
+    return n_shards or max(1, min(num_batches, res.progress_num_shards))
+
+
+# F01 - Percorsi degli shard di avanzamento di una run (stesso schema scritto dal worker: batch distribuiti per 'batch_id % n_shards')
+def get_shard_paths(dataset_name: str, num_batches: int, run_id: str = None, n_shards: int = None) -> list[str]:
+    n_shards = get_num_shards(num_batches, n_shards)
+    progress_dir = get_run_dir(res.gcs_progress_dir, run_id)
+    return [posixpath.join(progress_dir, f"{dataset_name}_progress_{shard:04d}.json") for shard in range(n_shards)]
+
+
+# F02 - Lettura di uno shard (tramite la cache locale dei blob); None se nessun batch dello shard è ancora stato completato
+def read_shard(path: str) -> dict | None:
+    try:
+        return json.loads(blob_cache.read_bytes(path))
+    except FileNotFoundError:
+        return None
+
+
+# F03 - Lettura in parallelo di tutti gli shard di una run (quelli non ancora creati sono omessi)
+async def load_shards(dataset_name: str, num_batches: int, run_id: str = None, n_shards: int = None) -> list[dict]:
+    paths = get_shard_paths(dataset_name, num_batches, run_id, n_shards)
+    docs = await asyncio.gather(*(storage.run("read_shard", read_shard, path) for path in paths))
+    return [doc for doc in docs if doc]
+
+
+# F04 - Aggregazione degli shard: batch completati, contatori, velocità (alert/s) e tempo stimato al termine
+def summarize(docs: list[dict], metadata: dict) -> dict:
+    num_batches, num_rows = metadata["num_batches"], metadata.get("num_rows", 0)
+
+    n_completed = sum(sum(bin(byte).count("1") for byte in base64.b64decode(doc.get("bitmap", ""))) for doc in docs)
+    n_alerts = sum(doc.get("n_alerts", 0) for doc in docs)
+    last_update = max((doc.get("last_update", 0) for doc in docs), default=None)
+
+    # Velocità media dall'avvio dell'analisi (o, per analisi avviate prima di questo campo, dal primo batch completato)
+    started_at = metadata.get("analysis_started_at") or min((doc.get("started_at", 0) for doc in docs), default=None)
+    elapsed = (last_update - started_at) if last_update and started_at else 0
+    alerts_per_sec = n_alerts / elapsed if elapsed > 0 else 0.0
+
+    remaining = max(0, num_rows - n_alerts)
+    eta_sec = remaining / alerts_per_sec if alerts_per_sec > 0 and n_completed < num_batches else (0.0 if n_completed >= num_batches else None)
+
+    return {
+        "n_completed": n_completed,
+        "num_batches": num_batches,
+        "n_alerts": n_alerts,
+        "n_errors": sum(doc.get("n_errors", 0) for doc in docs),
+        "n_timeouts": sum(doc.get("n_timeouts", 0) for doc in docs),
+        "alerts_per_sec": alerts_per_sec,
+        "eta_sec": eta_sec,
+        "last_update": last_update,
+        "seconds_since_update": time.time() - last_update if last_update else None
+    }
+
+
+# F05 - Avanzamento di un'analisi (lettura e aggregazione degli shard). 'metadata' = documento della run (o metadati del dataset, senza run ID)
+async def read_progress(dataset_name: str, metadata: dict) -> dict:
+    docs = await load_shards(dataset_name, metadata["num_batches"], metadata.get("run_id"), metadata.get("progress_num_shards"))
+    return summarize(docs, metadata)
+
+
+# F06 - ID dei batch completati, decodificati dalle bitmap degli shard (bit i-esimo dello shard s -> batch 'i * n_shards + s')
+def completed_batch_ids(docs: list[dict]) -> set[int]:
+    batch_ids = set()
+    for doc in docs:
+        shard, n_shards = doc["shard"], doc["num_shards"]
+        for i, byte in enumerate(base64.b64decode(doc.get("bitmap", ""))):
+            batch_ids.update((i * 8 + bit) * n_shards + shard for bit in range(8) if byte & (1 << bit))
+    return batch_ids
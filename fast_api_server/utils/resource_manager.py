@@ -25,8 +25,14 @@ class ResourceManager:
         self._gcs_result_dir = "results"
         self._gcs_batch_metrics_dir = "batch_metrics"
         self._gcs_batch_result_dir = "batch_results"
+        self._gcs_manifest_dir = "batch_manifests"
+        self._gcs_progress_dir = "batch_progress"
+        self._gcs_runs_dir = "runs"
+        self._progress_num_shards = 8
+        self._manifest_num_shards = 16
+        self._stream_poll_interval = 2
+        self._chat_read_timeout = 60
 
-        self._merge_lock_flag_filename = "merge_lock.flag"
         self._config_filename = "config.json"
         self._ml_dataset_filename = "training_reg_data.cvs"
 
@@ -35,13 +41,21 @@ class ResourceManager:
         self._vms_benchmark_context_path = "assets/benchmark_context.json"
         self._vms_benchmark_stop_flag = "assets/benchmark_stop.flag"
         self._vms_metrics_path = "assets/metrics.json"
-        self._vms_result_path = "assets/result.json"
+        self._vms_result_cache_dir = "assets/result_cache"
+        self._result_page_max_limit = 1000
+        self._vms_blob_cache_dir = "assets/blob_cache"
+        self._blob_cache_ttl = 10
+        self._blob_cache_memory_mb = 64
+        self._blob_cache_disk_mb = 1024
+        self._blob_cache_max_item_mb = 8
+        self._storage_max_concurrency = 32
         self._vms_ml_dataset_path = "assets/training_reg_data.csv"
 
         self._project_id = ""
         self._location = ""
 
         self._batch_analysis_queue_name = "batch-analysis"
+        self._enqueue_concurrency = 32
 
         self._runner_url = ""
         self._worker_url = ""
@@ -71,8 +85,14 @@ class ResourceManager:
         self._gcs_result_dir = conf.get("gcs_result_dir", self._gcs_result_dir)
         self._gcs_batch_metrics_dir = conf.get("gcs_batch_metrics_dir", self._gcs_batch_metrics_dir)
         self._gcs_batch_result_dir = conf.get("gcs_batch_result_dir", self._gcs_batch_result_dir)
+        self._gcs_manifest_dir = conf.get("gcs_manifest_dir", self._gcs_manifest_dir)
+        self._gcs_progress_dir = conf.get("gcs_progress_dir", self._gcs_progress_dir)
+        self._gcs_runs_dir = conf.get("gcs_runs_dir", self._gcs_runs_dir)
+        self._progress_num_shards = conf.get("progress_num_shards", self._progress_num_shards)
+        self._manifest_num_shards = conf.get("manifest_num_shards", self._manifest_num_shards)
+        self._stream_poll_interval = conf.get("stream_poll_interval", self._stream_poll_interval)
+        self._chat_read_timeout = conf.get("chat_read_timeout", self._chat_read_timeout)
         
-        self._merge_lock_flag_filename = conf.get("merge_lock_flag_filename", self._merge_lock_flag_filename)
         self._config_filename = conf.get("config_filename", self._config_filename)
         self._ml_dataset_filename = conf.get("ml_dataset_filename", self._ml_dataset_filename)
         
@@ -81,13 +101,21 @@ class ResourceManager:
         self._vms_benchmark_context_path = conf.get("vms_benchmark_context_path", self._vms_benchmark_context_path)
         self._vms_benchmark_stop_flag = conf.get("vms_benchmark_stop_flag", self._vms_benchmark_stop_flag)
         self._vms_metrics_path = conf.get("vms_metrics_path", self._vms_metrics_path)
-        self._vms_result_path = conf.get("vms_result_path", self._vms_result_path)
+        self._vms_result_cache_dir = conf.get("vms_result_cache_dir", self._vms_result_cache_dir)
+        self._result_page_max_limit = conf.get("result_page_max_limit", self._result_page_max_limit)
+        self._vms_blob_cache_dir = conf.get("vms_blob_cache_dir", self._vms_blob_cache_dir)
+        self._blob_cache_ttl = conf.get("blob_cache_ttl", self._blob_cache_ttl)
+        self._blob_cache_memory_mb = conf.get("blob_cache_memory_mb", self._blob_cache_memory_mb)
+        self._blob_cache_disk_mb = conf.get("blob_cache_disk_mb", self._blob_cache_disk_mb)
+        self._blob_cache_max_item_mb = conf.get("blob_cache_max_item_mb", self._blob_cache_max_item_mb)
+        self._storage_max_concurrency = conf.get("storage_max_concurrency", self._storage_max_concurrency)
         self._vms_ml_dataset_path = conf.get("vms_ml_dataset_path", self._vms_ml_dataset_path)
         
         self._project_id = conf.get("project_id", self._project_id)
         self._location = conf.get("location", self._location)
         
         self._batch_analysis_queue_name = conf.get("batch_analysis_queue_name", self._batch_analysis_queue_name)
+        self._enqueue_concurrency = conf.get("enqueue_concurrency", self._enqueue_concurrency)
         
         self._runner_url = conf.get("runner_url", self._runner_url)
         self._worker_url = conf.get("worker_url", self._worker_url)
@@ -156,6 +184,34 @@ class ResourceManager:
     @property
     def gcs_batch_result_dir(self):
         return self._gcs_batch_result_dir
+
+    @property
+    def gcs_manifest_dir(self):
+        return self._gcs_manifest_dir
+
+    @property
+    def gcs_progress_dir(self):
+        return self._gcs_progress_dir
+
+    @property
+    def gcs_runs_dir(self):
+        return self._gcs_runs_dir
+
+    @property
+    def progress_num_shards(self):
+        return self._progress_num_shards
+
+    @property
+    def manifest_num_shards(self):
+        return self._manifest_num_shards
+
+    @property
+    def stream_poll_interval(self):
+        return self._stream_poll_interval
+    
+    @property
+    def chat_read_timeout(self):
+        return self._chat_read_timeout
     
     @property
     def config_filename(self):
@@ -186,8 +242,36 @@ class ResourceManager:
         return self._vms_metrics_path
 
     @property
-    def vms_result_path(self):
-        return self._vms_result_path
+    def vms_result_cache_dir(self):
+        return self._vms_result_cache_dir
+
+    @property
+    def result_page_max_limit(self):
+        return self._result_page_max_limit
+
+    @property
+    def vms_blob_cache_dir(self):
+        return self._vms_blob_cache_dir
+
+    @property
+    def blob_cache_ttl(self):
+        return self._blob_cache_ttl
+
+    @property
+    def blob_cache_memory_bytes(self):
+        return self._blob_cache_memory_mb * 1024 * 1024
+
+    @property
+    def blob_cache_disk_bytes(self):
+        return self._blob_cache_disk_mb * 1024 * 1024
+
+    @property
+    def blob_cache_max_item_bytes(self):
+        return self._blob_cache_max_item_mb * 1024 * 1024
+
+    @property
+    def storage_max_concurrency(self):
+        return self._storage_max_concurrency
     
     @property
     def vms_ml_dataset_path(self):
@@ -204,6 +288,10 @@ class ResourceManager:
     @property
     def batch_analysis_queue_name(self):
         return self._batch_analysis_queue_name
+
+    @property
+    def enqueue_concurrency(self):
+        return self._enqueue_concurrency
     
     @property
     def runner_url(self):
@@ -217,10 +305,5 @@ class ResourceManager:
     def vm_service_account_email(self):
         return self._vm_service_account_email
 
-    @property
-    def merge_lock_flag_filename(self):
-        return self._merge_lock_flag_filename
-
-
 # Istanza singletone da far importare agli altri moduli
 resource_manager = ResourceManager()
\ No newline at end of file
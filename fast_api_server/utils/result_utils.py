@@ -0,0 +1,197 @@
+# Result Utils: modulo per l'interrogazione dei risultati di un'analisi (paginazione e filtri) tramite una cache SQLite locale
+
+import os, json, time, sqlite3, threading
+
+from contextlib import closing
+from google.api_core.exceptions import NotFound
+from utils.resource_manager import resource_manager as res
+from utils.gcs_utils import get_blob_path, get_run_dir
+from utils.run_utils import validate_run_id
+
+
+INSERT_BATCH_SIZE = 5000    # righe inserite per singola 'executemany' durante la costruzione della cache
+DEFAULT_PAGE_LIMIT = 100    # elementi per pagina se la richiesta non indica un 'limit'
+
+SCHEMA = """
+CREATE TABLE results (
+    id INTEGER PRIMARY KEY,
+    timestamp,
+    class TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX idx_results_class ON results (class, id);
+CREATE INDEX idx_results_timestamp ON results (timestamp);
+CREATE TABLE source (path TEXT, generation INTEGER);
+"""
+
+
+# C01 - Cache locale (un database SQLite per dataset) dei risultati finali, ricostruita solo quando cambia la generation del blob su GCS
+class ResultStore:
+    def __init__(self):
+        self._locks = {}                    # dataset -> lock di costruzione della cache (richieste concorrenti sullo stesso dataset)
+        self._locks_guard = threading.Lock()
+        self._checked = {}                  # dataset -> (istante dell'ultima verifica della generation, blob verificato)
+
+    # Interrogazione dei risultati: filtri opzionali su classe, intervallo temporale e ID, paginazione per offset o per cursore (ID dell'ultimo elemento)
+    #   Senza 'run_id' sono letti gli ultimi risultati pubblicati per il dataset
+    def query(self, dataset_filename: str, alert_class: str = None, time_from: float = None, time_to: float = None,
+              alert_id: int = None, cursor: int = None, offset: int = 0, limit: int = None, run_id: str = None) -> dict:
+        db_path = self.ensure(dataset_filename, run_id)
+
+        conditions, params = [], []
+        if alert_class is not None:
+            conditions.append("class = ?")
+            params.append(alert_class)
+        if time_from is not None or time_to is not None:
+            conditions.append("typeof(timestamp) IN ('integer', 'real')")   # esclusione dei timestamp non disponibili (es: "N/A")
+        if time_from is not None:
+            conditions.append("timestamp >= ?")
+            params.append(time_from)
+        if time_to is not None:
+            conditions.append("timestamp <= ?")
+            params.append(time_to)
+        if alert_id is not None:
+            conditions.append("id = ?")
+            params.append(alert_id)
+
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        page_where = where
+        page_params = list(params)
+        if cursor is not None:
+            page_where += (" AND " if conditions else " WHERE ") + "id > ?"
+            page_params.append(cursor)
+
+        with closing(sqlite3.connect(db_path)) as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM results{where}", params).fetchone()[0]
+
+            sql = f"SELECT id, data FROM results{page_where} ORDER BY id"
+            if limit is not None:
+                sql += " LIMIT ? OFFSET ?"
+                page_params += [limit + 1, offset]  # un elemento in più per sapere se esiste una pagina successiva
+            rows = conn.execute(sql, page_params).fetchall()
+
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit] if limit is not None else rows
+
+        return {
+            "items": [json.loads(data) for _, data in rows],
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next_cursor": rows[-1][0] if has_more else None
+        }
+
+    # Percorso della cache aggiornata del dataset (costruita, o ricostruita se il risultato su GCS è cambiato)
+    def ensure(self, dataset_filename: str, run_id: str = None) -> str:
+        dataset_name = os.path.splitext(dataset_filename)[0]
+        cache_key = f"{dataset_name}_{validate_run_id(run_id)}" if run_id else dataset_name
+        db_path = os.path.join(res.vms_result_cache_dir, f"{cache_key}.sqlite")
+
+        with self._get_lock(cache_key):
+            checked_at, blob = self._checked.get(cache_key, (None, None))
+            if checked_at is None or time.monotonic() - checked_at >= res.blob_cache_ttl:     # richieste ravvicinate non interrogano GCS
+                blob = self._get_result_blob(dataset_filename, run_id)
+                self._checked[cache_key] = (time.monotonic(), blob)
+
+            if self._cached_source(db_path) == (blob.name, blob.generation):
+                return db_path
+
+            self._build(blob, db_path)
+            return db_path
+
+    # Rimozione delle cache di una run (alla sua eliminazione: i risultati della run non esistono più su GCS). Restituisce i file rimossi
+    def drop_run(self, run_id: str) -> int:
+        suffix = f"_{validate_run_id(run_id)}.sqlite"
+        try:
+            filenames = [f for f in os.listdir(res.vms_result_cache_dir) if f.endswith(suffix)]
+        except FileNotFoundError:
+            return 0
+
+        for filename in filenames:
+            cache_key = filename[:-len(".sqlite")]
+            with self._get_lock(cache_key):
+                for path in (os.path.join(res.vms_result_cache_dir, filename), os.path.join(res.vms_result_cache_dir, filename + ".tmp")):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._checked.pop(cache_key, None)
+            with self._locks_guard:
+                self._locks.pop(cache_key, None)
+
+        res.logger.info(f"[result|C01]\t\t-> {len(filenames)} result caches of run '{run_id}' removed")
+        return len(filenames)
+
+
+    def _get_lock(self, cache_key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(cache_key, threading.Lock())
+
+    # Blob del risultato finale: JSONL del merge via compose, oppure JSON del merge con download. Se sono presenti entrambi
+    # (cambio di 'merge_mode' tra due merge), quello scritto più di recente: l'altro è il residuo di un merge precedente
+    def _get_result_blob(self, dataset_filename: str, run_id: str = None):
+        found = []
+        for file_format in ("jsonl", "json"):
+            blob = res.bucket.blob(get_blob_path(get_run_dir(res.gcs_result_dir, run_id), dataset_filename, "result", file_format))
+            try:
+                blob.reload()   # metadati (tra cui la generation) senza scaricare il contenuto
+                found.append(blob)
+            except NotFound:
+                continue
+
+        if found:
+            return max(found, key=lambda blob: (blob.updated, blob.generation))
+
+        msg = f"[result|C01]\t\t-> No result file found for '{dataset_filename}'" + (f" in run '{run_id}'" if run_id else "")
+        res.logger.error(msg)
+        raise FileNotFoundError(msg)
+
+    def _cached_source(self, db_path: str) -> tuple | None:
+        if not os.path.exists(db_path):
+            return None
+        try:
+            with closing(sqlite3.connect(db_path)) as conn:
+                return conn.execute("SELECT path, generation FROM source").fetchone()
+        except sqlite3.Error:
+            return None     # cache corrotta o con schema diverso: sarà ricostruita
+
+    # Costruzione della cache in un file temporaneo, poi sostituito atomicamente (le letture concorrenti vedono sempre una cache completa)
+    def _build(self, blob, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        tmp_path = db_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        try:
+            with closing(sqlite3.connect(tmp_path)) as conn:
+                conn.executescript(SCHEMA)
+
+                rows = []
+                for item in self._read_items(blob):
+                    rows.append((item.get("id"), item.get("timestamp"), item.get("class"), json.dumps(item, ensure_ascii=False)))
+                    if len(rows) >= INSERT_BATCH_SIZE:
+                        conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+                        rows.clear()
+                conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+                conn.execute("INSERT INTO source VALUES (?, ?)", (blob.name, blob.generation))
+                conn.commit()
+
+            os.replace(tmp_path, db_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        res.logger.info(f"[result|C01]\t\t-> Result cache built from '{blob.name}' (generation {blob.generation})")
+
+    # Lettura in streaming del risultato (JSONL riga per riga; il JSON legacy è un unico array e va letto per intero)
+    def _read_items(self, blob):
+        if blob.name.endswith(".jsonl"):
+            with blob.open("r", if_generation_match=blob.generation) as reader:
+                for line in reader:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            yield from json.loads(blob.download_as_text(if_generation_match=blob.generation))
+
+
+# Istanza singletone da far importare agli altri moduli
+result_store = ResultStore()
@@ -0,0 +1,102 @@
+# Run Utils: modulo per la gestione delle run di analisi (ogni avvio di '/analyze-dataset' ha un proprio ID e un proprio spazio su GCS)
+
+import re, json, time, uuid, random, posixpath
+import utils.gcs_utils as gcs
+
+from google.api_core.exceptions import PreconditionFailed, TooManyRequests
+from utils.resource_manager import resource_manager as res
+from utils.metadata_utils import download_metadata
+from utils.cache_utils import blob_cache
+from utils.progress_utils import get_num_shards
+
+
+RUN_DOC_FILENAME = "run.json"   # documento di stato di una run, nella radice del suo prefisso (stesso nome usato dal merge handler)
+RUN_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+RUN_FIELDS = ["dataset_name", "dataset_path", "index_path", "num_rows", "num_batches", "batch_size", "analysis_started_at"]
+
+STATUS_RUNNING = "running"      # batch in analisi (poi 'merging' e 'completed', scritti dal merge handler)
+STATUS_FAILED = "failed"        # avvio non riuscito (es: errore nell'accodamento dei task): nessun batch sarà analizzato
+MAX_UPDATE_ATTEMPTS = 10        # tentativi di aggiornamento del documento di una run, conteso con il merge handler
+
+
+# F01 - Nuovo run ID, ordinabile per istante di avvio (es: "20250101T120000-1a2b3c4d")
+def new_run_id() -> str:
+    return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+
+
+# F02 - Validazione di un run ID ricevuto da una richiesta (finisce in percorsi GCS e locali)
+def validate_run_id(run_id: str) -> str:
+    if not RUN_ID_PATTERN.match(run_id):
+        raise ValueError(f"Invalid run ID '{run_id}'")
+    return run_id
+
+
+# F03 - Percorso del documento di stato di una run
+def get_run_doc_path(run_id: str) -> str:
+    return posixpath.join(res.gcs_runs_dir, validate_run_id(run_id), RUN_DOC_FILENAME)
+
+
+# F04 - Creazione di una run a partire dai metadati del dataset: numero e dimensione dei batch sono fissati nel documento della run,
+#       così un'analisi successiva dello stesso dataset (anche con un'altra configurazione) non altera quelle in corso
+def create_run(metadata: dict) -> dict:
+    run_id = new_run_id()
+    run = {
+        "run_id": run_id,
+        "status": STATUS_RUNNING,
+        **{field: metadata.get(field) for field in RUN_FIELDS},
+        "progress_num_shards": get_num_shards(metadata.get("num_batches") or 1),  # condiviso con il worker (vedi 'progress_utils.F00')
+        "manifest_num_shards": max(1, min(metadata.get("num_batches") or 1, res.manifest_num_shards)),  # letto dal merge handler a ogni evento
+        "enqueue": {"status": "pending", "n_total": metadata.get("num_batches"), "n_enqueued": 0}  # accodamento dei task dei batch
+    }
+
+    gcs.write_json(run, get_run_doc_path(run_id))
+    res.logger.info(f"[run|F04]\t\t-> Run '{run_id}' created for dataset '{run['dataset_name']}'")
+    return run
+
+
+# F05 - Lettura del documento di stato di una run
+def read_run(run_id: str) -> dict:
+    return gcs.read_json(get_run_doc_path(run_id))
+
+
+# F06 - Risoluzione della run di una richiesta: quella indicata, oppure l'ultima avviata sul dataset (riferita nei suoi metadati).
+#       Per le analisi avviate prima dei run ID restituisce i metadati del dataset (cartelle condivise)
+def resolve_run(dataset_filename: str = None, run_id: str = None) -> dict:
+    if run_id:
+        return read_run(run_id)
+    if not dataset_filename:
+        raise ValueError("Missing 'dataset_filename' or 'run_id': no analysis started by this server")
+
+    metadata = download_metadata(dataset_filename) or {}
+    return read_run(metadata["run_id"]) if metadata.get("run_id") else metadata
+
+
+# F07 - Aggiornamento atomico di alcuni campi del documento di una run (read-modify-write con precondizione sulla generation,
+#       lo stesso documento è aggiornato dal merge handler)
+def update_run(run_id: str, **fields) -> dict:
+    path = get_run_doc_path(run_id)
+
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        blob = res.bucket.get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(f"Run '{run_id}' not found")
+
+        try:
+            run = json.loads(blob.download_as_text(if_generation_match=blob.generation))
+            run.update(fields)
+            content = json.dumps(run, indent=2).encode()
+
+            new_blob = res.bucket.blob(path)
+            new_blob.upload_from_string(content, content_type="application/json", if_generation_match=blob.generation)
+            blob_cache.put(path, new_blob.generation, content)
+            return run
+
+        except (PreconditionFailed, TooManyRequests):
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))   # scrittura concorrente del merge handler: backoff e nuovo tentativo
+
+    raise RuntimeError(f"Run document '{path}' still contended after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+# F08 - Eliminazione di tutti i file di una run (batch, manifest, avanzamento e risultati propri della run)
+async def delete_run(run_id: str):
+    await gcs.empty_dir(posixpath.join(res.gcs_runs_dir, validate_run_id(run_id)))
@@ -0,0 +1,261 @@
+# Scan Utils: modulo per la scansione incrementale (a chunk) dei dataset: parsing, profilazione delle colonne e indice delle righe
+
+import csv, json, math, heapq, codecs, struct
+
+
+CHUNK_SIZE = 1024 * 1024        # dimensione dei chunk letti/scritti su GCS (multiplo di 256 KB, richiesto dagli upload resumable)
+ROW_INDEX_ENTRY_SIZE = 8        # ogni entry dell'indice delle righe è un intero unsigned a 64 bit little-endian ('<Q') (vedi 'load_batch' in CRW)
+INDEX_FLUSH_ENTRIES = 65536     # numero di offset accumulati in RAM prima di essere scritti nell'indice
+MAX_RECORD_SIZE = 16 * 1024 * 1024  # dimensione massima di un record incompleto in attesa del chunk successivo (riga o elemento JSON)
+SKETCH_SIZE = 256               # numero di hash conservati da ogni sketch di cardinalità (errore relativo ~ 1/sqrt(k) ≈ 6%)
+SUPPORTED_FORMATS = (".json", ".jsonl", ".csv")
+
+
+# C01 - Sketch di cardinalità KMV (K Minimum Values): stima del numero di valori distinti di una colonna con memoria costante
+class CardinalitySketch:
+    def __init__(self, k: int = SKETCH_SIZE):
+        self._k = k
+        self._heap = []         # max-heap (valori negati) dei k hash più piccoli visti finora
+        self._members = set()   # stessi hash del heap, per scartare in O(1) i valori già visti
+
+    def add(self, value):
+        h = (hash(repr(value)) & 0xFFFFFFFFFFFFFFFF) / 2**64   # hash normalizzato in [0, 1)
+
+        if h in self._members:
+            return
+
+        if len(self._heap) < self._k:
+            heapq.heappush(self._heap, -h)
+            self._members.add(h)
+        elif h < -self._heap[0]:
+            removed = -heapq.heapreplace(self._heap, -h)
+            self._members.discard(removed)
+            self._members.add(h)
+
+    def estimate(self) -> int:
+        if len(self._heap) < self._k:   # meno di k valori distinti: il conteggio è esatto
+            return len(self._heap)
+        return int(round((self._k - 1) / -self._heap[0]))
+
+
+# C02 - Scanner incrementale di un dataset: riceve chunk di byte e ne estrae righe, colonne, valori nulli, cardinalità e offset delle righe
+class DatasetScanner:
+    def __init__(self, file_format: str, index_writer=None):
+        if file_format not in SUPPORTED_FORMATS:
+            raise ValueError(f"Invalid file format: '{file_format}' is not '.json', '.jsonl' or '.csv'")
+
+        self._format = file_format
+        self._index_writer = index_writer   # file binario (es: 'blob.open("wb")') su cui scrivere l'indice delle righe (solo JSONL)
+        self._index_buffer = []
+
+        self._size = 0          # byte ricevuti
+        self._num_rows = 0
+        self._columns = {}      # colonna -> [numero valori non nulli, sketch]  (il dict conserva l'ordine di prima apparizione)
+
+        # Stato JSONL (byte) e CSV (testo): riga incompleta in attesa del chunk successivo
+        self._pending = b""
+        self._pos = 0           # offset in byte dell'inizio di 'self._pending'
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()    # BOM iniziale scartato (altrimenti finirebbe nel primo campo dell'header CSV)
+        self._text = ""
+
+        # Stato CSV: header e record incompleto (campi tra virgolette contenenti a capo)
+        self._header = None
+        self._record = []
+        self._quotes = 0
+
+        # Stato JSON (array di oggetti)
+        self._json_decoder = json.JSONDecoder()
+        self._json_state = "start"  # start -> items -> end
+
+    # Aggiunta di un chunk di byte allo scanner
+    def feed(self, chunk: bytes):
+        if not chunk:
+            return
+
+        self._size += len(chunk)
+
+        if self._format == ".jsonl":
+            self._feed_jsonl(chunk)
+        elif self._format == ".csv":
+            self._feed_csv(self._decoder.decode(chunk))
+        else:
+            self._feed_json(self._decoder.decode(chunk))
+
+    # Chiusura dello scanner: elaborazione dell'eventuale ultima riga senza terminatore e scrittura della sentinella dell'indice
+    def close(self):
+        if self._format == ".jsonl":
+            if self._pending:
+                self._add_jsonl_line(self._pending)
+                self._pos += len(self._pending)
+                self._pending = b""
+
+            if self._index_writer is not None:
+                self._index_buffer.append(self._pos)    # entry sentinella: fine dell'ultima riga
+                self._flush_index()
+
+        elif self._format == ".csv":
+            tail = self._text + self._decoder.decode(b"", final=True)
+            if tail:
+                self._add_csv_line(tail)
+            if self._record:
+                raise ValueError("Unterminated quoted field at end of CSV file")
+
+        else:
+            self._feed_json(self._decoder.decode(b"", final=True))
+            if self._json_state != "end":
+                raise ValueError("Truncated JSON array")
+
+    # Riepilogo dei metadati calcolati
+    def summary(self) -> dict:
+        return {
+            "num_rows": self._num_rows,
+            "num_columns": len(self._columns),
+            "features": list(self._columns),
+            "size_bytes": self._size,
+            "columns_stats": {
+                col: {
+                    "null_count": self._num_rows - non_null,   # le colonne assenti in una riga contano come nulle (come in pandas)
+                    "approx_distinct": sketch.estimate()
+                }
+                for col, (non_null, sketch) in self._columns.items()
+            }
+        }
+
+
+    # -- JSONL ------------------------------------------------------------------------------------
+    def _feed_jsonl(self, chunk: bytes):
+        data = self._pending + chunk
+        end = data.rfind(b"\n")
+
+        if end < 0:     # nessuna riga completa nel chunk
+            self._pending = data
+            self._check_pending(len(data))
+            return
+
+        for line in data[:end].split(b"\n"):
+            self._add_jsonl_line(line)
+            self._pos += len(line) + 1
+
+        self._pending = data[end + 1:]
+
+    def _add_jsonl_line(self, line: bytes):
+        if not line.strip():    # le righe vuote sono ignorate anche da 'pd.read_json(..., lines=True)'
+            return
+
+        if self._index_writer is not None:
+            self._index_buffer.append(self._pos)
+            if len(self._index_buffer) >= INDEX_FLUSH_ENTRIES:
+                self._flush_index()
+
+        self._add_row(json.loads(line))
+
+    def _flush_index(self):
+        if self._index_buffer:
+            self._index_writer.write(struct.pack(f"<{len(self._index_buffer)}Q", *self._index_buffer))
+            self._index_buffer = []
+
+
+    # -- CSV --------------------------------------------------------------------------------------
+    def _feed_csv(self, text: str):
+        data = self._text + text
+        end = data.rfind("\n")
+
+        if end < 0:
+            self._text = data
+            self._check_pending(len(data))
+            return
+
+        for line in data[:end].split("\n"):
+            self._add_csv_line(line)
+
+        self._text = data[end + 1:]
+
+    def _add_csv_line(self, line: str):
+        # Un record è completo solo quando il numero di virgolette è pari (i campi quotati possono contenere degli a capo)
+        self._record.append(line.rstrip("\r"))
+        self._quotes += line.count('"')
+
+        if self._quotes % 2:
+            return
+
+        record = "\n".join(self._record)
+        self._record = []
+        self._quotes = 0
+
+        if not record.strip():  # righe vuote ignorate (come 'skip_blank_lines' di pandas)
+            return
+
+        values = next(csv.reader([record]))
+
+        if self._header is None:
+            self._header = values
+            for col in values:
+                self._add_column(col)
+            return
+
+        self._add_row(dict(zip(self._header, values)))
+
+
+    # -- JSON -------------------------------------------------------------------------------------
+    def _feed_json(self, text: str):
+        data = self._text + text
+        i, n = 0, len(data)
+
+        while i < n:
+            while i < n and data[i] in " \t\r\n":
+                i += 1
+            if i >= n:
+                break
+
+            if self._json_state == "start":
+                if data[i] != "[":
+                    raise ValueError("Expected a JSON array of records")
+                self._json_state = "items"
+                i += 1
+
+            elif self._json_state == "items":
+                if data[i] == ",":
+                    i += 1
+                elif data[i] == "]":
+                    self._json_state = "end"
+                    i += 1
+                else:
+                    try:
+                        row, i = self._json_decoder.raw_decode(data, i)
+                    except json.JSONDecodeError:
+                        break   # elemento incompleto: si attende il chunk successivo
+
+                    if not isinstance(row, dict):
+                        raise ValueError("Expected a JSON array of records")
+                    self._add_row(row)
+
+            else:
+                raise ValueError("Unexpected data after the end of the JSON array")
+
+        self._text = data[i:]   # taglio del buffer una sola volta per chunk (evita copie quadratiche)
+        self._check_pending(len(self._text))
+
+    # Un record incompleto oltre 'MAX_RECORD_SIZE' indica un file malformato (es: elemento JSON mai chiuso): errore invece di accumularlo
+    def _check_pending(self, size: int):
+        if size > MAX_RECORD_SIZE:
+            raise ValueError(f"Malformed dataset: record longer than {MAX_RECORD_SIZE} bytes or unterminated")
+
+
+    # -- Profilazione -----------------------------------------------------------------------------
+    def _add_column(self, col: str) -> list:
+        entry = self._columns.get(col)
+        if entry is None:
+            entry = self._columns[col] = [0, CardinalitySketch()]
+        return entry
+
+    def _add_row(self, row: dict):
+        self._num_rows += 1
+
+        for col, value in row.items():
+            entry = self._add_column(col)
+
+            if value is None or value == "" or (isinstance(value, float) and math.isnan(value)):
+                continue
+
+            entry[0] += 1
+            entry[1].add(value)
@@ -0,0 +1,75 @@
+# Storage Utils: modulo per l'esecuzione asincrona delle operazioni bloccanti su GCS (thread pool dedicato, concorrenza limitata e latenze misurate)
+
+import time, asyncio, functools
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.resource_manager import resource_manager as res
+
+
+LATENCY_WINDOW = 1000   # ultime latenze conservate per operazione (percentili)
+SLOW_CALL_SEC = 2.0     # soglia oltre la quale una chiamata viene segnalata nei log
+
+
+# C01 - Facciata asincrona del client GCS: le chiamate bloccanti sono eseguite in un thread pool riservato allo storage, così un upload
+#       di grandi dimensioni non blocca l'event loop (es: '/health') né occupa il pool di default usato dal resto del server
+class AsyncStorage:
+    def __init__(self):
+        self._max_concurrency = res.storage_max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency, thread_name_prefix="gcs")
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)  # chiamate in attesa fuori dal pool: tempo di coda misurabile
+        self._stats = {}
+
+    # Esecuzione di una chiamata bloccante ('op' = nome dell'operazione nelle statistiche)
+    async def run(self, op: str, fn, *args, **kwargs):
+        queued_at = time.perf_counter()
+
+        async with self._semaphore:
+            started_at = time.perf_counter()
+            failed = False
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self._record(op, started_at - queued_at, time.perf_counter() - started_at, failed)
+
+    # Statistiche per operazione: numero di chiamate, errori, latenza (media, p50, p95, massima) e attesa media in coda, in millisecondi
+    def stats(self) -> dict:
+        result = {}
+        for op, stat in self._stats.items():
+            latencies = sorted(stat["latencies"])
+            result[op] = {
+                "n_calls": stat["n_calls"],
+                "n_errors": stat["n_errors"],
+                "avg_ms": round(stat["total_sec"] / stat["n_calls"] * 1000, 1),
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+                "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+                "max_ms": round(stat["max_sec"] * 1000, 1),
+                "avg_queue_ms": round(stat["queue_sec"] / stat["n_calls"] * 1000, 1)
+            }
+        return {"max_concurrency": self._max_concurrency, "operations": result}
+
+    # Chiusura del thread pool (allo spegnimento del server)
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def _record(self, op: str, queue_sec: float, elapsed: float, failed: bool):
+        stat = self._stats.setdefault(op, {
+            "n_calls": 0, "n_errors": 0, "total_sec": 0.0, "max_sec": 0.0, "queue_sec": 0.0, "latencies": deque(maxlen=LATENCY_WINDOW)
+        })
+        stat["n_calls"] += 1
+        stat["n_errors"] += failed
+        stat["total_sec"] += elapsed
+        stat["max_sec"] = max(stat["max_sec"], elapsed)
+        stat["queue_sec"] += queue_sec
+        stat["latencies"].append(elapsed)
+
+        if elapsed >= SLOW_CALL_SEC:
+            res.logger.warning(f"[storage|C01]\t-> Slow GCS call '{op}': {elapsed:.2f}s (queued {queue_sec:.2f}s)")
+
+
+# Istanza singletone da far importare agli altri moduli
+storage = AsyncStorage()
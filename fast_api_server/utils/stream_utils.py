@@ -0,0 +1,142 @@
+# Stream Utils: modulo per la diffusione in streaming (Server-Sent Events) dell'avanzamento di un'analisi e dei risultati dei batch completati
+
+import json, asyncio, posixpath
+
+from utils.resource_manager import resource_manager as res
+from utils.gcs_utils import get_run_dir
+from utils.progress_utils import load_shards, summarize, completed_batch_ids
+from utils.storage_utils import storage
+
+
+STREAM_QUEUE_SIZE = 256     # eventi in coda per client: un client più lento viene disconnesso invece di rallentare gli altri
+KEEP_ALIVE_SEC = 15         # intervallo dei commenti SSE di keep-alive (evita la chiusura della connessione da parte di proxy)
+
+
+# F01 - Formattazione di un evento SSE
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), ensure_ascii=False)}\n\n"
+
+
+# F02 - Lettura dei risultati di un batch completato (nome del file deterministico, stesso schema del worker)
+def read_batch_results(dataset_name: str, batch_id: int, run_id: str = None) -> list[dict]:
+    path = posixpath.join(get_run_dir(res.gcs_batch_result_dir, run_id), f"{dataset_name}_result_{batch_id}.jsonl")
+    lines = res.bucket.blob(path).download_as_text().splitlines()
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+# C01 - Diffusore dell'avanzamento di una run: un solo ciclo di polling (documenti di avanzamento del worker) condiviso da tutti i client
+#       'metadata' = documento della run (o metadati del dataset, per le analisi senza run ID)
+class ProgressBroadcaster:
+    def __init__(self, key: str, metadata: dict, on_close):
+        self._key = key
+        self._metadata = metadata
+        self._dataset_name = metadata["dataset_name"]
+        self._run_id = metadata.get("run_id")
+        self._subscribers = set()
+        self._seen = None           # batch già notificati (None fino al primo polling)
+        self._last_progress = None
+        self._on_close = on_close
+        self._task = None
+
+    # Registrazione di un client: riceve subito l'ultimo avanzamento noto, poi gli eventi successivi
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        if self._last_progress is not None:
+            queue.put_nowait(("progress", self._last_progress))
+
+        self._subscribers.add(queue)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+
+    def _publish(self, event: str, data: dict):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                self._disconnect(queue, "client too slow")
+
+    # Chiusura dello stream di un client (gli eventi in coda sono scartati solo se non c'è spazio per l'evento di chiusura)
+    def _disconnect(self, queue: asyncio.Queue, reason: str):
+        self._subscribers.discard(queue)
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+        queue.put_nowait(("close", {"reason": reason}))
+
+    async def _run(self):
+        try:
+            num_batches = self._metadata["num_batches"]
+
+            while self._subscribers:
+                docs = await load_shards(self._dataset_name, num_batches, self._run_id, self._metadata.get("progress_num_shards"))
+                batch_ids = completed_batch_ids(docs)
+
+                if self._seen is None:
+                    self._seen = batch_ids  # batch completati prima del primo client: già consultabili tramite '/result' (nessun replay)
+
+                for batch_id in sorted(batch_ids - self._seen):
+                    alerts = await storage.run("read_batch_results", read_batch_results, self._dataset_name, batch_id, self._run_id)
+                    self._publish("batch", {"batch_id": batch_id, "alerts": alerts})
+                    self._seen.add(batch_id)
+
+                progress = summarize(docs, self._metadata)
+                if self._last_progress is None or progress["last_update"] != self._last_progress["last_update"]:
+                    self._publish("progress", progress)     # solo se un documento di avanzamento è cambiato dall'ultimo polling
+                self._last_progress = progress
+
+                if self._last_progress["n_completed"] >= num_batches:
+                    self._publish("completed", self._last_progress)
+                    break
+
+                await asyncio.sleep(res.stream_poll_interval)
+
+        except Exception as e:
+            res.logger.error(f"[stream|C01]\t\t-> Polling of '{self._key}' failed ({type(e).__name__}): {str(e)}")
+            self._publish("error", {"detail": f"{type(e).__name__}: {str(e)}"})
+
+        finally:
+            for queue in list(self._subscribers):
+                self._disconnect(queue, "stream ended")
+            self._on_close(self._key, self)
+
+
+# C02 - Registro dei diffusori attivi (uno per run, oppure per dataset nelle analisi senza run ID)
+class StreamHub:
+    def __init__(self):
+        self._broadcasters = {}
+
+    # Generatore degli eventi SSE di un client, fino al termine dell'analisi o alla disconnessione del client
+    async def events(self, metadata: dict):
+        key = metadata.get("run_id") or metadata["dataset_name"]
+        broadcaster = self._broadcasters.get(key)
+        if broadcaster is None:
+            broadcaster = self._broadcasters[key] = ProgressBroadcaster(key, metadata, self._remove)
+        queue = broadcaster.subscribe()
+
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=KEEP_ALIVE_SEC)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if event == "close":
+                    break
+                yield format_event(event, data)
+
+        finally:
+            broadcaster.unsubscribe(queue)  # anche alla disconnessione del client (generatore cancellato da Starlette)
+
+    def _remove(self, key: str, broadcaster: ProgressBroadcaster):
+        if self._broadcasters.get(key) is broadcaster:
+            del self._broadcasters[key]
+
+
+# Istanza singletone da far importare agli altri moduli
+stream_hub = StreamHub()
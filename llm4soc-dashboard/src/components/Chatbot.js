@@ -1,5 +1,5 @@
 import React, { useState } from "react";
-import { sendMessageToChatAPI } from "../services/apiService";
+import { streamMessageToChatAPI } from "../services/apiService";
 
 export default function Chatbot({ selectedAlerts }) {
   const [messages, setMessages] = useState([]);
@@ -19,21 +19,29 @@ export default function Chatbot({ selectedAlerts }) {
 
     console.log("Invio al chatbot:", selectedAlerts);
 
+    // Messaggio del bot aggiornato man mano che arrivano i frammenti della risposta
+    const updateBotMessage = (text) =>
+      setMessages((prev) => {
+        const last = prev[prev.length - 1];
+        const botMessage = { sender: "bot", text };
+        return last?.sender === "bot" && last.streaming
+          ? [...prev.slice(0, -1), { ...botMessage, streaming: true }]
+          : [...prev, { ...botMessage, streaming: true }];
+      });
+
     try {
-      const response = await sendMessageToChatAPI(
+      const response = await streamMessageToChatAPI(
         selectedAlerts,
-        input
+        input,
+        (_, reply) => updateBotMessage(reply)
       );
       console.log("Risposta dal backend:", response);
-      const botMessage = { sender: "bot", text: response.reply };
-      setMessages((prev) => [...prev, botMessage]);
+      updateBotMessage(response.reply);
       console.log("Messaggio ricevuto dal chatbot:", response.reply);
     } catch (err) {
-      setMessages((prev) => [
-        ...prev,
-        { sender: "bot", text: "❌ Errore nella risposta del chatbot." },
-      ]);
+      updateBotMessage("❌ Errore nella risposta del chatbot.");
     } finally {
+      setMessages((prev) => prev.map(({ streaming, ...msg }) => msg));
       setLoading(false);
     }
   };
@@ -2,7 +2,8 @@ import React, { useRef, useState } from "react";
 import {
   uploadFileToAPI,
   analyzeAlertsOnServer,
-  fetchResultsFromAPI
+  fetchResultsFromAPI,
+  subscribeToAnalysisStream
 } from "../services/apiService";
 
 export default function UploadFile({
@@ -20,6 +21,7 @@ export default function UploadFile({
   const [lastFile, setLastFile] = useState(null);
   const [interrupted, setInterrupted] = useState(false);
   const timerRef = useRef(null);
+  const streamRef = useRef(null);
   const fileInputRef = useRef(null);
 
   const startTimer = () => {
@@ -35,6 +37,23 @@ export default function UploadFile({
 
   const stopTimer = () => clearInterval(timerRef.current);
 
+  // 📡 Attesa della fine dell'analisi tramite lo stream SSE: true se completata, false se lo stream non è disponibile
+  const waitForAnalysis = (datasetFilename, runId) =>
+    new Promise((resolve) => {
+      const close = subscribeToAnalysisStream(datasetFilename, runId, {
+        onCompleted: () => resolve(true),
+        onError: () => resolve(false),
+      });
+      streamRef.current = () => {
+        close();
+        resolve(false);
+      };
+    }).finally(() => {
+      streamRef.current = null;
+    });
+
+  const stopStream = () => streamRef.current?.();
+
   const processFile = async (file) => {
     setLoading(true);
     setError("");
@@ -44,7 +63,12 @@ export default function UploadFile({
 
     try {
       await uploadFileToAPI(file);
-      await analyzeAlertsOnServer(file.name);
+      const analysis = await analyzeAlertsOnServer(file.name);
+
+      // Con lo stream i risultati sono richiesti solo a fine analisi; senza (o se il merge non è ancora concluso) si torna al polling
+      if (typeof EventSource !== "undefined") {
+        await waitForAnalysis(file.name, analysis.run_id);
+      }
 
       let result = null;
 
@@ -75,6 +99,7 @@ export default function UploadFile({
     } catch (err) {
       setError("❌ Errore: " + err.message);
     } finally {
+      stopStream();
       stopTimer();
       setLoading(false);
     }
@@ -95,6 +120,7 @@ export default function UploadFile({
 
   const handleStopClick = () => {
     setInterrupted(true);
+    stopStream();
     stopTimer();
     setError("❌ Errore: esecuzione interrotta manualmente");
     setLoading(false);
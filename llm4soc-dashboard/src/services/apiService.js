@@ -14,7 +14,7 @@ export async function uploadFileToAPI(file) {
 }
 
 export async function analyzeAlertsOnServer(datasetFilename) {
-  const response = await fetch(`${BASE_URL}/analyze-dataset?dataset_filename=${datasetFilename}`, {
+  const response = await fetch(`${BASE_URL}/analyze-dataset?dataset_filename=${encodeURIComponent(datasetFilename)}`, {
     method: "GET",
   });
 
@@ -23,19 +23,43 @@ export async function analyzeAlertsOnServer(datasetFilename) {
 }
 
 export async function fetchResultsFromAPI(datasetFilename) {
-  const response = await fetch(`${BASE_URL}/result?dataset_filename=${datasetFilename}`);
+  const response = await fetch(`${BASE_URL}/result?dataset_filename=${encodeURIComponent(datasetFilename)}`);
 
   if (!response.ok) throw new Error("Errore fetch risultati");
   return response.json();
 }
 
-export async function sendMessageToChatAPI(alertList, questionText) {
+export function subscribeToAnalysisStream(datasetFilename, runId, { onBatch, onProgress, onCompleted, onError } = {}) {
+  const params = runId ? `run_id=${encodeURIComponent(runId)}` : `dataset_filename=${encodeURIComponent(datasetFilename)}`;
+  const source = new EventSource(`${BASE_URL}/analysis-stream?${params}`);
+
+  source.addEventListener("batch", (e) => onBatch?.(JSON.parse(e.data)));
+  source.addEventListener("progress", (e) => onProgress?.(JSON.parse(e.data)));
+  source.addEventListener("completed", (e) => {
+    source.close();
+    onCompleted?.(JSON.parse(e.data));
+  });
+  source.addEventListener("error", (e) => {
+    if (e.data) {
+      source.close();
+      onError?.(JSON.parse(e.data));
+    } else if (source.readyState === EventSource.CLOSED) {
+      // Connessione rifiutata (es: risposta non SSE): il browser non riprova, il chiamante passa al polling
+      onError?.({ detail: "stream non disponibile" });
+    }
+  });
+
+  return () => source.close();
+}
+
+export async function streamMessageToChatAPI(alertList, questionText, onToken) {
   const alertsPayload = Array.isArray(alertList) ? alertList : [alertList];
 
-  const response = await fetch(`${BASE_URL}/chat`, {
+  const response = await fetch(`${BASE_URL}/chat?stream=true`, {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
+      "Accept": "text/event-stream",
     },
     body: JSON.stringify({
       alerts: alertsPayload,
@@ -45,6 +69,34 @@ export async function sendMessageToChatAPI(alertList, questionText) {
 
   if (!response.ok) throw new Error("Errore richiesta chatbot");
 
-  const data = await response.json();
-  return { reply: data.explanation };
+  // POST: EventSource non utilizzabile, gli eventi SSE sono letti dal body della risposta
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let reply = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const events = buffer.split("\n\n");
+    buffer = events.pop();
+
+    for (const block of events) {
+      const event = block.match(/^event: (.*)$/m)?.[1];
+      const data = JSON.parse(block.match(/^data: (.*)$/m)?.[1] ?? "{}");
+
+      if (event === "token") {
+        reply += data.text;
+        onToken?.(data.text, reply);
+      } else if (event === "done") {
+        return { reply: data.explanation };
+      } else if (event === "error") {
+        throw new Error(data.detail || "Errore richiesta chatbot");
+      }
+    }
+  }
+
+  return { reply };
 }